@@ -0,0 +1,398 @@
+# Seekable page archives which serve single HTML pages without extracting them.
+#
+# A container consists of a data file holding every page as an independently compressed
+# blob and a JSON index mapping each page name to the offset and length of its blob.
+# Reading a page therefore costs one seek and the decompression of this page only.
+# Pages are compressed with gzip or, if the zstandard package is installed, with zstd
+# and optionally a dictionary trained on sample pages which is stored next to the index.
+
+import json
+import logging
+import os
+import queue
+import tarfile
+import threading
+import zlib
+from datetime import datetime
+from typing import Iterable, Tuple
+from urllib.parse import quote, unquote, urlparse, parse_qs
+
+from scrapy.responsetypes import responsetypes
+from twisted.internet import defer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTAINER_SUFFIX = '.pages'
+INDEX_SUFFIX = '.index.json'
+
+logger = logging.getLogger(__name__)
+
+
+class Codec:
+
+    def __init__(self, name: str = 'gzip', dictionary: bytes = None, level: int = None):
+        """Initializes compression of single pages.
+
+        :param name: str
+            gzip or zstd
+        :param dictionary: bytes
+            zstd dictionary shared by all pages
+        :param level: int
+            Compression level, defaults to 6 for gzip and 19 for zstd
+        """
+        self.name = name
+        self.dictionary = dictionary
+        if name == 'gzip':
+            self.level = level or 6
+        elif name == 'zstd':
+            if zstandard is None:
+                raise ValueError('Codec zstd requires the zstandard package')
+            self.level = level or 19
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dict_data)
+            self.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+        else:
+            raise ValueError('Unknown codec: %s' % name)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a single page.
+
+        :param data: bytes
+        :return: bytes
+        """
+        if self.name == 'zstd':
+            return self.compressor.compress(data)
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)  # gzip member readable by any gzip tool
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompresses a single page.
+
+        :param data: bytes
+        :return: bytes
+        """
+        if self.name == 'zstd':
+            return self.decompressor.decompress(data)
+        return zlib.decompress(data, 31)
+
+
+def train_dictionary(samples: list, size: int = 112640) -> bytes:
+    """Trains a zstd dictionary on sample pages. Pages of the same site share most of their markup
+    which a dictionary lets compress well even though every page is compressed on its own.
+
+    :param samples: list
+        of page bytes
+    :param size: int
+        Maximum size of the dictionary in bytes
+    :return: bytes
+    """
+    if zstandard is None:
+        raise ValueError('Training a dictionary requires the zstandard package')
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def index_path(path: str) -> str:
+    """Returns path of the index belonging to the container.
+
+    :param path: str
+    :return: str
+    """
+    return path + INDEX_SUFFIX
+
+
+class ArchiveWriter:
+
+    def __init__(self, path: str, codec: str = 'gzip', dictionary_path: str = None):
+        """Initializes writer creating a new container. The index is written when closing the writer
+        so that a container without index is recognizable as incomplete.
+
+        :param path: str
+            Path of the container data file
+        :param codec: str
+            Compression of the single pages
+        :param dictionary_path: str
+            zstd dictionary file located in the directory of the container
+        """
+        self.path = path
+        self.dictionary_path = dictionary_path
+        dictionary = None
+        if dictionary_path:
+            with open(dictionary_path, 'rb') as f:
+                dictionary = f.read()
+        self.codec = Codec(codec, dictionary)
+        self.members = {}
+        self.rows = {}
+        self.file = open(path, 'wb')
+
+    def add(self, name: str, data: bytes, row: list = None) -> None:
+        """Appends page to the container. A page added twice replaces the earlier one in the index.
+
+        :param name: str
+        :param data: bytes
+        :param row: list
+            Metadata of the page such as its url which is stored in the index
+        """
+        blob = self.codec.compress(data)
+        self.members[name] = (self.file.tell(), len(blob))
+        self.file.write(blob)
+        if row is not None:
+            self.rows[name] = row
+
+    def close(self) -> None:
+        """Closes the data file and atomically writes the index."""
+        self.file.close()
+        temp_path = index_path(self.path) + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            index = {'codec': self.codec.name, 'members': self.members}
+            if self.dictionary_path:
+                index['dictionary'] = os.path.basename(self.dictionary_path)
+            if self.rows:
+                index['rows'] = self.rows
+            json.dump(index, f)
+        os.replace(temp_path, index_path(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:  # leave container without index
+            self.file.close()
+
+
+class PageArchiveWriter:
+
+    def __init__(self, directory: str, prefix: str, max_pages: int = 1000, codec: str = 'gzip', queue_size: int = 1000):
+        """Initializes writer which appends pages in a background thread to rolling containers of max_pages pages each,
+        so that neither writing nor compressing pages blocks the reactor. The rows of the pages are stored in the index
+        of their container, which is written atomically once the container is complete.
+
+        :param directory: str
+            Directory of the containers
+        :param prefix: str
+            Start of the container names, e.g. stories
+        :param max_pages: int
+            Number of pages after which a new container is started
+        :param codec: str
+            Compression of the single pages
+        :param queue_size: int
+            Number of pages waiting to be written after which adding a page blocks
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.max_pages = max_pages
+        self.codec = codec
+        self.pages = queue.Queue(queue_size)
+        self.completed = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='PageArchiveWriter-' + prefix, daemon=True)
+        self.thread.start()
+
+    def add(self, name: str, data: bytes, row: list) -> None:
+        """Queues page to be appended to the current container.
+
+        :param name: str
+            Filename of the page
+        :param data: bytes
+        :param row: list
+            Metadata of the page, e.g. filename, url, uid and chapter
+        """
+        if self.error:
+            raise self.error
+        self.pages.put((name, data, row))
+
+    def flush(self) -> None:
+        """Completes the current container and waits until all queued pages are written."""
+        self.pages.put(None)
+        self.pages.join()
+        if self.error:
+            raise self.error
+
+    def close(self) -> None:
+        """Completes the current container and stops the background thread."""
+        self.flush()
+        self.pages.put(False)
+        self.thread.join()
+
+    def committed(self) -> list:
+        """Returns the rows of the pages of all containers completed since the last call.
+
+        :return: list
+        """
+        rows = []
+        while True:
+            try:
+                rows.extend(self.completed.get_nowait())
+            except queue.Empty:
+                return rows
+
+    def new_container(self) -> ArchiveWriter:
+        name = '%s_%s%s' % (self.prefix, datetime.now().strftime('%Y%m%d%H%M%S%f'), CONTAINER_SUFFIX)
+        return ArchiveWriter(os.path.join(self.directory, name), self.codec)
+
+    def complete(self, writer: ArchiveWriter) -> None:
+        writer.close()
+        self.completed.put(list(writer.rows.values()))
+        logger.info('Archive: %s', writer.path)
+
+    def run(self) -> None:
+        """Writes queued pages until closed. None completes the current container, False stops the thread."""
+        writer = None
+        while True:
+            page = self.pages.get()
+            try:
+                if page is False:
+                    return
+                if self.error:  # discard pages after a failure, the spider stops with the next add
+                    continue
+                if page is None:
+                    if writer is not None:
+                        self.complete(writer)
+                        writer = None
+                    continue
+                if writer is None:
+                    writer = self.new_container()
+                writer.add(*page)
+                if len(writer.members) >= self.max_pages:
+                    self.complete(writer)
+                    writer = None
+            except Exception as e:  # surfaced in the reactor thread by the next add or flush
+                logger.exception('Writing page to archive failed')
+                self.error = e
+            finally:
+                self.pages.task_done()
+
+
+class ArchiveReader:
+
+    def __init__(self, path: str):
+        """Initializes random-access reader of a container.
+
+        :param path: str
+            Path of the container data file
+        """
+        self.path = path
+        with open(index_path(path), encoding='utf-8') as f:
+            index = json.load(f)
+        dictionary = None
+        if index.get('dictionary'):
+            with open(os.path.join(os.path.dirname(path), index['dictionary']), 'rb') as f:
+                dictionary = f.read()
+        self.codec = Codec(index['codec'], dictionary)
+        self.members = index['members']
+        self.rows = index.get('rows', {})
+        self.file = open(path, 'rb')
+        self.lock = threading.Lock()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.members
+
+    def names(self) -> Iterable[str]:
+        return self.members.keys()
+
+    def read(self, name: str) -> bytes:
+        """Returns the uncompressed page.
+
+        :param name: str
+        :return: bytes
+        """
+        offset, length = self.members[name]
+        with self.lock:  # decompressors must not be shared between threads either
+            self.file.seek(offset)
+            return self.codec.decompress(self.file.read(length))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def convert_archive(archive_path: str, container_path: str = None, codec: str = 'gzip') -> Tuple[str, list]:
+    """Recompresses a tar.gz archive into a container once. Pages are named by their filename
+    without directories such as temp/.
+
+    :param archive_path: str
+    :param container_path: str
+        defaults to the archive path with the container suffix
+    :param codec: str
+    :return: path of the container and names of its pages
+    """
+    if container_path is None:
+        container_path = archive_path[:-len('.tar.gz')] + CONTAINER_SUFFIX if archive_path.endswith('.tar.gz') else archive_path + CONTAINER_SUFFIX
+    with tarfile.open(archive_path, 'r|gz') as f, ArchiveWriter(container_path, codec) as writer:
+        for member in f:
+            if member.isfile() and member.name.endswith('.html'):
+                with f.extractfile(member) as page:
+                    writer.add(os.path.basename(member.name), page.read())
+        names = list(writer.members)
+    return container_path, names
+
+
+def archive_url(container_path: str, name: str) -> str:
+    """Returns url of a page inside a container. The page name is part of the query
+    so that every page has its own request fingerprint.
+
+    :param container_path: str
+    :param name: str
+    :return: str
+    """
+    return 'archive://' + quote(os.path.abspath(container_path)) + '?member=' + quote(name)
+
+
+def parse_archive_url(url: str) -> Tuple[str, str]:
+    """Returns container path and page name of an archive url.
+
+    :param url: str
+    :return: tuple
+    """
+    parsed = urlparse(url)
+    return unquote(parsed.path), parse_qs(parsed.query)['member'][0]
+
+
+class ArchiveDownloadHandler:
+    lazy = False
+
+    def __init__(self, settings, crawler=None):
+        """Initializes download handler for archive:// urls which reads pages straight from containers.
+        Enable it with DOWNLOAD_HANDLERS = {'archive': 'fanfiction.archives.ArchiveDownloadHandler'}.
+
+        :param settings: Settings
+        :param crawler: Crawler
+        """
+        self.max_open = settings.getint('ARCHIVE_MAX_OPEN_FILES', 64)
+        self.readers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    def reader(self, path: str) -> ArchiveReader:
+        """Returns reader of the container while keeping a limited number of containers open.
+
+        :param path: str
+        :return: ArchiveReader
+        """
+        reader = self.readers.pop(path, None)
+        if reader is None:
+            if len(self.readers) >= self.max_open:
+                oldest = next(iter(self.readers))
+                self.readers.pop(oldest).close()
+            reader = ArchiveReader(path)
+        self.readers[path] = reader  # most recently used last
+        return reader
+
+    def download_request(self, request, _spider):
+        return defer.maybeDeferred(self.read_response, request)
+
+    def read_response(self, request):
+        path, name = parse_archive_url(request.url)
+        body = self.reader(path).read(name)
+        respcls = responsetypes.from_args(filename=name, body=body)
+        return respcls(url=request.url, body=body)
+
+    def close(self) -> None:
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
@@ -0,0 +1,130 @@
+# Last-seen metadata of crawled urls for incremental crawls.
+#
+# For every url the signature of its listing entry, the validators ETag and Last-Modified and a hash of
+# its content are kept in the crawl_meta collection. Signatures and hashes are preloaded as 64-bit
+# fingerprints, so deciding whether a listed story changed costs no database query. Validators are only
+# fetched for pages which are requested again, since just these need conditional request headers.
+
+import time
+
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+from .fingerprints import fingerprint
+
+COLLECTION = 'crawl_meta'
+
+
+def listing_signature(texts: list) -> int:
+    """Returns fingerprint of the text of a listing entry, e.g. counts of chapters and reviews and the date of the last update.
+
+    :param texts: list
+        of text nodes
+    :return: int
+    """
+    return fingerprint(' '.join(text.strip() for text in texts if text.strip()))
+
+
+class CrawlMetaStore:
+
+    def __init__(self, db: Database, batch_size: int = 1000):
+        """Initializes store of last-seen metadata whose changes are written in unordered batches.
+
+        :param db: Database
+        :param batch_size: int
+            Number of buffered changes after which they are written
+        """
+        self.collection = db[COLLECTION]
+        self.batch_size = batch_size
+        self.signatures = {}
+        self.hashes = {}
+        self.operations = []
+
+    def load(self) -> None:
+        """Preloads listing signatures and content hashes."""
+        self.collection.create_index('url', unique=True)
+        for meta in self.collection.find({}, {'url': 1, 'listingSignature': 1, 'contentHash': 1}):
+            key = fingerprint(meta['url'])
+            if meta.get('listingSignature'):
+                self.signatures[key] = int(meta['listingSignature'], 16)
+            if meta.get('contentHash'):
+                self.hashes[key] = int(meta['contentHash'], 16)
+
+    def has_listing(self, url: str) -> bool:
+        return fingerprint(url) in self.signatures
+
+    def listing_changed(self, url: str, signature: int) -> bool:
+        """Checks if the listing entry of the url differs from the one seen last.
+
+        :param url: str
+        :param signature: int
+            fingerprint of the listing entry text, see listing_signature
+        :return: bool
+        """
+        return self.signatures.get(fingerprint(url)) != signature
+
+    def record_listing(self, url: str, signature: int) -> None:
+        """Remembers the listing entry of the url once its page has been crawled.
+
+        :param url: str
+        :param signature: int
+        """
+        self.signatures[fingerprint(url)] = signature
+        self.update(url, {'listingSignature': '%016x' % signature})
+
+    def conditional_headers(self, url: str) -> dict:
+        """Returns If-None-Match and If-Modified-Since headers from the validators of the last response.
+
+        :param url: str
+        :return: dict
+        """
+        if fingerprint(url) not in self.hashes:
+            return {}
+        meta = self.collection.find_one({'url': url}, {'etag': 1, 'lastModified': 1}) or {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('lastModified'):
+            headers['If-Modified-Since'] = meta['lastModified']
+        return headers
+
+    def unchanged(self, response, content: str = None) -> bool:
+        """Checks if the page was not modified or has the same content as last time and records its validators.
+
+        :param response: Response
+        :param content: str
+            Relevant part of the page which excludes e.g. advertisements, defaults to the whole page
+        :return: bool
+        """
+        if response.status == 304:
+            self.update(response.url, {'seenAt': time.time()})
+            return True
+        key = fingerprint(response.url)
+        content_hash = fingerprint(response.text if content is None else content)
+        fields = {'contentHash': '%016x' % content_hash, 'seenAt': time.time()}
+        for header, field in [(b'ETag', 'etag'), (b'Last-Modified', 'lastModified')]:
+            value = response.headers.get(header)
+            if value:
+                fields[field] = value.decode('latin-1')
+        self.update(response.url, fields)
+        same = self.hashes.get(key) == content_hash
+        self.hashes[key] = content_hash
+        return same
+
+    def update(self, url: str, fields: dict) -> None:
+        self.operations.append(UpdateOne({'url': url}, {'$set': fields}, upsert=True))
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered changes."""
+        if not self.operations:
+            return
+        operations, self.operations = self.operations, []
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:  # concurrent upserts of the same url
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+            if errors:
+                raise
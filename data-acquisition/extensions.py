@@ -0,0 +1,225 @@
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import os
+import re
+import resource
+import sqlite3
+import sys
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import data_path
+from twisted.internet import reactor, task
+from twisted.web import resource as web_resource, server
+
+
+def directory_size(path: str) -> int:
+    """Returns the size of all files below the path in bytes.
+
+    :param path: str
+    :return: int
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:  # removed meanwhile, e.g. a drained queue chunk
+                pass
+    return size
+
+
+def peak_memory() -> int:
+    """Returns the peak resident memory of the process in bytes.
+
+    :return: int
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+
+class FootprintReport:
+
+    def __init__(self, crawler, interval: float):
+        """Initializes extension sampling the length of the scheduler queue and the size of JOBDIR
+        and reporting their maxima together with the peak memory at the end of the crawl.
+
+        :param crawler: Crawler
+        :param interval: float
+            Seconds between samples
+        """
+        self.crawler = crawler
+        self.interval = interval
+        self.jobdir = crawler.settings.get('JOBDIR')
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('FOOTPRINT_ENABLED'):
+            raise NotConfigured
+        extension = cls(crawler, crawler.settings.getfloat('FOOTPRINT_INTERVAL', 60.0))
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.sample)
+        self.task.start(self.interval, now=True)
+
+    def queue_size(self) -> int:
+        """Returns the number of requests enqueued and not yet dequeued by the scheduler during this run,
+        from its stats since the engine exposes the scheduler only privately. Requests left in the JOBDIR by
+        a previous run are not included.
+
+        :return: int
+        """
+        stats = self.crawler.stats
+        return max(0, stats.get_value('scheduler/enqueued', 0) - stats.get_value('scheduler/dequeued', 0))
+
+    def sample(self) -> None:
+        stats = self.crawler.stats
+        stats.max_value('footprint/max_queue_size', self.queue_size())
+        stats.max_value('footprint/peak_memory_mb', round(peak_memory() / 1048576, 1))
+        if self.jobdir:
+            stats.max_value('footprint/max_jobdir_mb', round(directory_size(self.jobdir) / 1048576, 1))
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.sample()
+        stats = self.crawler.stats
+        spider.logger.info('Footprint: peak memory %s MB, maximum queue size %s, maximum JOBDIR size %s MB',
+                           stats.get_value('footprint/peak_memory_mb'), stats.get_value('footprint/max_queue_size'), stats.get_value('footprint/max_jobdir_mb', 0))
+
+
+class MetricsResource(web_resource.Resource):
+    isLeaf = True
+
+    def __init__(self, exporter):
+        super().__init__()
+        self.exporter = exporter
+
+    def render_GET(self, request):
+        """Renders the latest sample in the Prometheus text format."""
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        lines = ['fanfiction_%s %s' % (re.sub(r'[^a-zA-Z0-9_]', '_', name), value) for name, value in sorted(self.exporter.latest.items())]
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class MetricsExporter:
+
+    def __init__(self, crawler, interval: float, path: str, retention_days: float, port: int = None):
+        """Initializes extension sampling pages, items per type and 429 responses per second as well as the mean and p95 latency
+        of the database operations of the pipelines. Samples are kept in a SQLite file and optionally served via HTTP.
+
+        :param crawler: Crawler
+        :param interval: float
+            Seconds between samples
+        :param path: str
+            SQLite file keeping the samples of all spiders
+        :param retention_days: float
+            Days after which samples are deleted
+        :param port: int
+            Local port serving the latest sample on /metrics, none if None
+        """
+        self.crawler = crawler
+        self.interval = interval
+        self.path = path
+        self.retention_days = retention_days
+        self.port = port
+        self.item_counts = {}
+        self.previous = {}
+        self.sampled_at = None
+        self.latest = {}
+        self.connection = None
+        self.listener = None
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            interval=crawler.settings.getfloat('METRICS_INTERVAL', 30.0),
+            path=data_path(crawler.settings.get('METRICS_FILE', 'metrics.sqlite')),
+            retention_days=crawler.settings.getfloat('METRICS_RETENTION_DAYS', 7.0),
+            port=crawler.settings.getint('METRICS_PORT') or None
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        return extension
+
+    def spider_opened(self, spider):
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS samples (spider TEXT NOT NULL, sampled_at REAL NOT NULL, name TEXT NOT NULL, value REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS samples_sampled_at ON samples (sampled_at)')
+        self.connection.commit()
+        if self.port:
+            self.listener = reactor.listenTCP(self.port, server.Site(MetricsResource(self)), interface='127.0.0.1')
+            spider.logger.info('Serving crawl metrics on http://127.0.0.1:%d/metrics', self.port)
+        self.sampled_at = time.monotonic()
+        self.task = task.LoopingCall(self.sample, spider)
+        self.task.start(self.interval, now=False)
+
+    def item_scraped(self, item, spider):
+        name = type(item).__name__
+        self.item_counts[name] = self.item_counts.get(name, 0) + 1
+
+    def counters(self) -> dict:
+        stats = self.crawler.stats
+        counters = {
+            'pages': stats.get_value('response_received_count', 0),
+            'items': stats.get_value('item_scraped_count', 0),
+            '429': stats.get_value('ratelimit/429', 0),
+        }
+        counters.update({'items/' + name: count for name, count in self.item_counts.items()})
+        return counters
+
+    def pipeline_latencies(self) -> list:
+        """Returns the latency recorders of the enabled item pipelines.
+
+        :return: list
+        """
+        itemproc = getattr(getattr(self.crawler.engine, 'scraper', None), 'itemproc', None)
+        return [pipeline.latencies for pipeline in getattr(itemproc, 'middlewares', ()) if hasattr(pipeline, 'latencies')]
+
+    def sample(self, spider) -> None:
+        """Computes the rates of the counters since the last sample and the latencies of the database operations and stores them."""
+        now = time.monotonic()
+        elapsed = max(now - self.sampled_at, 1e-6)
+        counters = self.counters()
+        metrics = {name + '_per_second': round((count - self.previous.get(name, 0)) / elapsed, 3) for name, count in counters.items()}
+        for latencies in self.pipeline_latencies():
+            for (operation, collection), (count, mean, p95) in latencies.drain().items():
+                metrics['pipeline/%s/%s/mean_ms' % (operation, collection)] = round(mean, 3)
+                metrics['pipeline/%s/%s/p95_ms' % (operation, collection)] = round(p95, 3)
+                metrics['pipeline/%s/%s_per_second' % (operation, collection)] = round(count / elapsed, 3)
+        self.previous = counters
+        self.sampled_at = now
+        self.latest = metrics
+        sampled_at = time.time()
+        self.connection.executemany('INSERT INTO samples (spider, sampled_at, name, value) VALUES (?, ?, ?, ?)',
+                                    [(spider.name, sampled_at, name, value) for name, value in metrics.items()])
+        self.connection.execute('DELETE FROM samples WHERE sampled_at < ?', (sampled_at - self.retention_days * 86400,))
+        self.connection.commit()
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.sample(spider)
+        stats = self.crawler.stats
+        for latencies in self.pipeline_latencies():
+            for (operation, collection), (count, mean) in latencies.means().items():
+                stats.set_value('pipeline/%s/%s/count' % (operation, collection), count)
+                stats.set_value('pipeline/%s/%s/mean_ms' % (operation, collection), round(mean, 3))
+        if self.listener:
+            self.listener.stopListening()
+        self.connection.close()
+        self.connection = None
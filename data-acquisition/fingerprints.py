@@ -0,0 +1,55 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from typing import Iterable
+
+
+def fingerprint(url: str) -> int:
+    """Returns 64-bit fingerprint of the url.
+
+    :param url: str
+    :return: int
+    """
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class UrlSet:
+
+    def __init__(self, fingerprints: Iterable[int] = ()):
+        """Initializes compact membership set of url fingerprints.
+        Preloaded fingerprints are kept in a sorted array taking 8 bytes each and searched by bisection,
+        urls added later on are kept in a regular set. Collisions of fingerprints may report a url as
+        contained which is not, which is negligible for 64 bits and millions of urls.
+
+        :param fingerprints: Iterable[int]
+            e.g. an array('Q') filled with fingerprint()
+        """
+        self.fingerprints = array('Q', sorted(fingerprints))
+        self.added = set()
+
+    @classmethod
+    def from_urls(cls, urls: Iterable[str]):
+        """Creates set containing the urls.
+
+        :param urls: Iterable[str]
+        :return: UrlSet
+        """
+        return cls(array('Q', (fingerprint(url) for url in urls)))
+
+    def __contains__(self, url: str) -> bool:
+        value = fingerprint(url)
+        if value in self.added:
+            return True
+        index = bisect_left(self.fingerprints, value)
+        return index < len(self.fingerprints) and self.fingerprints[index] == value
+
+    def __len__(self) -> int:
+        return len(self.fingerprints) + len(self.added)
+
+    def add(self, url: str) -> None:
+        """Adds url to the set.
+
+        :param url: str
+        """
+        if url not in self:
+            self.added.add(fingerprint(url))
@@ -0,0 +1,95 @@
+# Content-addressed HTTP cache storage for Scrapy's HttpCacheMiddleware.
+#
+# Every response is stored once per request fingerprint in a SQLite database per spider. Bodies are kept
+# in a separate table keyed by the SHA-256 hash of their content and compressed with the codecs of the
+# page archives, so identical pages such as error or login pages are stored a single time. Together with
+# HTTPCACHE_IGNORE_MISSING a crawl can be replayed entirely from the cache without network requests.
+
+import hashlib
+import os
+import sqlite3
+import time
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from archives import Codec
+
+
+class ContentAddressedCacheStorage:
+
+    def __init__(self, settings):
+        """Initializes cache storage. Enable it with HTTPCACHE_STORAGE = 'fanfiction.httpcache.ContentAddressedCacheStorage'.
+
+        :param settings: Settings
+        """
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.codec = Codec(settings.get('HTTPCACHE_CODEC', 'gzip'))
+        self.commit_interval = settings.getint('HTTPCACHE_COMMIT_INTERVAL', 1000)
+        self.connection = None
+        self.fingerprinter = None
+        self.changes = 0
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, spider.name + '.sqlite')
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (fingerprint TEXT PRIMARY KEY, url TEXT NOT NULL, status INTEGER NOT NULL, headers BLOB NOT NULL, body TEXT NOT NULL, stored_at REAL NOT NULL) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, codec TEXT NOT NULL, data BLOB NOT NULL) WITHOUT ROWID')
+        self.connection.commit()
+        self.fingerprinter = getattr(spider.crawler, 'request_fingerprinter', None)
+        spider.logger.debug('Using content-addressed cache storage in %s', path)
+
+    def close_spider(self, spider):
+        self.connection.commit()
+        self.connection.close()
+        self.connection = None
+
+    def fingerprint(self, request) -> str:
+        if self.fingerprinter is not None:
+            return self.fingerprinter.fingerprint(request).hex()
+        from scrapy.utils.request import request_fingerprint  # Scrapy < 2.7
+        return request_fingerprint(request)
+
+    def retrieve_response(self, spider, request):
+        """Returns the cached response of the request or None if it is missing or expired.
+
+        :param spider: Spider
+        :param request: Request
+        :return: Response or None
+        """
+        row = self.connection.execute('SELECT url, status, headers, body, stored_at FROM responses WHERE fingerprint = ?', (self.fingerprint(request),)).fetchone()
+        if row is None:
+            return None
+        url, status, raw_headers, body_hash, stored_at = row
+        if 0 < self.expiration_secs < time.time() - stored_at:
+            return None
+        body_row = self.connection.execute('SELECT codec, data FROM bodies WHERE hash = ?', (body_hash,)).fetchone()
+        if body_row is None:
+            return None
+        codec, data = body_row
+        body = (self.codec if codec == self.codec.name else Codec(codec)).decompress(data)
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        """Stores the response while storing its body only if no response with the same body was stored before.
+
+        :param spider: Spider
+        :param request: Request
+        :param response: Response
+        """
+        body_hash = hashlib.sha256(response.body).hexdigest()
+        if self.connection.execute('SELECT 1 FROM bodies WHERE hash = ?', (body_hash,)).fetchone() is None:
+            self.connection.execute('INSERT INTO bodies (hash, codec, data) VALUES (?, ?, ?)', (body_hash, self.codec.name, self.codec.compress(response.body)))
+        self.connection.execute('INSERT OR REPLACE INTO responses (fingerprint, url, status, headers, body, stored_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                (self.fingerprint(request), response.url, response.status, headers_dict_to_raw(response.headers), body_hash, time.time()))
+        self.changes += 1
+        if self.changes >= self.commit_interval:
+            self.connection.commit()
+            self.changes = 0
@@ -2,12 +2,13 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
-import re
 
 from scrapy.item import Item, Field
 from itemloaders.processors import TakeFirst, MapCompose, Join
 from w3lib.html import remove_tags, replace_tags, replace_escape_chars, replace_entities
 
+from normalization import WHITESPACE_PATTERN, normalize_default, normalize_text
+
 
 def replace_tags_with_commas(value: str) -> str:
     """Replaces HTML tags with commas.
@@ -51,7 +52,7 @@ def replace_multiple_spaces(value: str) -> str:
     :return: str
         where multiple spaces got replaced with one
     """
-    return re.sub(r'\s+', ' ', value)
+    return WHITESPACE_PATTERN.sub(' ', value)
 
 
 def replace_escape_chars_with_spaces(value: str) -> str:
@@ -65,8 +66,10 @@ def replace_escape_chars_with_spaces(value: str) -> str:
     return replace_escape_chars(value, replace_by=' ')
 
 
-DEFAULT_INPUT_PROCESSORS = MapCompose(replace_tags_with_spaces, replace_escape_chars, replace_entities, replace_nbsp, replace_multiple_spaces, str.strip)
-TEXT_INPUT_PROCESSORS = MapCompose(replace_tags_with_spaces, replace_escape_chars_with_spaces, replace_entities, replace_nbsp, replace_multiple_spaces, str.strip)
+# normalize_default and normalize_text are single-pass equivalents of the chains
+# replace_tags_with_spaces, replace_escape_chars(_with_spaces), replace_entities, replace_nbsp, replace_multiple_spaces, str.strip
+DEFAULT_INPUT_PROCESSORS = MapCompose(normalize_default)
+TEXT_INPUT_PROCESSORS = MapCompose(normalize_text)
 
 
 class User(Item):
@@ -4,12 +4,19 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+import random
 import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Union
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.response import response_status_message
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 
 
 class FanfictionSpiderMiddleware:
@@ -106,26 +113,169 @@ class FanfictionDownloaderMiddleware:
         spider.logger.info('Spider opened: %s' % spider.name)
 
 
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float):
+        """Initializes token bucket of a domain. Tokens are reserved in advance, so a negative
+        number of tokens is the queue of delayed requests waiting for their token.
+
+        :param rate: float
+            Tokens added per second
+        :param burst: float
+            Maximum number of tokens
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.failures = 0
+
+    def reserve(self, now: float) -> float:
+        """Takes a token and returns the seconds to wait until it becomes available.
+
+        :param now: float
+            monotonic time
+        :return: float
+        """
+        if now > self.updated_at:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+        self.tokens -= 1
+        wait = self.updated_at - now
+        if self.tokens < 0:
+            wait += -self.tokens / self.rate
+        return wait
+
+    def backoff(self, delay: float, now: float) -> None:
+        """Blocks the domain for the delay and starts refilling the bucket afterwards.
+
+        :param delay: float
+            seconds
+        :param now: float
+            monotonic time
+        """
+        self.blocked_until = max(self.blocked_until, now + delay)
+        self.updated_at = max(self.updated_at, self.blocked_until)
+        self.tokens = 0
+
+
+def parse_retry_after(value: bytes) -> Union[float, None]:
+    """Returns the seconds of a Retry-After header given either as seconds or as HTTP date.
+
+    :param value: bytes
+    :return: float or None if missing or invalid
+    """
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
 class TooManyRequestsRetryMiddleware(RetryMiddleware):
 
     def __init__(self, crawler):
+        """Initializes retry middleware limiting the requests of each domain by a token bucket.
+        A 429 response halves the rate of its domain and blocks the domain for the seconds of its
+        Retry-After header or an exponential backoff with jitter. Only requests to this domain are delayed,
+        the rate recovers with every successful response.
+
+        :param crawler: Crawler
+        """
         super(TooManyRequestsRetryMiddleware, self).__init__(crawler.settings)
         self.crawler = crawler
+        settings = crawler.settings
+        self.rate = settings.getfloat('RATELIMIT_RATE', 4.0)
+        self.max_rate = settings.getfloat('RATELIMIT_MAX_RATE', self.rate)
+        self.min_rate = settings.getfloat('RATELIMIT_MIN_RATE', 0.05)
+        self.burst = settings.getfloat('RATELIMIT_BURST', 4.0)
+        self.recovery = settings.getfloat('RATELIMIT_RECOVERY', 0.05)
+        self.backoff_base = settings.getfloat('RATELIMIT_BACKOFF_BASE', 60.0)
+        self.backoff_max = settings.getfloat('RATELIMIT_BACKOFF_MAX', 600.0)
+        self.jitter = settings.getfloat('RATELIMIT_JITTER', 0.25)
+        self.buckets = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         return cls(crawler)
 
+    def bucket(self, request) -> Union[TokenBucket, None]:
+        """Returns token bucket of the domain of the request, None for local files and archives.
+
+        :param request: Request
+        :return: TokenBucket or None
+        """
+        domain = urlparse_cached(request).hostname
+        if not domain:
+            return None
+        bucket = self.buckets.get(domain)
+        if bucket is None:
+            bucket = self.buckets[domain] = TokenBucket(self.rate, self.burst)
+            self.update_stats(domain, bucket)
+        return bucket
+
+    def update_stats(self, domain: str, bucket: TokenBucket) -> None:
+        stats = self.crawler.stats
+        stats.set_value('ratelimit/%s/rate' % domain, round(bucket.rate, 3))
+        stats.set_value('ratelimit/%s/failures' % domain, bucket.failures)
+        stats.set_value('ratelimit/%s/backoff' % domain, round(max(0.0, bucket.blocked_until - time.monotonic()), 1))
+
+    def process_request(self, request, spider):
+        bucket = self.bucket(request)
+        if bucket is None:
+            return None
+        wait = bucket.reserve(time.monotonic())
+        if wait <= 0:
+            return None
+        self.crawler.stats.inc_value('ratelimit/delayed')
+        delayed = Deferred()
+        reactor.callLater(wait, delayed.callback, None)
+        delayed.addCallback(lambda _: self.process_request(request, spider) if bucket.blocked_until > time.monotonic() else None)  # wait again if backed off meanwhile
+        return delayed
+
     def process_response(self, request, response, spider):
+        bucket = self.bucket(request)
+        if response.status == 429:
+            self.crawler.stats.inc_value('ratelimit/429')
+            if bucket is not None:
+                self.backoff(request, response, spider, bucket)
+        elif bucket is not None and bucket.failures:
+            bucket.failures = 0
+            self.update_stats(urlparse_cached(request).hostname, bucket)
+        elif bucket is not None and bucket.rate < self.max_rate:
+            bucket.rate = min(self.max_rate, bucket.rate + self.recovery)
+            self.update_stats(urlparse_cached(request).hostname, bucket)
+
         if request.meta.get('dont_retry', False):
             return response
-        elif response.status == 429:
-            self.crawler.engine.pause()
-            time.sleep(300)  # If the rate limit is renewed in a minute, put 300 seconds, and so on.
-            self.crawler.engine.unpause()
-            reason = response_status_message(response.status)
-            return self._retry(request, reason, spider) or response
-        elif response.status in self.retry_http_codes:
+        elif response.status in self.retry_http_codes or response.status == 429:
             reason = response_status_message(response.status)
             return self._retry(request, reason, spider) or response
         return response
+
+    def backoff(self, request, response, spider, bucket: TokenBucket) -> None:
+        """Halves the rate of the domain and blocks it for the Retry-After seconds or an exponential backoff.
+
+        :param request: Request
+        :param response: Response
+        :param spider: Spider
+        :param bucket: TokenBucket
+        """
+        bucket.failures += 1
+        bucket.rate = max(self.min_rate, bucket.rate / 2)
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (bucket.failures - 1))
+        delay += random.uniform(0, delay * self.jitter)  # spread the retries of concurrent requests
+        bucket.backoff(delay, time.monotonic())
+        domain = urlparse_cached(request).hostname
+        spider.logger.info('Too many requests to %s, backing off for %.0f seconds at %.2f requests per second', domain, delay, bucket.rate)
+        self.update_stats(domain, bucket)
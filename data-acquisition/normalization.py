@@ -0,0 +1,91 @@
+# Text normalization used by the input processors of the items and by the date helpers.
+#
+# Each processor chain of items.py ran one w3lib function and one regular expression after another
+# on every value. The functions below do the same work in a single function call per value with
+# precompiled patterns, skip steps which cannot change the value and cache the results for short,
+# frequently repeated values such as tags, fandoms or user names.
+
+import re
+from datetime import datetime
+from functools import lru_cache
+
+from dateutil import parser
+from w3lib.html import replace_entities
+
+# same pattern as w3lib.html.replace_tags
+TAG_PATTERN = re.compile(r'<[a-zA-Z\/!].*?>', re.DOTALL)
+# also matches NBSP characters
+WHITESPACE_PATTERN = re.compile(r'\s+')
+REMOVE_ESCAPE_CHARS = str.maketrans('', '', '\n\t\r')
+NON_DATETIME_PATTERN = re.compile(r'[^\d.:]+')
+NON_DATE_PATTERN = re.compile(r'[^\d.]+')
+# e.g. 24.12.2015 or 24.12.2015 18:30
+GERMAN_DATETIME_PATTERN = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})(?: (\d{1,2}):(\d{2})(?::(\d{2}))?)?')
+
+# values up to this length are cached
+CACHE_MAX_LENGTH = 256
+CACHE_SIZE = 65536
+
+
+def normalize(value: str, escape_chars: bool) -> str:
+    """Replaces tags with spaces, removes escape chars, replaces entities and collapses whitespace
+    including NBSP characters into single spaces before stripping the value.
+
+    :param value: str
+    :param escape_chars: bool
+        remove escape chars instead of treating them as whitespace
+    :return: str
+    """
+    if '<' in value:
+        value = TAG_PATTERN.sub(' ', value)
+    if escape_chars:
+        value = value.translate(REMOVE_ESCAPE_CHARS)
+    if '&' in value:
+        value = replace_entities(value)
+    return WHITESPACE_PATTERN.sub(' ', value).strip()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def normalize_cached(value: str, escape_chars: bool) -> str:
+    return normalize(value, escape_chars)
+
+
+def normalize_default(value: str) -> str:
+    """Normalizes short values, equivalent to replace_tags_with_spaces, replace_escape_chars, replace_entities,
+    replace_nbsp, replace_multiple_spaces and str.strip.
+
+    :param value: str
+    :return: str
+    """
+    if len(value) <= CACHE_MAX_LENGTH:
+        return normalize_cached(value, True)
+    return normalize(value, True)
+
+
+def normalize_text(value: str) -> str:
+    """Normalizes text such as summaries or chapter contents, equivalent to replace_tags_with_spaces,
+    replace_escape_chars_with_spaces, replace_entities, replace_nbsp, replace_multiple_spaces and str.strip.
+
+    :param value: str
+    :return: str
+    """
+    if len(value) <= CACHE_MAX_LENGTH:
+        return normalize_cached(value, False)
+    return normalize(value, False)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_datetime(value: str) -> datetime:
+    """Parses German dates such as 24.12.2015 with an optional time, day first. Other formats are parsed by dateutil.
+
+    :param value: str
+    :return: datetime
+    """
+    match = GERMAN_DATETIME_PATTERN.fullmatch(value.strip())
+    if match:
+        day, month, year, hour, minute, second = match.groups()
+        try:
+            return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+        except ValueError:
+            pass
+    return parser.parse(value)
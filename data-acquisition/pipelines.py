@@ -3,55 +3,667 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import logging
+import math
+import threading
+import time
 import pymongo
-from typing import Union
+from collections import deque
+from contextlib import contextmanager
+from typing import Tuple, Union
 from datetime import datetime
 
 from bson import ObjectId
 from itemadapter import ItemAdapter
-from scrapy import Spider
+from pymongo import ASCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from scrapy import Spider, signals
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
 
 from items import User, Story, Chapter, Review
+from urlfields import COLLECTIONS as URL_COLLECTIONS, url_fields
 from utilities import merge_dict, str_to_int
 
+# collections holding names which are resolved by the pipelines
+LOOKUP_COLLECTIONS = ['sources', 'categories', 'genres', 'ratings', 'pairings', 'fandoms', 'topics', 'characters', 'tags']
+
+# fields by which documents not yet written in bulk mode can be found
+PENDING_KEYS = {
+    'stories': [('_id',), ('url',), ('iid',)],
+    'users': [('_id',), ('url',)],
+    'chapters': [('_id',), ('url',), ('storyId', 'number')],
+    'reviews': [('_id',), ('userId', 'reviewedAt', 'reviewableType', 'reviewableId'), ('reviewedAt', 'reviewableType', 'reviewableId')],
+}
+
+# collections written before the others in bulk mode, each one referenced by the following ones and the join rows
+FLUSH_ORDER = ['users', 'stories', 'chapters', 'reviews']
+
+# unique fields on which documents are upserted in bulk mode, so that concurrent processes do not insert them twice
+UPSERT_KEYS = {'users': 'url', 'stories': 'url', 'chapters': 'url'}
+
+# fields of a buffered document not set on the document another process inserted first
+MERGE_EXCLUDED = {'_id', 'url', 'createdAt', 'currentChapterCount', 'currentReviewCount'}
+
+# indexes backing the lookups of the pipelines, unique ones keep upserts from creating duplicates
+INDEXES = {
+    'stories': [IndexModel([('url', ASCENDING)], unique=True), IndexModel([('iid', ASCENDING)], unique=True, sparse=True), IndexModel([('urlHost', ASCENDING), ('urlKind', ASCENDING)])],
+    'users': [IndexModel([('url', ASCENDING)], unique=True), IndexModel([('urlHost', ASCENDING), ('urlKind', ASCENDING)])],
+    'chapters': [IndexModel([('url', ASCENDING)], unique=True), IndexModel([('storyId', ASCENDING), ('number', ASCENDING)]), IndexModel([('urlHost', ASCENDING), ('urlKind', ASCENDING)])],
+    'reviews': [IndexModel([('reviewableId', ASCENDING), ('reviewableType', ASCENDING), ('reviewedAt', ASCENDING)])],
+    'story_fandoms': [IndexModel([('storyId', ASCENDING), ('fandomId', ASCENDING)], unique=True)],
+    'story_topics': [IndexModel([('storyId', ASCENDING), ('topicId', ASCENDING)], unique=True)],
+    'story_characters': [IndexModel([('storyId', ASCENDING), ('characterId', ASCENDING)], unique=True)],
+    'story_ratings': [IndexModel([('storyId', ASCENDING), ('ratingId', ASCENDING)], unique=True)],
+    'story_pairings': [IndexModel([('storyId', ASCENDING), ('pairingId', ASCENDING)], unique=True)],
+    'story_tags': [IndexModel([('storyId', ASCENDING), ('tagId', ASCENDING)], unique=True)],
+}
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_indexes(db: Database) -> None:
+    """Creates the indexes used by the pipelines unless they exist already.
+    A unique index which cannot be built, e.g. due to existing duplicates or a non-unique index
+    on the same fields, is replaced by a non-unique one so that lookups still avoid collection scans.
+
+    :param db: Database
+    """
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            keys = list(index.document['key'].items())
+            try:
+                db[collection].create_indexes([index])
+            except OperationFailure as e:
+                if not index.document.get('unique'):
+                    raise
+                logger.warning('Unique index on %s.%s not created, upserts may produce duplicates: %s', collection, ', '.join(k for k, _ in keys), e)
+                db[collection].create_index(keys)
+
+
+class LookupCache:
+
+    def __init__(self, db: Database, collections: list):
+        """Initializes write-through cache for the lookup collections.
+
+        :param db: Database
+            MongoDB database containing the lookup collections
+        :param collections: list
+            Names of the collections to be cached
+        """
+        self.db = db
+        self.collections = collections
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def name_fields(collection: str) -> tuple:
+        """Returns the fields a document of the collection can be found by.
+
+        :param collection: str
+        :return: tuple
+        """
+        if collection == 'sources':
+            return 'name',
+        return 'name1', 'name2', 'name3'
+
+    def load(self) -> None:
+        """Preloads all documents of the cached collections while indexing every name alias."""
+        for collection in self.collections:
+            self.ids[collection] = {}
+            projection = {field: 1 for field in self.name_fields(collection)}
+            projection['fandomId'] = 1
+            for document in self.db[collection].find({}, projection):
+                self.add(collection, document)
+
+    def add(self, collection: str, document: dict) -> None:
+        """Adds document to the cache. Characters are only unique within their fandom.
+
+        :param collection: str
+        :param document: dict
+            containing the _id and name fields
+        """
+        scope = document.get('fandomId')
+        for field in self.name_fields(collection):
+            name = document.get(field)
+            if name is not None:
+                self.ids[collection].setdefault((scope, name), document['_id'])  # first match wins as with find_one
+
+    def find_id(self, collection: str, name: str, fandom_id: ObjectId = None) -> Union[ObjectId, None]:
+        """Returns id of the document matching one of its names.
+
+        :param collection: str
+        :param name: str
+        :param fandom_id: ObjectId
+            only used for characters
+        :return: id of the matching document or None
+        """
+        return self.ids[collection].get((fandom_id, name))
+
+    def find_or_insert(self, collection: str, name: str, document: dict) -> ObjectId:
+        """Returns id of the document matching the name and inserts the passed document on a miss.
+
+        :param collection: str
+        :param name: str
+        :param document: dict
+            to be inserted if no document matches the name
+        :return: id of the found or created document
+        """
+        document_id = self.find_id(collection, name, document.get('fandomId'))
+        if document_id is None:
+            with self.lock:
+                document_id = self.find_id(collection, name, document.get('fandomId'))
+                if document_id is None:
+                    document_id = self.db[collection].insert_one(document).inserted_id
+                    self.add(collection, document)
+        return document_id
+
+
+def percentile(values: list, p: float) -> float:
+    """Returns the nearest-rank percentile of the values.
+
+    :param values: list
+    :param p: float
+        between 0 and 100
+    :return: float
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+class LatencyRecorder:
+
+    def __init__(self, window: int = 10000):
+        """Initializes recorder of the durations of database operations per operation and collection.
+
+        :param window: int
+            Maximum number of durations kept per operation and collection between two calls of drain
+        """
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, operation: str, collection: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(operation, collection, time.perf_counter() - start)
+
+    def record(self, operation: str, collection: str, seconds: float) -> None:
+        key = (operation, collection)
+        with self.lock:
+            samples = self.samples.get(key)
+            if samples is None:
+                samples = self.samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+            count, total = self.totals.get(key, (0, 0.0))
+            self.totals[key] = (count + 1, total + seconds)
+
+    def drain(self) -> dict:
+        """Returns number, mean and p95 in milliseconds of the durations recorded since the last call
+        per operation and collection and discards them.
+
+        :return: dict
+            mapping (operation, collection) to (count, mean_ms, p95_ms)
+        """
+        with self.lock:
+            samples, self.samples = self.samples, {}
+        return {key: (len(values), sum(values) / len(values) * 1000, percentile(values, 95) * 1000) for key, values in samples.items()}
+
+    def means(self) -> dict:
+        """Returns number and mean in milliseconds of all durations recorded per operation and collection.
+
+        :return: dict
+            mapping (operation, collection) to (count, mean_ms)
+        """
+        with self.lock:
+            return {key: (count, total / count * 1000) for key, (count, total) in self.totals.items()}
+
 
-class FanfictionPipeline:
+class BulkWriter:
 
-    def __init__(self, mongo_uri: str, mongo_db: str):
+    def __init__(self, db: Database, batch_size: int = 1000, flush_interval: float = 10.0, latencies: LatencyRecorder = None, on_flush=None):
+        """Initializes buffer collecting write operations per collection.
+
+        :param db: Database
+        :param batch_size: int
+            Number of buffered operations triggering a flush
+        :param flush_interval: float
+            Seconds after which buffered operations are flushed on the next write
+        :param latencies: LatencyRecorder
+            Recording the durations of the batch writes
+        :param on_flush: Callable
+            Called with whether all operations were written after each flush while still holding the lock,
+            so no operation is buffered before it returns
+        """
+        self.db = db
+        self.latencies = latencies or LatencyRecorder()
+        self.on_flush = on_flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.inserts = {}
+        self.updates = {}
+        self.documents = {}
+        self.replaced = {}  # ids of buffered documents mapped to those of documents another process inserted first
+        self.count = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.RLock()
+
+    def insert(self, collection: str, document: dict) -> ObjectId:
+        """Buffers insert of document. Its id is created client-side so that dependent documents can reference it immediately.
+
+        :param collection: str
+        :param document: dict
+        :return: id of the document to be inserted
+        """
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        with self.lock:
+            pending = self.documents.setdefault(collection, {})
+            for fields in PENDING_KEYS.get(collection, []):
+                if all(field in document for field in fields):
+                    pending.setdefault((fields, tuple(document[field] for field in fields)), document)
+            self.add(self.inserts, collection, document)
+        return document['_id']
+
+    def update(self, collection: str, query: dict, update: dict, upsert: bool = False) -> None:
+        """Buffers update of the document matching the query. Fields set on a buffered document are set on it
+        right away, so that pending returns it as it will be written.
+
+        :param collection: str
+        :param query: dict
+        :param update: dict
+            containing update operators
+        :param upsert: bool
+        """
+        with self.lock:
+            if '$set' in update and list(query) == ['_id']:
+                document = self.documents.get(collection, {}).get((('_id',), (query['_id'],)))
+                if document is not None:
+                    document.update(update['$set'])  # the buffered insert holds the same dict
+            self.add(self.updates, collection, (query, update, upsert))
+
+    def pending(self, collection: str, query: dict) -> Union[dict, None]:
+        """Returns buffered document matching the query by equality or None.
+
+        :param collection: str
+        :param query: dict
+        :return: dict or None
+        """
+        with self.lock:
+            return self.documents.get(collection, {}).get((tuple(query.keys()), tuple(query.values())))
+
+    def add(self, buffer: dict, collection: str, operation) -> None:
+        """Adds operation to the buffer and flushes it when one of the thresholds is reached.
+
+        :param buffer: dict
+            of inserts or updates
+        :param collection: str
+        :param operation: dict | tuple
+            document to be inserted or query, update and upsert flag
+        """
+        with self.lock:
+            buffer.setdefault(collection, []).append(operation)
+            self.count += 1
+            if self.count >= self.batch_size or time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+
+    def replace_ids(self, value):
+        """Returns the value with ids of documents inserted first by another process replacing those of the buffered ones.
+
+        :param value: Any
+        :return: Any
+        """
+        if isinstance(value, ObjectId):
+            return self.replaced.get(value, value)
+        if isinstance(value, dict):
+            return {k: self.replace_ids(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.replace_ids(v) for v in value)
+        return value
+
+    def write(self, collection: str, operations: list) -> Tuple[set, list]:
+        """Writes operations in an unordered batch.
+
+        :param collection: str
+        :param operations: list
+        :return: indexes of the operations which inserted a document by an upsert and the write errors
+        """
+        try:
+            with self.latencies.measure('bulk_write', collection):
+                result = self.db[collection].bulk_write(operations, ordered=False)
+            return set(result.upserted_ids), []
+        except BulkWriteError as e:
+            return {upserted['index'] for upserted in e.details.get('upserted', [])}, e.details.get('writeErrors', [])
+
+    def write_inserts(self, collection: str, documents: list) -> Tuple[list, list]:
+        """Writes buffered documents. Documents with a unique url are upserted on it, so that a document another
+        process inserted first is not duplicated. Its id then replaces the id of the buffered document.
+
+        :param collection: str
+        :param documents: list
+        :return: updates setting the fields of buffered documents on those inserted first, and the write errors
+        """
+        key = UPSERT_KEYS.get(collection)
+        keyed = {i for i, document in enumerate(documents) if key and document.get(key) is not None}
+        operations = [UpdateOne({key: document[key]}, {'$setOnInsert': {k: v for k, v in document.items() if k != key}}, upsert=True) if i in keyed else InsertOne(document)
+                      for i, document in enumerate(documents)]
+        upserted, errors = self.write(collection, operations)
+        retries = [error['index'] for error in errors if error.get('code') == 11000 and error['index'] in keyed]  # concurrent upserts of the same url
+        if retries:
+            errors = [error for error in errors if error['index'] not in retries]
+            retried, retry_errors = self.write(collection, [operations[i] for i in retries])
+            upserted |= {retries[i] for i in retried}
+            errors += [dict(error, index=retries[error['index']]) for error in retry_errors]
+        failed = {error['index'] for error in errors}
+        matched = [documents[i] for i in sorted(keyed - upserted - failed)]
+        updates = []
+        if matched:
+            winners = {row[key]: row['_id'] for row in self.db[collection].find({key: {'$in': [document[key] for document in matched]}}, {key: 1})}
+            for document in matched:
+                winner = winners.get(document[key])
+                if winner is None or winner == document['_id']:
+                    continue
+                self.replaced[document['_id']] = winner
+                fields = {k: v for k, v in document.items() if k not in MERGE_EXCLUDED and v is not None and v != ''}
+                if not document.get('isPreliminary') and fields:  # as upsert, preliminary documents do not set their fields
+                    updates.append((collection, {'_id': winner}, {'$set': fields}, False))
+        return updates, errors
+
+    def flush(self) -> None:
+        """Writes all buffered operations, referenced documents before the ones referencing them and inserts before
+        updates within a collection. on_flush is told whether all operations were written."""
+        with self.lock:  # buffered documents stay findable until written
+            errors = []
+            collections = set(self.inserts) | set(self.updates)
+            for collection in sorted(collections, key=lambda c: FLUSH_ORDER.index(c) if c in FLUSH_ORDER else len(FLUSH_ORDER)):
+                updates = []
+                if collection in self.inserts:
+                    merges, insert_errors = self.write_inserts(collection, [self.replace_ids(document) for document in self.inserts[collection]])
+                    updates += [(query, update, upsert) for _, query, update, upsert in merges]
+                    errors += [(collection, error) for error in insert_errors]
+                updates += self.updates.get(collection, [])
+                if updates:
+                    operations = [UpdateOne(self.replace_ids(query), self.replace_ids(update), upsert=upsert) for query, update, upsert in updates]
+                    errors += [(collection, error) for error in self.write(collection, operations)[1]]
+            for collection in collections:
+                collection_errors = [error for c, error in errors if c == collection]
+                if collection_errors:
+                    logger.error('Bulk write to %s failed for %d operations: %s', collection, len(collection_errors), collection_errors[:1])
+            self.inserts = {}
+            self.updates = {}
+            self.documents = {}
+            self.count = 0
+            self.flushed_at = time.monotonic()
+            if self.on_flush:
+                self.on_flush(not errors)
+
+
+class MongoPipeline:
+
+    def __init__(self, mongo_uri: str, mongo_db: str, bulk_write: bool = False, bulk_size: int = 1000, bulk_interval: float = 10.0,
+                 upserts: bool = False, create_indexes: bool = True, reconcile_counts: bool = False):
         """Initializes FanFiction pipeline.
 
         :param mongo_uri: str
             Uri to MongoDB database
         :param mongo_db: str
             Name of MongoDB database
+        :param bulk_write: bool
+            Whether write operations are buffered and written in batches
+        :param bulk_size: int
+            Number of buffered operations triggering a batch write
+        :param bulk_interval: float
+            Seconds after which buffered operations are written
+        :param upserts: bool
+            Whether users, stories and chapters are saved with a single upsert instead of find and write.
+            Reviews are always found and written: they have no unique key, anonymous ones not even a user,
+            so concurrent upserts could not be kept from creating duplicates. Ignored in bulk mode.
+        :param create_indexes: bool
+            Whether the indexes used for lookups are ensured when opening the spider
+        :param reconcile_counts: bool
+            Whether the counters of stories touched by the crawl are recounted when closing the spider
         """
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.bulk_write = bulk_write
+        self.bulk_size = bulk_size
+        self.bulk_interval = bulk_interval
+        self.upserts = upserts and not bulk_write
+        self.create_indexes = create_indexes
+        self.reconcile_counts = reconcile_counts
+        self.counted_stories = set()
         self.db = None
         self.client = None
+        self.lookups = None
+        self.writer = None
+        self.spider = None
+        self.latencies = LatencyRecorder()
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(
+        pipeline = cls(
             mongo_uri=crawler.settings.get('MONGO_URI'),
-            mongo_db=crawler.settings.get('MONGO_DB', 'items')
+            mongo_db=crawler.settings.get('MONGO_DB', 'items'),
+            bulk_write=crawler.settings.getbool('PIPELINE_BULK_WRITE'),
+            bulk_size=crawler.settings.getint('PIPELINE_BULK_SIZE', 1000),
+            bulk_interval=crawler.settings.getfloat('PIPELINE_BULK_INTERVAL', 10.0),
+            upserts=crawler.settings.getbool('PIPELINE_UPSERTS'),
+            create_indexes=crawler.settings.getbool('PIPELINE_CREATE_INDEXES', True),
+            reconcile_counts=crawler.settings.getbool('PIPELINE_RECONCILE_COUNTS')
         )
+        crawler.signals.connect(pipeline.flush, signal=signals.spider_idle)
+        return pipeline
 
-    def open_spider(self, _spider):
-        """Connects to MongoDB and drops all existing collections containing dynamic data.
+    def open_spider(self, spider):
+        """Connects to MongoDB, ensures its indexes and preloads the lookup collections.
 
-        :param _spider: Any
+        :param spider: Any
         """
+        self.spider = spider
         self.client = pymongo.MongoClient(self.mongo_uri)
         self.db = self.client[self.mongo_db]
+        if self.create_indexes:
+            ensure_indexes(self.db)
+        self.lookups = LookupCache(self.db, LOOKUP_COLLECTIONS)
+        self.lookups.load()
+        if self.bulk_write:
+            self.writer = BulkWriter(self.db, self.bulk_size, self.bulk_interval, self.latencies, self.flushed)
 
     def close_spider(self, _spider):
-        """Disconnects from MongoDB when done with current spider.
+        """Writes buffered operations, reconciles counters and disconnects from MongoDB when done with current spider.
 
         :param _spider: Any
         """
+        self.flush()
+        if self.reconcile_counts:
+            self.reconcile()
         self.client.close()
 
+    def flush(self) -> None:
+        """Writes buffered operations in bulk mode."""
+        if self.writer:
+            self.writer.flush()
+        else:
+            self.flushed(True)
+
+    def flushed(self, written: bool) -> None:
+        """Lets the spider know that all items processed so far are written by calling its items_flushed method if present,
+        e.g. to mark the sources of those items as done. Called from the thread writing the items.
+
+        :param written: bool
+            False if any operation of the flush failed
+        """
+        handler = getattr(self.spider, 'items_flushed', None)
+        if handler:
+            handler(written)
+
+    def find_one(self, collection: str, query: dict) -> Union[dict, None]:
+        """Finds document matching the query while considering documents buffered in bulk mode.
+
+        :param collection: str
+        :param query: dict
+        :return: dict or None
+        """
+        if self.writer:
+            document = self.writer.pending(collection, query)
+            if document is not None:
+                return document
+        with self.latencies.measure('find_one', collection):
+            return self.db[collection].find_one(query)
+
+    @staticmethod
+    def changes(document: dict, merged: dict) -> dict:
+        """Returns the fields of the merged document which differ from the found one. Setting only those keeps
+        updates written since the document was read, e.g. still buffered in bulk mode, from being undone.
+
+        :param document: dict
+            as found
+        :param merged: dict
+            as merged with the item
+        :return: dict
+        """
+        return {k: v for k, v in merged.items() if k not in document or document[k] != v}
+
+    @staticmethod
+    def add_url_fields(collection: str, fields: dict) -> None:
+        """Adds urlHost and urlKind to the fields if they contain the url of a document.
+
+        :param collection: str
+        :param fields: dict
+        """
+        if collection in URL_COLLECTIONS and fields.get('url'):
+            fields.update(url_fields(fields['url']))
+
+    def insert(self, collection: str, document: dict) -> ObjectId:
+        """Inserts document or buffers its insert in bulk mode.
+
+        :param collection: str
+        :param document: dict
+        :return: id of the inserted document
+        """
+        self.add_url_fields(collection, document)
+        if self.writer:
+            return self.writer.insert(collection, document)
+        with self.latencies.measure('insert_one', collection):
+            return self.db[collection].insert_one(document).inserted_id
+
+    def update(self, collection: str, query: dict, update: dict) -> None:
+        """Updates document matching the query or buffers the update in bulk mode.
+
+        :param collection: str
+        :param query: dict
+        :param update: dict
+            containing update operators
+        """
+        if '$set' in update:
+            self.add_url_fields(collection, update['$set'])
+        if self.writer:
+            self.writer.update(collection, query, update)
+        else:
+            with self.latencies.measure('update_one', collection):
+                self.db[collection].update_one(query, update)
+
+    def increment(self, story_id: ObjectId, counter: str, fields: dict = None) -> None:
+        """Increments counter of the story for an inserted chapter or review without reading the story or counting.
+
+        :param story_id: ObjectId
+        :param counter: str
+            currentChapterCount or currentReviewCount
+        :param fields: dict
+            additional fields to be set
+        """
+        update = {'$inc': {counter: 1}}
+        if fields:
+            update['$set'] = fields
+        self.update('stories', {'_id': story_id}, update)
+        if self.reconcile_counts:
+            self.counted_stories.add(story_id)
+
+    def reconcile(self, chunk_size: int = 1000) -> None:
+        """Recounts chapters and top-level reviews of all stories whose counters were incremented
+        and overwrites the counters, e.g. to repair increments lost by an interrupted crawl.
+
+        :param chunk_size: int
+            Number of stories recounted per aggregation
+        """
+        story_ids = list(self.counted_stories)
+        for i in range(0, len(story_ids), chunk_size):
+            chunk = story_ids[i:i + chunk_size]
+            chapter_counts = {story_id: 0 for story_id in chunk}
+            review_counts = {story_id: 0 for story_id in chunk}
+            reviewables = {story_id: story_id for story_id in chunk}
+            for group in self.db['chapters'].aggregate([
+                {'$match': {'storyId': {'$in': chunk}}},
+                {'$group': {'_id': '$storyId', 'count': {'$sum': 1}, 'chapterIds': {'$push': '$_id'}}}
+            ]):
+                chapter_counts[group['_id']] = group['count']
+                reviewables.update({chapter_id: group['_id'] for chapter_id in group['chapterIds']})
+            for group in self.db['reviews'].aggregate([
+                {'$match': {'reviewableId': {'$in': list(reviewables)}, 'parentId': None}},
+                {'$group': {'_id': '$reviewableId', 'count': {'$sum': 1}}}
+            ]):
+                review_counts[reviewables[group['_id']]] += group['count']
+            self.db['stories'].bulk_write([
+                UpdateOne({'_id': story_id}, {'$set': {'currentChapterCount': chapter_counts[story_id], 'currentReviewCount': review_counts[story_id]}})
+                for story_id in chunk
+            ], ordered=False)
+        logger.info('Reconciled counters of %d stories', len(story_ids))
+        self.counted_stories = set()
+
+    def upsert(self, collection: str, query: dict, document: dict, is_preliminary: bool = False, defaults: dict = None) -> Tuple[ObjectId, bool]:
+        """Creates or updates the document matching the query in a single round trip.
+        Preliminary documents only set their fields if the document is created. Like merge_dict, empty values
+        do not overwrite stored ones, they are only set if the document is created.
+
+        :param collection: str
+        :param query: dict
+        :param document: dict
+            fields to be set
+        :param is_preliminary: bool
+        :param defaults: dict
+            additional fields only set if the document is created
+        :return: id of the document and whether it was created
+        """
+        self.add_url_fields(collection, document)
+        now = datetime.now()
+        document_id = ObjectId()
+        on_insert = {'_id': document_id, 'createdAt': now, **(defaults or {})}
+        if is_preliminary:
+            update = {'$setOnInsert': {**document, 'updatedAt': now, **on_insert}}
+        else:
+            values = {k: v for k, v in document.items() if v is not None and v != '' and k not in query}
+            empty = {k: v for k, v in document.items() if k not in values and k not in query}
+            update = {'$set': {**values, 'updatedAt': now}, '$setOnInsert': {**empty, **on_insert}}
+        with self.latencies.measure('upsert', collection):
+            try:
+                before = self.db[collection].find_one_and_update(query, update, projection={'_id': True}, upsert=True)
+            except DuplicateKeyError:  # a concurrent upsert inserted the same key first
+                before = self.db[collection].find_one_and_update(query, update, projection={'_id': True}, upsert=True)
+        if before is None:
+            return document_id, True
+        return before['_id'], False
+
+    def link(self, collection: str, query: dict, document: dict) -> None:
+        """Inserts association document unless one matching the query exists.
+        In bulk mode an upsert is buffered instead of looking up the document.
+
+        :param collection: str
+        :param query: dict
+        :param document: dict
+        """
+        if self.writer:
+            self.writer.update(collection, query, {'$setOnInsert': {k: v for k, v in document.items() if k not in query}}, upsert=True)
+        elif self.find_one(collection, query) is None:
+            self.insert(collection, document)
+
+
+class FanfictionPipeline(MongoPipeline):
+
     def process_item(self, item: Union[User, Story, Chapter, Review], _spider: Spider) -> Union[None, str, ObjectId]:
         """Determines the type of item and calls its save function accordingly.
         Return value with e.g. a user ID cannot be used since function calls are asynchronous.
@@ -84,50 +696,38 @@ class FanfictionPipeline:
 
         # set story source
         if 'source' in item:
-            source = self.db['sources'].find_one({'name': item['source']})
-            if source:
-                item['sourceId'] = source['_id']
+            source_id = self.lookups.find_id('sources', item['source'])
+            if source_id:
+                item['sourceId'] = source_id
             del item['source']
 
         # set category
         if 'category' in item:
-            category = self.db['categories'].find_one({'$or': [{'name1': item['category']}, {'name2': item['category']}, {'name3': item['category']}]})
-            if category:
-                item['categoryId'] = category['_id']
-            else:
-                item['categoryId'] = self.db['categories'].insert_one({'name1': item['category'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+            item['categoryId'] = self.lookups.find_or_insert('categories', item['category'], {'name1': item['category'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['category']
 
         # set genre
         if 'genre' in item:
-            genre = self.db['genres'].find_one({'$or': [{'name1': item['genre']}, {'name2': item['genre']}, {'name3': item['genre']}]})
-            if genre:
-                item['genreId'] = genre['_id']
-            else:
-                item['genreId'] = self.db['genres'].insert_one({'name1': item['genre'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+            item['genreId'] = self.lookups.find_or_insert('genres', item['genre'], {'name1': item['genre'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['genre']
 
         # set rating
         if 'rating' in item:
-            rating = self.db['ratings'].find_one({'$or': [{'name1': item['rating']}, {'name2': item['rating']}, {'name3': item['rating']}]})
-            if rating:
-                item['ratingId'] = rating['_id']
+            rating_id = self.lookups.find_id('ratings', item['rating'])
+            if rating_id:
+                item['ratingId'] = rating_id
             else:
-                item['ratingId'] = self.db['ratings'].insert_one({'name1': item['rating'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+                item['ratingId'] = self.lookups.find_or_insert('ratings', item['rating'], {'name1': item['rating'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
                 del item['rating']
 
         # set pairing
         if 'pairing' in item:
-            pairing = self.db['pairings'].find_one({'$or': [{'name1': item['pairing']}, {'name2': item['pairing']}, {'name3': item['pairing']}]})
-            if pairing:
-                item['pairingId'] = pairing['_id']
-            else:
-                item['pairingId'] = self.db['pairings'].insert_one({'name1': item['pairing'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+            item['pairingId'] = self.lookups.find_or_insert('pairings', item['pairing'], {'name1': item['pairing'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['pairing']
 
         # search for existing user and set authorId if found or create a rudimentary user
         if 'authorUrl' in item:
-            user = self.db['users'].find_one({'url': item['authorUrl']})
+            user = self.find_one('users', {'url': item['authorUrl']})
             if user:
                 item['authorId'] = user['_id']
             else:
@@ -149,23 +749,29 @@ class FanfictionPipeline:
                 story_item['follows'] = str_to_int(story_item['follows'])
             if 'hits' in story_item and story_item['hits']:
                 story_item['hits'] = str_to_int(story_item['hits'])
-            # check if story already exists
-            story = None
-            if 'iid' in story_item:
-                story = self.db['stories'].find_one({'iid': story_item['iid']})
-            if not story:
-                story = self.db['stories'].find_one({'url': story_item['url']})
-            if story:  # merge and update story
-                story_item['updatedAt'] = datetime.now()
-                updated_story = merge_dict(story, story_item)
-                self.db['stories'].update_one({'_id': story['_id']}, {'$set': updated_story})
-                story_id = story['_id']
-            else:  # create new story
-                story_item['createdAt'] = datetime.now()
-                story_item['updatedAt'] = datetime.now()
-                story_item['currentChapterCount'] = 0
-                story_item['currentReviewCount'] = 0
-                story_id = self.db['stories'].insert_one(story_item).inserted_id
+            if self.upserts:  # match by iid or url as the lookups below
+                query = {'$or': [{'iid': story_item['iid']}, {'url': story_item['url']}]} if 'iid' in story_item else {'url': story_item['url']}
+                story_id = self.upsert('stories', query, story_item, is_preliminary, {'currentChapterCount': 0, 'currentReviewCount': 0})[0]
+            else:
+                # check if story already exists
+                story = None
+                if 'iid' in story_item:
+                    story = self.find_one('stories', {'iid': story_item['iid']})
+                if not story:
+                    story = self.find_one('stories', {'url': story_item['url']})
+                if story:  # merge and update story
+                    story_item['updatedAt'] = datetime.now()
+                    updated_story = merge_dict(story, story_item)
+                    for field in ('_id', 'currentChapterCount', 'currentReviewCount'):  # counters are only changed by increment, the read may be stale
+                        updated_story.pop(field, None)
+                    self.update('stories', {'_id': story['_id']}, {'$set': self.changes(story, updated_story)})
+                    story_id = story['_id']
+                else:  # create new story
+                    story_item['createdAt'] = datetime.now()
+                    story_item['updatedAt'] = datetime.now()
+                    story_item['currentChapterCount'] = 0
+                    story_item['currentReviewCount'] = 0
+                    story_id = self.insert('stories', story_item)
         else:
             return None
 
@@ -183,15 +789,9 @@ class FanfictionPipeline:
             else:
                 fandoms = item['fandoms'].split(', ')
             for f in fandoms:
-                fandom = self.db['fandoms'].find_one({'$or': [{'name1': f}, {'name2': f}, {'name3': f}]})
-                if fandom:
-                    fandom_id = fandom['_id']
-                else:
-                    fandom_id = self.db['fandoms'].insert_one({'name1': f, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
-                # check if fandom already exists for story
-                story_fandom = self.db['story_fandoms'].find_one({'storyId': story_id, 'fandomId': fandom_id})
-                if story_fandom is None:
-                    self.db['story_fandoms'].insert_one({'storyId': story_id, 'fandomId': fandom_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                fandom_id = self.lookups.find_or_insert('fandoms', f, {'name1': f, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                # link fandom to story unless already linked
+                self.link('story_fandoms', {'storyId': story_id, 'fandomId': fandom_id}, {'storyId': story_id, 'fandomId': fandom_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['fandoms']
 
         # set topics for story
@@ -201,15 +801,9 @@ class FanfictionPipeline:
             else:
                 topics = item['topics'].split(', ')
             for t in topics:
-                topic = self.db['topics'].find_one({'$or': [{'name1': t}, {'name2': t}, {'name3': t}]})
-                if topic:
-                    topic_id = topic['_id']
-                else:
-                    topic_id = self.db['topics'].insert_one({'name1': t}).inserted_id
-                # check if topic already exists for story
-                story_topic = self.db['story_topics'].find_one({'storyId': story_id, 'topicId': topic_id})
-                if story_topic is None:
-                    self.db['story_topics'].insert_one({'storyId': story_id, 'topicId': topic_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                topic_id = self.lookups.find_or_insert('topics', t, {'name1': t})
+                # link topic to story unless already linked
+                self.link('story_topics', {'storyId': story_id, 'topicId': topic_id}, {'storyId': story_id, 'topicId': topic_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['topics']
 
         # set characters for story
@@ -219,69 +813,45 @@ class FanfictionPipeline:
             else:
                 characters = item['characters'].split(', ')
             for c in characters:
-                character = self.db['characters'].find_one({'fandomId': fandom_id, '$or': [{'name1': c}, {'name2': c}, {'name3': c}]})
-                if character:
-                    character_id = character['_id']
-                else:
-                    character_id = self.db['characters'].insert_one({'fandomId': fandom_id, 'name1': c, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
-                # check if character already exists for story
-                story_character = self.db['story_characters'].find_one({'storyId': story_id, 'characterId': character_id})
-                if story_character is None:
-                    self.db['story_characters'].insert_one({'storyId': story_id, 'characterId': character_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                character_id = self.lookups.find_or_insert('characters', c, {'fandomId': fandom_id, 'name1': c, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                # link character to story unless already linked
+                self.link('story_characters', {'storyId': story_id, 'characterId': character_id}, {'storyId': story_id, 'characterId': character_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['characters']
 
         # set ratings for story
         if 'ratings' in item:
             for r in item['ratings']:
-                rating = self.db['ratings'].find_one({'$or': [{'name1': r}, {'name2': r}, {'name3': r}]})
-                if rating:
-                    rating_id = rating['_id']
-                else:
-                    rating_id = self.db['ratings'].insert_one({'name1': r, 'name2': None, 'name3': None}).inserted_id
-                # check if rating already exists for story
-                story_rating = self.db['story_ratings'].find_one({'storyId': story_id, 'ratingId': rating_id})
-                if story_rating is None:
-                    self.db['story_ratings'].insert_one({'storyId': story_id, 'ratingId': rating_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                rating_id = self.lookups.find_or_insert('ratings', r, {'name1': r, 'name2': None, 'name3': None})
+                # link rating to story unless already linked
+                self.link('story_ratings', {'storyId': story_id, 'ratingId': rating_id}, {'storyId': story_id, 'ratingId': rating_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['ratings']
 
         # set pairings for story
         if 'pairings' in item:
             for p in item['pairings']:
-                pairing = self.db['pairings'].find_one({'$or': [{'name1': p}, {'name2': p}, {'name3': p}]})
-                if pairing:
-                    pairing_id = pairing['_id']
-                else:
-                    pairing_id = self.db['pairings'].insert_one({'name1': p, 'name2': None, 'name3': None}).inserted_id
-                # check if pairing already exists for story
-                story_pairing = self.db['story_pairings'].find_one({'storyId': story_id, 'pairingId': pairing_id})
-                if story_pairing is None:
-                    self.db['story_pairings'].insert_one({'storyId': story_id, 'pairingId': pairing_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                pairing_id = self.lookups.find_or_insert('pairings', p, {'name1': p, 'name2': None, 'name3': None})
+                # link pairing to story unless already linked
+                self.link('story_pairings', {'storyId': story_id, 'pairingId': pairing_id}, {'storyId': story_id, 'pairingId': pairing_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['pairings']
 
         # set tags for story
         if 'tags' in item:
             for t in item['tags']:
                 # check if tag is a category
-                category = self.db['categories'].find_one({'$or': [{'name1': t}, {'name2': t}]})
-                if category:
-                    self.db['stories'].update_one({'_id': story_id}, {'$set': {'categoryId': category['_id']}})
+                category_id = self.lookups.find_id('categories', t)
+                if category_id:
+                    self.update('stories', {'_id': story_id}, {'$set': {'categoryId': category_id}})
                     continue
 
                 # check if tag is a topic
-                topic = self.db['topics'].find_one({'$or': [{'name1': t}, {'name2': t}, {'name3': t}]})
-                if topic:
-                    self.db['story_topics'].insert_one({'storyId': story_id, 'topicId': topic['_id'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                topic_id = self.lookups.find_id('topics', t)
+                if topic_id:
+                    self.link('story_topics', {'storyId': story_id, 'topicId': topic_id}, {'storyId': story_id, 'topicId': topic_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
                     continue
 
-                tag = self.db['tags'].find_one({'$or': [{'name1': t}, {'name2': t}, {'name3': t}]})
-                if tag:
-                    tag_id = tag['_id']
-                else:
-                    tag_id = self.db['tags'].insert_one({'name1': t, 'name2': None, 'name3': None}).inserted_id
-                # check if tag already exists for story
-                story_tag = self.db['story_tags'].find_one({'storyId': story_id, 'tagId': tag_id})
-                if story_tag is None:
-                    self.db['story_tags'].insert_one({'storyId': story_id, 'tagId': tag_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                tag_id = self.lookups.find_or_insert('tags', t, {'name1': t, 'name2': None, 'name3': None})
+                # link tag to story unless already linked
+                self.link('story_tags', {'storyId': story_id, 'tagId': tag_id}, {'storyId': story_id, 'tagId': tag_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['tags']
 
         return story_id
@@ -298,7 +868,7 @@ class FanfictionPipeline:
 
         if 'storyUrl' in item:
             # check if story already exists
-            story = self.db['stories'].find_one({'url': item['storyUrl']})
+            story = self.find_one('stories', {'url': item['storyUrl']})
             if story:
                 item['storyId'] = story['_id']
             else:
@@ -308,23 +878,29 @@ class FanfictionPipeline:
         if 'url' in item:
             if 'number' in item and item['number']:
                 item['number'] = str_to_int(item['number'])
+            if self.upserts:
+                if 'content' in item:
+                    item['hasMissingContent'] = False
+                chapter_id, created = self.upsert('chapters', {'url': item['url']}, item, is_preliminary)
+                if created and 'storyId' in item:
+                    self.increment(item['storyId'], 'currentChapterCount', {'hasMissingChapters': False})
+                return chapter_id
             # check if chapter already exists
-            chapter = self.db['chapters'].find_one({'url': item['url']})
+            chapter = self.find_one('chapters', {'url': item['url']})
             if chapter:  # merge and update chapter
                 item['updatedAt'] = datetime.now()
                 updated_chapter = merge_dict(chapter, item)
                 if 'content' in updated_chapter:
                     updated_chapter['hasMissingContent'] = False
-                self.db['chapters'].update_one({'_id': chapter['_id']}, {'$set': updated_chapter})
+                self.update('chapters', {'_id': chapter['_id']}, {'$set': self.changes(chapter, updated_chapter)})
                 return chapter['_id']
             else:  # create new chapter
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                # set current chapter count
+                # increment current chapter count
                 if 'storyId' in item:
-                    current_chapter_count = self.db['chapters'].count_documents({'storyId': item['storyId']})
-                    self.db['stories'].update_one({'_id': item['storyId']}, {'$set': {'currentChapterCount': current_chapter_count + 1, 'hasMissingChapters': False}})
-                return self.db['chapters'].insert_one(item).inserted_id
+                    self.increment(item['storyId'], 'currentChapterCount', {'hasMissingChapters': False})
+                return self.insert('chapters', item)
         return None
 
     def process_user(self, item: User, is_preliminary: bool = False) -> Union[str, None]:
@@ -340,26 +916,28 @@ class FanfictionPipeline:
 
         # set user source
         if 'source' in item:
-            source = self.db['sources'].find_one({'name': item['source']})
-            if source:
-                item['sourceId'] = source['_id']
+            source_id = self.lookups.find_id('sources', item['source'])
+            if source_id:
+                item['sourceId'] = source_id
             del item['source']
 
         if 'age' in item:
             item['age'] = str_to_int(item['age'])
 
         if 'url' in item:
+            if self.upserts:
+                return self.upsert('users', {'url': item['url']}, item, is_preliminary)[0]
             # check if user already exists
-            user = self.db['users'].find_one({'url': item['url']})
+            user = self.find_one('users', {'url': item['url']})
             if user:
                 item['updatedAt'] = datetime.now()
                 updated_user = merge_dict(user, item)
-                self.db['users'].update_one({'_id': user['_id']}, {'$set': updated_user})
+                self.update('users', {'_id': user['_id']}, {'$set': self.changes(user, updated_user)})
                 return user['_id']
             else:
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                return self.db['users'].insert_one(item).inserted_id
+                return self.insert('users', item)
         return None
 
     def process_review(self, item: Review) -> Union[str, None]:
@@ -385,7 +963,7 @@ class FanfictionPipeline:
 
         if 'userUrl' in item:
             # check if review user already exists
-            user = self.db['users'].find_one({'url': item['userUrl']})
+            user = self.find_one('users', {'url': item['userUrl']})
             if user:
                 item['userId'] = user['_id']
             else:
@@ -400,18 +978,18 @@ class FanfictionPipeline:
             if item['reviewableType'] == 'Chapter':
                 # check if chapter already exists
                 if 'reviewableUrl' in item:
-                    chapter = self.db['chapters'].find_one({'url': item['reviewableUrl']})
+                    chapter = self.find_one('chapters', {'url': item['reviewableUrl']})
                 elif 'chapterNumber' in item and 'storyUrl' in item:
-                    story = self.db['stories'].find_one({'url': item['storyUrl']})
+                    story = self.find_one('stories', {'url': item['storyUrl']})
                     if story:
-                        chapter = self.db['chapters'].find_one({'storyId': story['_id'], 'number': item['chapterNumber']})
+                        chapter = self.find_one('chapters', {'storyId': story['_id'], 'number': item['chapterNumber']})
                 if chapter:
                     item['reviewableId'] = chapter['_id']
                 elif 'reviewableUrl' in item:
                     item['reviewableId'] = self.process_chapter(Chapter({'url': item['reviewableUrl']}), True)
             if item['reviewableType'] == 'Story' and 'reviewableUrl' in item:
                 # check if story already exists
-                story = self.db['stories'].find_one({'url': item['reviewableUrl']})
+                story = self.find_one('stories', {'url': item['reviewableUrl']})
                 if story:
                     item['reviewableId'] = story['_id']
                 else:
@@ -421,77 +999,40 @@ class FanfictionPipeline:
         else:
             return None
 
-        # get story document except for reply reviews
-        story = None
+        # get story id except for reply reviews
+        story_id = None
         if item['parentId'] is None:
             if item['reviewableType'] == 'Chapter':
-                chapter = self.db['chapters'].find_one({'_id': item['reviewableId']})
+                chapter = self.find_one('chapters', {'_id': item['reviewableId']})
                 if chapter and 'storyId' in chapter:
-                    story = self.db['stories'].find_one({'_id': chapter['storyId']})
+                    story_id = chapter['storyId']
             elif item['reviewableType'] == 'Story':
-                story = self.db['stories'].find_one({'_id': item['reviewableId']})
+                story_id = item['reviewableId']
 
         if 'reviewedAt' in item:
             # check if review already exists
             if item['userId']:
-                review = self.db['reviews'].find_one({'userId': item['userId'], 'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
+                review = self.find_one('reviews', {'userId': item['userId'], 'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
             else:  # anonymous user
-                review = self.db['reviews'].find_one({'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
+                review = self.find_one('reviews', {'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
             if review:
                 item['updatedAt'] = datetime.now()
                 updated_review = merge_dict(review, item)
-                self.db['reviews'].update_one({'_id': review['_id']}, {'$set': updated_review})
+                self.update('reviews', {'_id': review['_id']}, {'$set': self.changes(review, updated_review)})
                 return review['_id']
             else:
-                if not story and chapter:
-                    story = self.db['stories'].find_one({'_id': chapter['storyId']})
-                if story:
-                    if 'currentReviewCount' not in story:
-                        story['currentReviewCount'] = 0
-                    self.db['stories'].update_one({'_id': story['_id']}, {'$set': {'currentReviewCount': story['currentReviewCount'] + 1}})
+                if not story_id and chapter and item['parentId'] is None:  # replies are not counted, as in reconcile
+                    story_id = chapter.get('storyId')
+                if story_id:
+                    self.increment(story_id, 'currentReviewCount')
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                return self.db['reviews'].insert_one(item).inserted_id
+                return self.insert('reviews', item)
         else:
             return None
 
 
-class FanfictionHtmlPipeline:
-
-    def __init__(self, mongo_uri: str, mongo_db: str):
-        """Initializes FanFiction pipeline.
-
-        :param mongo_uri: str
-            Uri to MongoDB database
-        :param mongo_db: str
-            Name of MongoDB database
-        """
-        self.mongo_uri = mongo_uri
-        self.mongo_db = mongo_db
-        self.db = None
-        self.client = None
-
-    @classmethod
-    def from_crawler(cls, crawler):
-        return cls(
-            mongo_uri=crawler.settings.get('MONGO_URI'),
-            mongo_db=crawler.settings.get('MONGO_DB', 'items')
-        )
-
-    def open_spider(self, _spider):
-        """Connects to MongoDB and drops all existing collections containing dynamic data.
-
-        :param _spider: Any
-        """
-        self.client = pymongo.MongoClient(self.mongo_uri)
-        self.db = self.client[self.mongo_db]
-
-    def close_spider(self, _spider):
-        """Disconnects from MongoDB when done with current spider.
-
-        :param _spider: Any
-        """
-        self.client.close()
+class FanfictionHtmlPipeline(MongoPipeline):
 
     def process_item(self, item: Union[User, Story, Chapter], _spider):
         """Determines the type of item and calls its save function accordingly.
@@ -526,27 +1067,19 @@ class FanfictionHtmlPipeline:
 
         # set story source
         if 'source' in item:
-            source = self.db['sources'].find_one({'name': item['source']})
-            if source:
-                item['sourceId'] = source['_id']
+            source_id = self.lookups.find_id('sources', item['source'])
+            if source_id:
+                item['sourceId'] = source_id
             del item['source']
 
         # set category
         if 'category' in item:
-            category = self.db['categories'].find_one({'$or': [{'name1': item['category']}, {'name2': item['category']}, {'name3': item['category']}]})
-            if category:
-                item['categoryId'] = category['_id']
-            else:
-                item['categoryId'] = self.db['categories'].insert_one({'name1': item['category'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+            item['categoryId'] = self.lookups.find_or_insert('categories', item['category'], {'name1': item['category'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['category']
 
         # set genre
         if 'genre' in item:
-            genre = self.db['genres'].find_one({'$or': [{'name1': item['genre']}, {'name2': item['genre']}, {'name3': item['genre']}]})
-            if genre:
-                item['genreId'] = genre['_id']
-            else:
-                item['genreId'] = self.db['genres'].insert_one({'name1': item['genre'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+            item['genreId'] = self.lookups.find_or_insert('genres', item['genre'], {'name1': item['genre'], 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['genre']
 
         # set ratings
@@ -559,11 +1092,7 @@ class FanfictionHtmlPipeline:
             del item['rating']
         if 'ratings' in item:
             for rating_item in item['ratings']:
-                rating = self.db['ratings'].find_one({'$or': [{'name1': rating_item}, {'name2': rating_item}, {'name3': rating_item}]})
-                if rating:
-                    rating_id = rating['_id']
-                else:
-                    rating_id = self.db['ratings'].insert_one({'name1': rating_item, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+                rating_id = self.lookups.find_or_insert('ratings', rating_item, {'name1': rating_item, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
                 rating_ids.append(rating_id)
                 del item['ratings']
 
@@ -577,17 +1106,13 @@ class FanfictionHtmlPipeline:
             del item['pairing']
         if 'pairings' in item:
             for pairing_item in item['pairings']:
-                pairing = self.db['pairings'].find_one({'$or': [{'name1': pairing_item}, {'name2': pairing_item}, {'name3': pairing_item}]})
-                if pairing:
-                    pairing_id = pairing['_id']
-                else:
-                    pairing_id = self.db['pairings'].insert_one({'name1': pairing_item, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
+                pairing_id = self.lookups.find_or_insert('pairings', pairing_item, {'name1': pairing_item, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
                 pairing_ids.append(pairing_id)
                 del item['pairings']
 
         # search for existing user and set authorId if found or create a rudimentary user
         if 'authorUrl' in item:
-            user = self.db['users'].find_one({'url': item['authorUrl']})
+            user = self.find_one('users', {'url': item['authorUrl']})
             if user:
                 item['authorId'] = user['_id']
             else:
@@ -609,19 +1134,24 @@ class FanfictionHtmlPipeline:
                 story_item['follows'] = str_to_int(story_item['follows'])
             if 'hits' in story_item and story_item['hits']:
                 story_item['hits'] = str_to_int(story_item['hits'])
-            # check if story already exists
-            story = self.db['stories'].find_one({'url': story_item['url']})
-            if story:  # merge and update story
-                story_item['updatedAt'] = datetime.now()
-                updated_story = merge_dict(story, story_item)
-                self.db['stories'].update_one({'_id': story['_id']}, {'$set': updated_story})
-                story_id = story['_id']
-            else:  # create new story
-                story_item['createdAt'] = datetime.now()
-                story_item['updatedAt'] = datetime.now()
-                story_item['currentChapterCount'] = 0
-                story_item['currentReviewCount'] = 0
-                story_id = self.db['stories'].insert_one(story_item).inserted_id
+            if self.upserts:
+                story_id = self.upsert('stories', {'url': story_item['url']}, story_item, is_preliminary, {'currentChapterCount': 0, 'currentReviewCount': 0})[0]
+            else:
+                # check if story already exists
+                story = self.find_one('stories', {'url': story_item['url']})
+                if story:  # merge and update story
+                    story_item['updatedAt'] = datetime.now()
+                    updated_story = merge_dict(story, story_item)
+                    for field in ('_id', 'currentChapterCount', 'currentReviewCount'):  # counters are only changed by increment, the read may be stale
+                        updated_story.pop(field, None)
+                    self.update('stories', {'_id': story['_id']}, {'$set': self.changes(story, updated_story)})
+                    story_id = story['_id']
+                else:  # create new story
+                    story_item['createdAt'] = datetime.now()
+                    story_item['updatedAt'] = datetime.now()
+                    story_item['currentChapterCount'] = 0
+                    story_item['currentReviewCount'] = 0
+                    story_id = self.insert('stories', story_item)
         else:
             return None
 
@@ -635,45 +1165,27 @@ class FanfictionHtmlPipeline:
             del item['fandom']
         if 'fandoms' in item:
             for fandom_item in item['fandoms']:
-                fandom = self.db['fandoms'].find_one({'$or': [{'name1': fandom_item}, {'name2': fandom_item}, {'name3': fandom_item}]})
-                if fandom:
-                    fandom_id = fandom['_id']
-                else:
-                    fandom_id = self.db['fandoms'].insert_one({'name1': fandom_item, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
-                # check if fandom already exists for story
-                story_fandom = self.db['story_fandoms'].find_one({'storyId': story_id, 'fandomId': fandom_id})
-                if story_fandom is None:
-                    self.db['story_fandoms'].insert_one({'storyId': story_id, 'fandomId': fandom_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                fandom_id = self.lookups.find_or_insert('fandoms', fandom_item, {'name1': fandom_item, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                # link fandom to story unless already linked
+                self.link('story_fandoms', {'storyId': story_id, 'fandomId': fandom_id}, {'storyId': story_id, 'fandomId': fandom_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
                 fandom_ids.append(fandom_id)
             del item['fandoms']
 
         # set topics for story
         if 'topics' in item:
             for t in item['topics'].split(', '):
-                topic = self.db['topics'].find_one({'$or': [{'name1': t}, {'name2': t}, {'name3': t}]})
-                if topic:
-                    topic_id = topic['_id']
-                else:
-                    topic_id = self.db['topics'].insert_one({'name1': t}).inserted_id
-                # check if topic already exists for story
-                story_topic = self.db['story_topics'].find_one({'storyId': story_id, 'topicId': topic_id})
-                if story_topic is None:
-                    self.db['story_topics'].insert_one({'storyId': story_id, 'topicId': topic_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                topic_id = self.lookups.find_or_insert('topics', t, {'name1': t})
+                # link topic to story unless already linked
+                self.link('story_topics', {'storyId': story_id, 'topicId': topic_id}, {'storyId': story_id, 'topicId': topic_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['topics']
 
         # set characters for story
         if 'characters' in item:
             for character_item in item['characters']:
                 for fandom_id in fandom_ids:
-                    character = self.db['characters'].find_one({'fandomId': fandom_id, '$or': [{'name1': character_item}, {'name2': character_item}, {'name3': character_item}]})
-                    if character:
-                        character_id = character['_id']
-                    else:
-                        character_id = self.db['characters'].insert_one({'fandomId': fandom_id, 'name1': character_item, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()}).inserted_id
-                    # check if character already exists for story
-                    story_characters = self.db['story_characters'].find_one({'storyId': story_id, 'characterId': character_id})
-                    if story_characters is None:
-                        self.db['story_characters'].insert_one({'storyId': story_id, 'characterId': character_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                    character_id = self.lookups.find_or_insert('characters', character_item, {'fandomId': fandom_id, 'name1': character_item, 'name2': None, 'name3': None, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
+                    # link character to story unless already linked
+                    self.link('story_characters', {'storyId': story_id, 'characterId': character_id}, {'storyId': story_id, 'characterId': character_id, 'createdAt': datetime.now(), 'updatedAt': datetime.now()})
             del item['characters']
 
         return story_id
@@ -690,7 +1202,7 @@ class FanfictionHtmlPipeline:
 
         if 'storyUrl' in item:
             # check if story already exists
-            story = self.db['stories'].find_one({'url': item['storyUrl']})
+            story = self.find_one('stories', {'url': item['storyUrl']})
             if story:
                 item['storyId'] = story['_id']
             else:
@@ -700,21 +1212,25 @@ class FanfictionHtmlPipeline:
         if 'url' in item:
             if 'number' in item and item['number']:
                 item['number'] = str_to_int(item['number'])
+            if self.upserts:
+                chapter_id, created = self.upsert('chapters', {'url': item['url']}, item, is_preliminary)
+                if created and 'storyId' in item:
+                    self.increment(item['storyId'], 'currentChapterCount')
+                return chapter_id
             # check if chapter already exists
-            chapter = self.db['chapters'].find_one({'url': item['url']})
+            chapter = self.find_one('chapters', {'url': item['url']})
             if chapter:  # merge and update chapter
                 item['updatedAt'] = datetime.now()
                 updated_chapter = merge_dict(chapter, item)
-                self.db['chapters'].update_one({'_id': chapter['_id']}, {'$set': updated_chapter})
+                self.update('chapters', {'_id': chapter['_id']}, {'$set': self.changes(chapter, updated_chapter)})
                 return chapter['_id']
             else:  # create new chapter
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                # set current chapter count
+                # increment current chapter count
                 if 'storyId' in item:
-                    current_chapter_count = self.db['chapters'].count_documents({'storyId': item['storyId']})
-                    self.db['stories'].update_one({'_id': item['storyId']}, {'$set': {'currentChapterCount': current_chapter_count + 1}})
-                return self.db['chapters'].insert_one(item).inserted_id
+                    self.increment(item['storyId'], 'currentChapterCount')
+                return self.insert('chapters', item)
 
         return None
 
@@ -731,26 +1247,28 @@ class FanfictionHtmlPipeline:
 
         # set user source
         if 'source' in item:
-            source = self.db['sources'].find_one({'name': item['source']})
-            if source:
-                item['sourceId'] = source['_id']
+            source_id = self.lookups.find_id('sources', item['source'])
+            if source_id:
+                item['sourceId'] = source_id
             del item['source']
 
         if 'age' in item:
             item['age'] = str_to_int(item['age'])
 
         if 'url' in item:
+            if self.upserts:
+                return self.upsert('users', {'url': item['url']}, item, is_preliminary)[0]
             # check if user already exists
-            user = self.db['users'].find_one({'url': item['url']})
+            user = self.find_one('users', {'url': item['url']})
             if user:
                 item['updatedAt'] = datetime.now()
                 updated_user = merge_dict(user, item)
-                self.db['users'].update_one({'_id': user['_id']}, {'$set': updated_user})
+                self.update('users', {'_id': user['_id']}, {'$set': self.changes(user, updated_user)})
                 return user['_id']
             else:
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                return self.db['users'].insert_one(item).inserted_id
+                return self.insert('users', item)
 
     def process_review(self, item: Review) -> Union[str, None]:
         """Save Review object to the database.
@@ -775,7 +1293,7 @@ class FanfictionHtmlPipeline:
 
         if 'userUrl' in item:
             # check if review user already exists
-            user = self.db['users'].find_one({'url': item['userUrl']})
+            user = self.find_one('users', {'url': item['userUrl']})
             if user:
                 item['userId'] = user['_id']
             else:
@@ -788,14 +1306,14 @@ class FanfictionHtmlPipeline:
         if 'reviewableType' in item and 'reviewableUrl' in item:
             if item['reviewableType'] == 'Chapter':
                 # check if chapter already exists
-                chapter = self.db['chapters'].find_one({'url': item['reviewableUrl']})
+                chapter = self.find_one('chapters', {'url': item['reviewableUrl']})
                 if chapter:
                     item['reviewableId'] = chapter['_id']
                 else:
                     item['reviewableId'] = self.process_chapter(Chapter({'url': item['reviewableUrl']}), True)
             if item['reviewableType'] == 'Story':
                 # check if story already exists
-                story = self.db['stories'].find_one({'url': item['reviewableUrl']})
+                story = self.find_one('stories', {'url': item['reviewableUrl']})
                 if story:
                     item['reviewableId'] = story['_id']
                 else:
@@ -804,35 +1322,88 @@ class FanfictionHtmlPipeline:
         else:
             return None
 
-        # get story document except for reply reviews
-        story = None
+        # get story id except for reply reviews
+        story_id = None
         if item['parentId'] is None:
             if item['reviewableType'] == 'Chapter':
-                chapter = self.db['chapters'].find_one({'_id': item['reviewableId']})
+                chapter = self.find_one('chapters', {'_id': item['reviewableId']})
                 if chapter and 'storyId' in chapter:
-                    story = self.db['stories'].find_one({'_id': chapter['storyId']})
+                    story_id = chapter['storyId']
             elif item['reviewableType'] == 'Story':
-                story = self.db['stories'].find_one({'_id': item['reviewableId']})
+                story_id = item['reviewableId']
 
         if 'reviewedAt' in item:
             # check if review already exists
             if item['userId']:
-                review = self.db['reviews'].find_one({'userId': item['userId'], 'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
+                review = self.find_one('reviews', {'userId': item['userId'], 'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
             else:  # anonymous user
-                review = self.db['reviews'].find_one({'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
+                review = self.find_one('reviews', {'reviewedAt': item['reviewedAt'], 'reviewableType': item['reviewableType'], 'reviewableId': item['reviewableId']})
 
             if review:
                 item['updatedAt'] = datetime.now()
                 updated_review = merge_dict(review, item)
-                self.db['reviews'].update_one({'_id': review['_id']}, {'$set': updated_review})
+                self.update('reviews', {'_id': review['_id']}, {'$set': self.changes(review, updated_review)})
                 return review['_id']
             else:
-                if story:
-                    if 'currentReviewCount' not in story:
-                        story['currentReviewCount'] = 0
-                    self.db['stories'].update_one({'_id': story['_id']}, {'$set': {'currentReviewCount': story['currentReviewCount'] + 1}})
+                if story_id:
+                    self.increment(story_id, 'currentReviewCount')
                 item['createdAt'] = datetime.now()
                 item['updatedAt'] = datetime.now()
-                return self.db['reviews'].insert_one(item).inserted_id
+                return self.insert('reviews', item)
 
         return None
+
+
+class ThreadPoolPipeline:
+
+    def __init__(self, *args, **kwargs):
+        """Initializes pipeline which processes items in a thread pool instead of the reactor thread.
+        Needs to precede a MongoPipeline in the list of base classes.
+        """
+        super().__init__(*args, **kwargs)
+        self.concurrency = 1
+        self.pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super().from_crawler(crawler)
+        pipeline.concurrency = crawler.settings.getint('PIPELINE_CONCURRENCY', 1)
+        return pipeline
+
+    def open_spider(self, spider):
+        """Connects to MongoDB and starts the thread pool.
+
+        :param spider: Any
+        """
+        super().open_spider(spider)
+        self.pool = ThreadPool(minthreads=1, maxthreads=self.concurrency, name='MongoPipeline')
+        self.pool.start()
+
+    def close_spider(self, spider):
+        """Waits for all queued items before disconnecting from MongoDB.
+
+        :param spider: Any
+        """
+        self.pool.stop()
+        super().close_spider(spider)
+
+    def process_item(self, item: Union[User, Story, Chapter, Review], spider: Spider):
+        """Processes item in the thread pool so that its database round trips overlap with downloading and parsing.
+        More than one thread can create duplicates when items referencing the same url are processed at the same time
+        unless upserts are enabled and backed by the unique indexes.
+
+        :param item: The item object to process
+        :param spider: The currently processed spider
+        :return: Deferred firing with the item once it is saved
+        """
+        deferred = threads.deferToThreadPool(reactor, self.pool, super().process_item, item, spider)
+        deferred.addCallback(lambda _: item)
+        return deferred
+
+
+class AsyncFanfictionPipeline(ThreadPoolPipeline, FanfictionPipeline):
+    pass
+
+
+class AsyncFanfictionHtmlPipeline(ThreadPoolPipeline, FanfictionHtmlPipeline):
+    pass
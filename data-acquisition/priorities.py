@@ -0,0 +1,10 @@
+# Request priorities of the spiders. Scrapy downloads requests of higher priority first, so pages
+# leading to items (chapters, reviews, stories and users) are drained before further listing pages
+# are expanded. The scheduler queue therefore only grows with the listing pages crawled at once
+# instead of with every story found on them.
+
+LISTING = 0
+USER = 10
+STORY = 20
+REVIEWS = 30
+CHAPTER = 40
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+
+# -----------------------------------------------------------
+# Sets urlHost and urlKind of all users, stories, chapters
+# and reviews saved before the pipelines populated them and
+# indexes them, so that repair scripts and the Missing
+# spiders select documents by equality instead of scanning
+# the collections with regular expressions on their urls.
+# Documents are updated in batches in the order of their ids
+# and a restarted run skips those already updated.
+# -----------------------------------------------------------
+
+import os
+import sys
+from pymongo import ASCENDING, UpdateOne
+from pymongo.database import Database
+from utils.db_connect import DatabaseConnection
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # data-acquisition modules
+from urlfields import COLLECTIONS, url_fields
+
+DATABASE_NAME = 'FanFiction'
+BATCH_SIZE = 1000
+
+
+def backfill(database: Database, collection: str) -> int:
+    """Sets urlHost and urlKind of the documents of the collection missing them.
+
+    :param database: Database
+    :param collection: str
+    :return: number of updated documents
+    """
+    query = {'urlHost': {'$exists': False}, 'url': {'$type': 'string'}}
+    total = database[collection].count_documents(query)
+    print('Backfilling %i documents of %s.' % (total, collection))
+    count = 0
+    last_id = None
+    while True:
+        batch_query = dict(query, _id={'$gt': last_id}) if last_id else query
+        documents = list(database[collection].find(batch_query, {'url': 1}).sort('_id', ASCENDING).limit(BATCH_SIZE))
+        if not documents:
+            break
+        database[collection].bulk_write([UpdateOne({'_id': document['_id']}, {'$set': url_fields(document['url'])}) for document in documents], ordered=False)
+        count += len(documents)
+        last_id = documents[-1]['_id']
+        print('%s: %i/%i' % (collection, count, total))
+    database[collection].create_index([('urlHost', ASCENDING), ('urlKind', ASCENDING)])
+    return count
+
+
+if __name__ == "__main__":
+    client = DatabaseConnection()
+    try:
+        database = client.connect(DATABASE_NAME)
+        for collection in COLLECTIONS:
+            backfill(database, collection)
+        print('Done.')
+    finally:
+        client.disconnect()
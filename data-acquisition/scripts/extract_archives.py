@@ -4,13 +4,26 @@
 # Walks through specified directories containing
 # tar.gz-archives and extracts them while storing the file
 # and content information to the database.
+# Archives are processed in parallel by a pool of processes
+# with each one streaming the members of an archive directly
+# into its output folder. Alternatively archives are
+# converted into seekable page containers which the
+# FanFiktionHtmlExtract spider reads without extraction.
 # -----------------------------------------------------------
 
 import tarfile
 import os
 import shutil
+import sys
+from multiprocessing import Pool, cpu_count, freeze_support
+from pymongo import ASCENDING, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError, OperationFailure
 from utils.db_connect import DatabaseConnection
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # data-acquisition modules
+from archives import convert_archive
+
 INPUT_ARCHIVE_PATH_USERS = '/Users/jonathan/Documents/Studium/Master/Masterarbeit/data/html-users-20220222_books/'
 OUTPUT_PATH_USERS = '/Users/jonathan/Documents/Studium/Master/Masterarbeit/data/html-books-extracted-users/'
 
@@ -20,94 +33,155 @@ OUTPUT_PATH_STORIES = '/Users/jonathan/Documents/Studium/Master/Masterarbeit/dat
 INPUT_ARCHIVE_PATH_REVIEWS = '/Users/jonathan/Documents/Studium/Master/Masterarbeit/data/html-reviews-20220222_books/'
 OUTPUT_PATH_REVIEWS = '/Users/jonathan/Documents/Studium/Master/Masterarbeit/data/html-books-extracted-reviews/'
 
-client = DatabaseConnection()
-db = client.connect('FanfictionDB')
+DATABASE_NAME = 'FanfictionDB'
+PROCESS_COUNT = cpu_count()
+
+# convert archives into page containers instead of extracting their files
+CONVERT_ARCHIVES = False
+
+# database connection of a worker process
+db = None
+
+
+def user_row(filename: str, datestamp: str) -> dict:
+    parts = filename.split('.')
+    uid = parts[0]  # e.g.: -BabyDoll-.html
+    url = 'https://www.fanfiktion.de/u/' + uid
+    return {'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp}
+
+
+def story_row(filename: str, datestamp: str) -> dict:
+    parts = filename.split('_')  # e.g.: 4a298d450000e42606702328_4_Der-Alltag-eines-Genies.html
+    uid = parts[0]
+    chapter = parts[1]
+    title = parts[2].split('.')[0]
+    url = 'https://www.fanfiktion.de/s/' + uid + '/' + chapter + '/' + title
+    return {'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp, 'chapter': chapter, 'title': title}
+
 
-try:
-    # extract archives with user html pages and store in csv_users collection
+def reviews_row(filename: str, datestamp: str) -> dict:
+    parts = filename.split('_')  # e.g.: 4f36ea8000016c470670b798_date_0_4.html
+    uid = parts[0]
+    sorted_by = parts[1]
+    chapter = parts[2]
+    page = parts[3].split('.')[0]
+    url = 'https://www.fanfiktion.de/r/s/' + uid + '/' + sorted_by + '/' + chapter + '/' + page
+    return {'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp, 'page': page}
+
+
+# collection and row builder for each type of archive
+ARCHIVE_TYPES = {
+    'users': ('csv_users', user_row),
+    'stories': ('csv_stories', story_row),
+    'reviews': ('csv_reviews', reviews_row),
+}
+
+
+def find_archives() -> list:
+    """Collects all archives to be extracted with their output paths and datestamps.
+    Story and review archives are distributed into a new folder for every seventh file.
+
+    :return: list
+        of tuples (archive type, archive path, output path, datestamp)
+    """
+    tasks = []
     for root, dirs, archives in os.walk(INPUT_ARCHIVE_PATH_USERS):
         for archive in archives:
             filepath = os.path.join(root, archive)
             if archive.endswith("tar.gz"):
                 archive_name = os.path.basename(filepath)
                 datestamp = archive_name.split('_', 1)[0][0:10]
-                output_path = OUTPUT_PATH_USERS + datestamp + '/'
-                print('Extracting ' + filepath + ' to ' + output_path)
-                with tarfile.open(filepath, 'r:gz') as f:
-                    filenames = [name for name in f.getnames() if name.endswith('.html')]
-                    f.extractall(output_path)
-                    for filename in filenames:
-                        parts = filename.split('.')
-                        uid = parts[0]  # e.g.: -BabyDoll-.html
-                        url = 'https://www.fanfiktion.de/u/' + uid
-                        csv_user = db['csv_users'].find_one({'filename': filename})
-                        if not csv_user:
-                            db['csv_users'].insert_one({'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp})
-
-    # extract archives with story html pages and store in csv_stories collection
-    for root, dirs, archives in os.walk(INPUT_ARCHIVE_PATH_STORIES):
-        num = 0
-        idx = 0
-        for archive in archives:
-            idx += 1
-            if idx % 7 == 0:
-                num += 1
-            filepath = os.path.join(root, archive)
-            if archive.endswith("tar.gz"):
-                archive_name = os.path.basename(filepath)
-                datestamp = archive_name.split('_', 1)[0][0:8]
-                output_path = OUTPUT_PATH_STORIES + datestamp + str(num) + '/'
-                print('Extracting ' + filepath + ' to ' + output_path)
-                with tarfile.open(filepath, 'r:gz') as f:
-                    filenames = [name.replace('temp/', '') for name in f.getnames() if name.endswith('.html')]
-                    f.extractall(output_path)
-                    temp_files = os.listdir(output_path + 'temp/')
-                    for temp_file in temp_files:
-                        temp_file_name = os.path.join(output_path + 'temp/', temp_file)
-                        if not os.path.exists(output_path + temp_file):
-                            shutil.move(temp_file_name, output_path)
-                    for filename in filenames:
-                        parts = filename.split('_')  # e.g.: 4a298d450000e42606702328_4_Der-Alltag-eines-Genies.html
-                        uid = parts[0]
-                        chapter = parts[1]
-                        title = parts[2].split('.')[0]
-                        url = 'https://www.fanfiktion.de/s/' + uid + '/' + chapter + '/' + title
-                        csv_story = db['csv_stories'].find_one({'filename': filename})
-                        if not csv_story:
-                            db['csv_stories'].insert_one({'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp, 'chapter': chapter, 'title': title})
-
-    # extract archives with review html pages and store in csv_reviews collection
-    for root, dirs, archives in os.walk(INPUT_ARCHIVE_PATH_REVIEWS):
-        num = 0
-        idx = 0
-        for archive in archives:
-            idx += 1
-            if idx % 7 == 0:
-                num += 1
-            filepath = os.path.join(root, archive)
-            if archive.endswith("tar.gz"):
-                archive_name = os.path.basename(filepath)
-                datestamp = archive_name.split('_', 1)[0][0:8]
-                output_path = OUTPUT_PATH_REVIEWS + datestamp + str(num) + '/'
-                print('Extracting ' + filepath + ' to ' + output_path)
-                with tarfile.open(filepath, 'r:gz') as f:
-                    filenames = [name.replace('temp/', '') for name in f.getnames() if name.endswith('.html')]
-                    f.extractall(output_path)
-                    temp_files = os.listdir(output_path + 'temp/')
-                    for temp_file in temp_files:
-                        temp_file_name = os.path.join(output_path + 'temp/', temp_file)
-                        if not os.path.exists(output_path + temp_file):
-                            shutil.move(temp_file_name, output_path)
-                    for filename in filenames:
-                        parts = filename.split('_')  # e.g.: 4f36ea8000016c470670b798_date_0_4.html
-                        uid = parts[0]
-                        sorted_by = parts[1]
-                        chapter = parts[2]
-                        page = parts[3].split('.')[0]
-                        url = 'https://www.fanfiktion.de/r/s/' + uid + '/' + sorted_by + '/' + chapter + '/' + page
-                        csv_reviews = db['csv_reviews'].find_one({'filename': filename})
-                        if not csv_reviews:
-                            db['csv_reviews'].insert_one({'done': False, 'filename': filename, 'uid': uid, 'url': url, 'extracted_folder': datestamp, 'page': page})
-
-finally:
-    client.disconnect()
+                tasks.append(('users', filepath, OUTPUT_PATH_USERS + datestamp + '/', datestamp))
+    for archive_type, input_path, output_path in [('stories', INPUT_ARCHIVE_PATH_STORIES, OUTPUT_PATH_STORIES), ('reviews', INPUT_ARCHIVE_PATH_REVIEWS, OUTPUT_PATH_REVIEWS)]:
+        for root, dirs, archives in os.walk(input_path):
+            num = 0
+            idx = 0
+            for archive in archives:
+                idx += 1
+                if idx % 7 == 0:
+                    num += 1
+                filepath = os.path.join(root, archive)
+                if archive.endswith("tar.gz"):
+                    archive_name = os.path.basename(filepath)
+                    datestamp = archive_name.split('_', 1)[0][0:8]
+                    tasks.append((archive_type, filepath, output_path + datestamp + str(num) + '/', datestamp))
+    return tasks
+
+
+def connect_worker() -> None:
+    """Opens a database connection for the worker process since clients cannot be shared across processes."""
+    global db
+    client = DatabaseConnection()
+    db = client.connect(DATABASE_NAME)
+
+
+def extract_archive(archive_type: str, filepath: str, output_path: str, datestamp: str) -> int:
+    """Streams html members of the archive into the output path while dropping their directories,
+    e.g. temp/, and upserts one row per file keyed on its filename. Existing files are kept.
+    With CONVERT_ARCHIVES the archive is converted into a page container which is linked in the rows instead.
+
+    :param archive_type: str
+        users, stories or reviews
+    :param filepath: str
+    :param output_path: str
+    :param datestamp: str
+    :return: int
+        number of extracted html files
+    """
+    collection, build_row = ARCHIVE_TYPES[archive_type]
+    os.makedirs(output_path, exist_ok=True)
+    operations = []
+    try:
+        if CONVERT_ARCHIVES:
+            container_path = os.path.join(output_path, os.path.basename(filepath)[:-len('.tar.gz')] + '.pages')
+            container_path, filenames = convert_archive(filepath, container_path)
+            for filename in filenames:
+                row = build_row(filename, datestamp)
+                operations.append(UpdateOne({'filename': filename}, {'$setOnInsert': row, '$set': {'archive': container_path}}, upsert=True))
+        else:
+            with tarfile.open(filepath, 'r|gz') as f:
+                for member in f:
+                    if not member.isfile() or not member.name.endswith('.html'):
+                        continue
+                    filename = os.path.basename(member.name)
+                    target = os.path.join(output_path, filename)
+                    if not os.path.exists(target):
+                        with f.extractfile(member) as source, open(target, 'wb') as destination:
+                            shutil.copyfileobj(source, destination)
+                    operations.append(UpdateOne({'filename': filename}, {'$setOnInsert': build_row(filename, datestamp)}, upsert=True))
+        if operations:
+            try:
+                db[collection].bulk_write(operations, ordered=False)
+            except BulkWriteError as bwe:  # another process upserted the same filename first
+                errors = [error for error in bwe.details.get('writeErrors', []) if error.get('code') != 11000]
+                if errors:
+                    raise
+        print('Extracted %i files from %s to %s' % (len(operations), filepath, output_path))
+    except Exception as ex:
+        print('Extracting %s failed: %s' % (filepath, ex))
+    return len(operations)
+
+
+def ensure_indexes(database: Database) -> None:
+    """Creates the index the upserts are keyed on. It is unique unless existing duplicates prevent it."""
+    for collection, _ in ARCHIVE_TYPES.values():
+        try:
+            database[collection].create_index([('filename', ASCENDING)], unique=True)
+        except OperationFailure as ex:
+            print('Unique index on %s.filename not created: %s' % (collection, ex))
+            database[collection].create_index([('filename', ASCENDING)])
+
+
+if __name__ == "__main__":
+    freeze_support()
+    client = DatabaseConnection()
+    try:
+        database = client.connect(DATABASE_NAME)
+        ensure_indexes(database)
+        archive_tasks = find_archives()
+        print('Extracting %i archives using %i processes.' % (len(archive_tasks), PROCESS_COUNT))
+        with Pool(PROCESS_COUNT, initializer=connect_worker) as mp_pool:
+            file_count = sum(mp_pool.starmap(extract_archive, archive_tasks, chunksize=1))
+        print('Extracted %i files.' % file_count)
+    finally:
+        client.disconnect()
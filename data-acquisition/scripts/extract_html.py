@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+# -----------------------------------------------------------
+# Runs the FanFiktionHtmlExtract spider in one process per
+# CPU core. Parsing locally stored HTML is bound by the CPU
+# and every process claims its own batches of csv rows by
+# a lease in the database so that no page is parsed twice.
+# -----------------------------------------------------------
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+from multiprocessing import cpu_count
+
+PROCESS_COUNT = cpu_count()
+SPIDER_NAME = 'FanFiktionHtmlExtract'
+# extraction engine of the spider: loader, fast or check
+PARSER = 'loader'
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_process(number: int, timestamp: str) -> subprocess.Popen:
+    """Starts a crawl of the spider logging into its own file.
+
+    :param number: int
+    :param timestamp: str
+    :return: Popen
+    """
+    logfile = os.path.join('logs', 'extract_%s_%02d.log' % (timestamp, number))
+    return subprocess.Popen([sys.executable, '-m', 'scrapy', 'crawl', SPIDER_NAME, '-a', 'parser=' + PARSER, '--logfile', logfile], cwd=PROJECT_PATH)
+
+
+if __name__ == "__main__":
+    os.makedirs(os.path.join(PROJECT_PATH, 'logs'), exist_ok=True)
+    started_at = datetime.now().strftime('%Y%m%d_%H%M%S')
+    print('Starting %i processes of %s.' % (PROCESS_COUNT, SPIDER_NAME))
+    processes = [start_process(number, started_at) for number in range(PROCESS_COUNT)]
+    failed = 0
+    for number, process in enumerate(processes):
+        if process.wait() != 0:
+            failed += 1
+            print('Process %i exited with code %i' % (number, process.returncode))
+    print('Finished %i processes, %i failed.' % (len(processes), failed))
@@ -4,66 +4,176 @@
 # Extracts filenames from archives files and derives urls
 # from them. The gathered information are being stored in
 # csv-files for stories, users and reviews accordingly.
+# Archives are listed in parallel processes into sorted run
+# files which are merged into deduplicated, sorted output
+# so that memory use does not grow with the number of pages.
+# Parquet files are written as well if pyarrow is installed.
 # -----------------------------------------------------------
 
 from glob import glob
+from multiprocessing import Pool, cpu_count, freeze_support
+import heapq
+import json
+import os
+import shutil
 import tarfile
+import tempfile
 import csv
 
-stories = set()
-for file in glob('../pages/stories/*.gz'):
-    t = tarfile.open(file)
-    names = [name for name in t.getnames() if name.endswith('.html')]
-    print(file + ': ' + str(len(names)))
-    stories.update(names)
-
-users = set()
-for file in glob('../pages/users/*.gz'):
-    t = tarfile.open(file)
-    names = [name for name in t.getnames() if name.endswith('.html')]
-    print(file + ': ' + str(len(names)))
-    users.update(names)
-
-reviews = set()
-for file in glob('../pages/reviews/*.gz'):
-    t = tarfile.open(file)
-    names = [name for name in t.getnames() if name.endswith('.html')]
-    print(file + ': ' + str(len(names)))
-    reviews.update(names)
-
-print('Stories: ' + str(len(stories)))
-print('Users: ' + str(len(users)))
-print('Reviews: ' + str(len(reviews)))
-
-with open('users.csv', 'a', encoding='UTF8') as f:
-    writer = csv.writer(f)
-    for user in sorted(users):
-        parts = user.split('.')
-        uid = parts[0]  # e.g.: -BabyDoll-.html
-        url = 'https://www.fanfiktion.de/u/' + uid
-        writer.writerow([user, url, uid])
-
-uniq_stories = set()
-with open('stories.csv', 'a', encoding='UTF8') as f:
-    writer = csv.writer(f)
-    for story in sorted(stories):
-        parts = story.split('_')  # e.g.: 4a298d450000e42606702328_4_Der-Alltag-eines-Genies.html
-        uid = parts[0]
-        chapter = parts[1]
-        title = parts[2].split('.')[0]
-        url = 'https://www.fanfiktion.de/s/' + uid + '/' + chapter + '/' + title
-        writer.writerow([story, url, uid, title, chapter])
-        uniq_stories.add(uid)
-
-with open('reviews.csv', 'a', encoding='UTF8') as f:
-    writer = csv.writer(f)
-    for review in sorted(reviews):
-        parts = review.split('_')  # e.g.: 4f36ea8000016c470670b798_date_0_4.html
-        uid = parts[0]
-        sorted_by = parts[1]
-        chapter = parts[2]
-        page = parts[3].split('.')[0]
-        url = 'https://www.fanfiktion.de/r/s/' + uid + '/' + sorted_by + '/' + chapter + '/' + page
-        writer.writerow([review, url, uid, page])
-
-print('Unique Stories: ' + str(len(uniq_stories)))
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PROCESS_COUNT = cpu_count()
+MERGE_FAN_IN = 256  # maximum number of run files opened at once
+PARQUET_ROW_GROUP_SIZE = 100000
+
+
+def user_row(filename: str) -> list:
+    parts = filename.split('.')
+    uid = parts[0]  # e.g.: -BabyDoll-.html
+    url = 'https://www.fanfiktion.de/u/' + uid
+    return [filename, url, uid]
+
+
+def story_row(filename: str) -> list:
+    parts = filename.split('_')  # e.g.: 4a298d450000e42606702328_4_Der-Alltag-eines-Genies.html
+    uid = parts[0]
+    chapter = parts[1]
+    title = parts[2].split('.')[0]
+    url = 'https://www.fanfiktion.de/s/' + uid + '/' + chapter + '/' + title
+    return [filename, url, uid, title, chapter]
+
+
+def reviews_row(filename: str) -> list:
+    parts = filename.split('_')  # e.g.: 4f36ea8000016c470670b798_date_0_4.html
+    uid = parts[0]
+    sorted_by = parts[1]
+    chapter = parts[2]
+    page = parts[3].split('.')[0]
+    url = 'https://www.fanfiktion.de/r/s/' + uid + '/' + sorted_by + '/' + chapter + '/' + page
+    return [filename, url, uid, page]
+
+
+# row builder and columns for each type of archive
+ITEM_TYPES = {
+    'users': (user_row, ['filename', 'url', 'uid']),
+    'stories': (story_row, ['filename', 'url', 'uid', 'title', 'chapter']),
+    'reviews': (reviews_row, ['filename', 'url', 'uid', 'page']),
+}
+
+
+def list_archive(archive: str, run_dir: str) -> tuple:
+    """Writes the sorted, unique html filenames of an archive into a run file. Tar archives are streamed
+    member by member, page containers created by rearchive.py are listed from their index.
+
+    :param archive: str
+    :param run_dir: str
+    :return: tuple of archive path, run file path and number of names
+    """
+    if archive.endswith('.pages'):
+        with open(archive + '.index.json', encoding='utf-8') as f:
+            names = set(json.load(f)['members'])
+    else:
+        names = set()
+        with tarfile.open(archive, 'r|gz') as t:
+            for member in t:
+                if member.name.endswith('.html'):
+                    names.add(os.path.basename(member.name))
+    fd, run_path = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    with os.fdopen(fd, 'w', encoding='UTF8') as f:
+        for name in sorted(names):
+            f.write(name + '\n')
+    return archive, run_path, len(names)
+
+
+def read_run(path: str):
+    with open(path, encoding='UTF8') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def merge_runs(run_paths: list, run_dir: str):
+    """Merges sorted run files into unique, sorted names. Runs are merged in several passes
+    if there are more of them than files may be opened at once.
+
+    :param run_paths: list
+    :param run_dir: str
+    :return: Iterator of names
+    """
+    while len(run_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for i in range(0, len(run_paths), MERGE_FAN_IN):
+            fd, merged_path = tempfile.mkstemp(suffix='.run', dir=run_dir)
+            with os.fdopen(fd, 'w', encoding='UTF8') as f:
+                for name in unique(heapq.merge(*[read_run(path) for path in run_paths[i:i + MERGE_FAN_IN]])):
+                    f.write(name + '\n')
+            for path in run_paths[i:i + MERGE_FAN_IN]:
+                os.remove(path)
+            merged_paths.append(merged_path)
+        run_paths = merged_paths
+    yield from unique(heapq.merge(*[read_run(path) for path in run_paths]))
+
+
+def unique(names):
+    previous = None
+    for name in names:
+        if name != previous:
+            yield name
+            previous = name
+
+
+def write_index(item_type: str, mp_pool: Pool) -> None:
+    """Lists all archives of the item type and overwrites its csv and parquet files.
+
+    :param item_type: str
+    :param mp_pool: Pool
+    """
+    build_row, columns = ITEM_TYPES[item_type]
+    archives = glob('../pages/' + item_type + '/*.gz') + glob('../pages/' + item_type + '/*.pages')
+    run_dir = tempfile.mkdtemp(prefix=item_type + '_')
+    try:
+        run_paths = []
+        for archive, run_path, count in mp_pool.starmap(list_archive, [(archive, run_dir) for archive in archives]):
+            print(archive + ': ' + str(count))
+            run_paths.append(run_path)
+
+        parquet_writer = None
+        if pyarrow is not None:
+            schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+            parquet_writer = pyarrow.parquet.ParquetWriter(item_type + '.parquet', schema)
+        row_count = 0
+        uids = 0
+        previous_uid = None
+        batch = []
+        with open(item_type + '.csv', 'w', encoding='UTF8') as f:
+            writer = csv.writer(f)
+            for name in merge_runs(run_paths, run_dir):
+                row = build_row(name)
+                writer.writerow(row)
+                row_count += 1
+                if row[2] != previous_uid:  # names of the same uid are adjacent when sorted
+                    uids += 1
+                    previous_uid = row[2]
+                if parquet_writer is not None:
+                    batch.append(row)
+                    if len(batch) >= PARQUET_ROW_GROUP_SIZE:
+                        parquet_writer.write_table(pyarrow.table(list(zip(*batch)), names=columns))
+                        batch = []
+        if parquet_writer is not None:
+            if batch:
+                parquet_writer.write_table(pyarrow.table(list(zip(*batch)), names=columns))
+            parquet_writer.close()
+        print('%s: %i [Unique uids: %i]' % (item_type.capitalize(), row_count, uids))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    freeze_support()
+    with Pool(PROCESS_COUNT) as pool:
+        write_index('users', pool)
+        write_index('stories', pool)
+        write_index('reviews', pool)
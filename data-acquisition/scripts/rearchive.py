@@ -1,44 +1,89 @@
 #!/usr/bin/python3
 
 # -----------------------------------------------------------
-# Extracts archives for storing them in a new archive
-# consisting of 1,000 files.
+# Repacks archives into new seekable page containers
+# consisting of 1,000 files. Pages are streamed from the old
+# archives into the new containers without extracting them
+# and each one can be read on its own afterwards.
 # -----------------------------------------------------------
 
 import os
+import sys
 import tarfile
 from glob import glob
 from datetime import datetime
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # data-acquisition modules
+from archives import ArchiveWriter, train_dictionary
+
+OUTPUT_PATH = 'temp/'
+FILES_PER_CONTAINER = 1000
+
+# gzip or zstd, the latter requires the zstandard package
+CODEC = 'gzip'
+# number of pages a zstd dictionary is trained on, 0 disables training
+DICTIONARY_SAMPLES = 2000
+
+
+def read_pages(item_type: str):
+    """Streams the html pages of all archives of the item type.
+
+    :param item_type: str
+    :return: Iterator of tuples (filename, bytes)
+    """
+    for archive in glob('../pages/' + item_type + '/*.tar.gz'):
+        with tarfile.open(archive, 'r|gz') as f:
+            for member in f:
+                if member.isfile() and member.name.endswith('.html'):
+                    with f.extractfile(member) as page:
+                        yield os.path.basename(member.name), page.read()
+
+
+def create_dictionary(item_type: str) -> str:
+    """Trains a zstd dictionary on the first pages of the item type.
+
+    :param item_type: str
+    :return: path of the dictionary file
+    """
+    samples = []
+    for _, data in read_pages(item_type):
+        samples.append(data)
+        if len(samples) >= DICTIONARY_SAMPLES:
+            break
+    dictionary_path = OUTPUT_PATH + item_type + '.dict'
+    with open(dictionary_path, 'wb') as f:
+        f.write(train_dictionary(samples))
+    print('Dictionary:', dictionary_path)
+    return dictionary_path
+
+
+def new_container(item_type: str, dictionary_path: str = None) -> ArchiveWriter:
+    archive_name = OUTPUT_PATH + datetime.now().strftime("%Y%m%d%H%M%S%f") + '_' + item_type + '.pages'
+    return ArchiveWriter(archive_name, CODEC, dictionary_path)
+
 
 def archive_files(item_type: str) -> None:
-    file_count = 0
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    dictionary_path = None
+    if CODEC == 'zstd' and DICTIONARY_SAMPLES:
+        dictionary_path = create_dictionary(item_type)
     archive_count = 0
-    output_path = 'temp/'
-    for archive in glob('../pages/' + item_type + '/*.tar.gz'):
-        archive_count += 1
-        with tarfile.open(archive) as f:
-            names = [name for name in f.getnames() if name.endswith('.html')]
-            file_count += len(names)
-            f.extractall(output_path)
-        if file_count >= 1000:
-            filelist = [os.path.join(output_path, file) for file in os.listdir(output_path) if file.endswith('.html')]
-            archive_name = output_path + datetime.now().strftime("%Y%m%d%H%M%S%f") + '_' + item_type + '.tar.gz'
-            with tarfile.open(archive_name, "w:gz") as f:
-                for file in filelist:
-                    f.add(file)  # add to archive
-                    os.remove(file)  # delete file
-            print('Archive', archive_count, ':', archive_name)
-            file_count = 0
-    filelist = [os.path.join(output_path, file) for file in os.listdir(output_path) if file.endswith('.html')]
-    archive_name = output_path + datetime.now().strftime("%Y%m%d%H%M%S%f") + '_' + item_type + '.tar.gz'
-    with tarfile.open(archive_name, "w:gz") as f:
-        for file in filelist:
-            f.add(file, arcname=file.split('/')[-1])  # add to archive
-            os.remove(file)  # delete file
-    print('Archive:', archive_name)
-
-
-archive_files('users')
-archive_files('stories')
-archive_files('reviews')
+    writer = None
+    for filename, data in read_pages(item_type):
+        if writer is None:
+            writer = new_container(item_type, dictionary_path)
+        writer.add(filename, data)
+        if len(writer.members) >= FILES_PER_CONTAINER:
+            writer.close()
+            archive_count += 1
+            print('Archive', archive_count, ':', writer.path)
+            writer = None
+    if writer is not None:
+        writer.close()
+        print('Archive:', writer.path)
+
+
+if __name__ == "__main__":
+    archive_files('users')
+    archive_files('stories')
+    archive_files('reviews')
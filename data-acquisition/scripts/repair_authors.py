@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+# -----------------------------------------------------------
+# Applies the journal of users created from story urls which
+# the FanFiktionMissing spider wrote along with the urls of
+# the actual authors. Every batch of journal rows resolves
+# the author urls with a single query. The stories of a
+# user are then reassigned to the existing author, who is
+# then deleted, or the user gets the author url. The byte
+# offset of the last applied batch is saved next to the
+# journal, so an interrupted repair resumes from there.
+# The journal and the database default to the settings
+# REPAIR_JOURNAL_PATH and MONGO_DB, see --help.
+# -----------------------------------------------------------
+
+import argparse
+import csv
+import os
+import sys
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateMany, UpdateOne
+from pymongo.database import Database
+from utils.db_connect import DatabaseConnection
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # data-acquisition modules
+from settings import MONGO_DB, REPAIR_JOURNAL_PATH
+from urlfields import url_fields
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZE = 1000
+
+
+def read_offset(offset_path: str) -> int:
+    if not os.path.isfile(offset_path):
+        return 0
+    with open(offset_path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_offset(offset_path: str, offset: int) -> None:
+    """Saves the offset of the journal up to which all rows are applied, replacing the previous one atomically.
+
+    :param offset_path: str
+    :param offset: int
+    """
+    with open(offset_path + '.tmp', 'w') as f:
+        f.write(str(offset))
+    os.replace(offset_path + '.tmp', offset_path)
+
+
+def read_batches(journal_path: str, offset: int):
+    """Streams batches of journal rows starting at the byte offset.
+
+    :param journal_path: str
+    :param offset: int
+    :return: Iterator of tuples (rows, offset after the rows)
+    """
+    with open(journal_path, 'rb') as f:
+        f.seek(offset)
+        rows = []
+        for line in f:
+            if not line.endswith(b'\n'):  # row still being written by the spider, applied by the next run
+                break
+            offset += len(line)
+            row = next(csv.reader([line.decode('UTF8')]), None)
+            if row:
+                rows.append((ObjectId(row[0]), row[1]))
+            if len(rows) >= BATCH_SIZE:
+                yield rows, offset
+                rows = []
+        yield rows, offset
+
+
+def repair_batch(database: Database, rows: list) -> tuple:
+    """Reassigns the stories of the journaled users to their authors and deletes the users,
+    or sets the author url of a user if no user with this url exists.
+
+    :param database: Database
+    :param rows: list
+        of tuples (user id, author url)
+    :return: number of reassigned and of corrected users
+    """
+    author_ids = {user['url']: user['_id'] for user in database.users.find({'url': {'$in': list({url for _, url in rows})}}, {'url': 1})}
+    story_operations = []
+    user_operations = []
+    reassigned = corrected = 0
+    for user_id, url in rows:
+        author_id = author_ids.get(url)
+        if author_id is None:  # the user becomes the author, further users with this url are reassigned to it
+            author_ids[url] = user_id
+            user_operations.append(UpdateOne({'_id': user_id}, {'$set': {'url': url, **url_fields(url)}}))
+            corrected += 1
+        elif author_id != user_id:
+            story_operations.append(UpdateMany({'authorId': user_id}, {'$set': {'authorId': author_id}}))
+            user_operations.append(DeleteOne({'_id': user_id}))
+            reassigned += 1
+    if story_operations:  # before deleting the users so that no story loses its author
+        database.stories.bulk_write(story_operations, ordered=False)
+    if user_operations:
+        database.users.bulk_write(user_operations, ordered=True)
+    return reassigned, corrected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Applies the author repair journal written by the FanFiktionMissing spider.')
+    parser.add_argument('--journal', default=REPAIR_JOURNAL_PATH, help='path of the journal, relative ones to data-acquisition as for the spider (default: REPAIR_JOURNAL_PATH)')
+    parser.add_argument('--database', default=MONGO_DB, help='name of the database (default: MONGO_DB)')
+    args = parser.parse_args()
+    journal_path = os.path.join(PROJECT_PATH, args.journal)  # absolute paths are kept
+    offset_path = journal_path + '.offset'
+    if not args.database:
+        parser.error('No database given, set MONGO_DB or pass --database.')
+    if not os.path.isfile(journal_path):
+        print('No journal found at %s.' % journal_path)
+        sys.exit()
+    client = DatabaseConnection()
+    try:
+        database = client.connect(args.database)
+        offset = read_offset(offset_path)
+        print('Repairing authors from %s starting at byte %i.' % (journal_path, offset))
+        total_reassigned = total_corrected = 0
+        for batch, next_offset in read_batches(journal_path, offset):
+            if batch:
+                reassigned, corrected = repair_batch(database, batch)
+                total_reassigned += reassigned
+                total_corrected += corrected
+                print('Reassigned %i and corrected %i users.' % (total_reassigned, total_corrected))
+            write_offset(offset_path, next_offset)
+        print('Done.')
+    finally:
+        client.disconnect()
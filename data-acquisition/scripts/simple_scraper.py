@@ -20,7 +20,7 @@ if __name__ == "__main__":
         if db is None:
             raise Exception('Database connection failed.')
 
-        chapters = db.chapters.find({'url': {'$regex': r'https:\/\/archiveofourown'}, 'numCharacters': {'$lte': 100}})
+        chapters = db.chapters.find({'urlHost': 'archiveofourown.org', 'numCharacters': {'$lte': 100}})
         for chapter in chapters:
             print('URL: %s' % chapter['url'])
 
@@ -99,7 +99,7 @@ pairings = [
 ]
 db['pairings'].insert_many(pairings)
 
-db['chapters'].create_index({'url': 1})
+db['chapters'].create_index({'url': 1}, unique=True)
 db['chapters'].create_index({'storyId': 1})
 db['characters'].create_index({'fandomId': 1})
 db['reviews'].create_index({'parentId': 1})
@@ -109,7 +109,7 @@ db['stories'].create_index({'categoryId': 1})
 db['stories'].create_index({'genreId': 1})
 db['stories'].create_index({'pairingId': 1})
 db['stories'].create_index({'ratingId': 1})
-db['stories'].create_index({'url': 1})
+db['stories'].create_index({'url': 1}, unique=True)
 db['stories'].create_index({'ageVerification': 1})
 db['stories'].create_index({'isPreliminary': 1})
 db['stories'].create_index({'authorId': 1})
@@ -117,7 +117,7 @@ db['stories'].create_index({'sourceId': 1})
 db['story_characters'].create_index({'characterId': 1, 'storyId': 1})
 db['story_fandoms'].create_index({'fandomId': 1, 'storyId': 1})
 db['story_topics'].create_index({'topicId': 1, 'storyId': 1})
-db['users'].create_index({'url': 1})
+db['users'].create_index({'url': 1}, unique=True)
 db['users'].create_index({'sourceId': 1})
 
 client.close()
@@ -95,14 +95,63 @@ COOKIES_DEBUG = True
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
 EXTENSIONS = {
    'scrapy.extensions.spiderstate.SpiderState': 500,
+   'fanfiction.extensions.FootprintReport': 510,
+   'fanfiction.extensions.MetricsExporter': 520,
 }
 
+# Report peak memory and the maximum sizes of the scheduler queue and JOBDIR sampled every interval in seconds,
+# enabled in the custom_settings of the crawling spiders
+FOOTPRINT_ENABLED = False
+FOOTPRINT_INTERVAL = 60
+
+# Sample pages, items per type and 429 responses per second as well as the mean and p95 latency of the database operations
+# of the pipelines every interval in seconds. Samples are kept for METRICS_RETENTION_DAYS in a SQLite file below .scrapy,
+# enabled in the custom_settings of the crawling spiders
+METRICS_ENABLED = False
+METRICS_INTERVAL = 30
+METRICS_FILE = 'metrics.sqlite'
+METRICS_RETENTION_DAYS = 7
+# Serve the latest sample on http://127.0.0.1:<port>/metrics, disabled if None
+METRICS_PORT = None
+
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
     'fanfiction.pipelines.FanfictionPipeline': 300,
+    # 'fanfiction.pipelines.AsyncFanfictionPipeline': 300,
 }
 
+# Buffer write operations of the item pipelines and write them in unordered batches
+# once the number of operations or the seconds since the last batch are reached
+PIPELINE_BULK_WRITE = False
+PIPELINE_BULK_SIZE = 1000
+PIPELINE_BULK_INTERVAL = 10
+
+# Save users, stories and chapters with a single upsert each instead of a lookup followed by a write,
+# reviews lack a unique key and are always looked up
+PIPELINE_UPSERTS = False
+# Create the indexes the pipelines rely on for lookups and upserts when opening a spider
+PIPELINE_CREATE_INDEXES = True
+
+# Recount chapters and reviews of the stories touched by the crawl when closing the spider
+PIPELINE_RECONCILE_COUNTS = False
+
+# Number of threads saving items when using one of the Async* pipelines
+PIPELINE_CONCURRENCY = 1
+
+# Number of pages per container written by FanFiktionHtml and their compression, gzip or zstd
+PAGE_ARCHIVE_SIZE = 1000
+PAGE_ARCHIVE_CODEC = 'gzip'
+
+# Number of csv rows a FanFiktionHtmlExtract process claims at once, they are marked as done once the pipeline has written their items
+EXTRACT_BATCH_SIZE = 1000
+# Seconds after which rows claimed by a crashed FanFiktionHtmlExtract process may be claimed by another one
+EXTRACT_LEASE_SECONDS = 3600
+
+# Journal of users created from story urls and the urls of their actual authors written by FanFiktionMissing,
+# applied in bulk by scripts/repair_authors.py
+REPAIR_JOURNAL_PATH = 'repairs/authors.csv'
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 AUTOTHROTTLE_ENABLED = True
@@ -121,10 +170,27 @@ AUTOTHROTTLE_MAX_DELAY = 60
 # HTTPCACHE_ENABLED = True
 # HTTPCACHE_EXPIRATION_SECS = 0
 # HTTPCACHE_DIR = 'httpcache'
-# HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+HTTPCACHE_IGNORE_HTTP_CODES = [429]
+# Responses are stored once per request in a SQLite database per spider with compressed, deduplicated bodies.
+# Replay a crawl without any network requests by running it with -s HTTPCACHE_ENABLED=1 -s HTTPCACHE_IGNORE_MISSING=1
+HTTPCACHE_STORAGE = 'fanfiction.httpcache.ContentAddressedCacheStorage'
+# gzip or zstd, the latter requires the zstandard package
+HTTPCACHE_CODEC = 'gzip'
 RETRY_HTTP_CODES = [429]
 
+# Token bucket of TooManyRequestsRetryMiddleware limiting the requests per second of each domain.
+# A 429 response halves the rate and blocks the domain for its Retry-After seconds or an exponential
+# backoff starting at RATELIMIT_BACKOFF_BASE seconds plus up to RATELIMIT_JITTER of it, while every
+# other response raises the rate by RATELIMIT_RECOVERY until RATELIMIT_MAX_RATE is reached again.
+RATELIMIT_RATE = 4.0
+RATELIMIT_MAX_RATE = 4.0
+RATELIMIT_MIN_RATE = 0.05
+RATELIMIT_BURST = 4
+RATELIMIT_RECOVERY = 0.05
+RATELIMIT_BACKOFF_BASE = 60
+RATELIMIT_BACKOFF_MAX = 600
+RATELIMIT_JITTER = 0.25
+
 # Enable or disable downloader middlewares
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
@@ -135,7 +201,7 @@ DOWNLOADER_MIDDLEWARES = {
     # 'rotating_free_proxies.middlewares.BanDetectionMiddleware': 620,
     # 'rotating_proxies.middlewares.RotatingProxyMiddleware': 610,
     # 'rotating_proxies.middlewares.BanDetectionMiddleware': 620,
-    'fanfiction.middlewares.TooManyRequestsRetryMiddleware': 543,
+    'fanfiction.middlewares.TooManyRequestsRetryMiddleware': 950,  # after HttpCacheMiddleware (900) so that cached responses are not rate limited
 }
 
 # ROTATING_PROXY_LIST = [
@@ -16,6 +16,7 @@ from scrapy.loader import ItemLoader
 from scrapy.spiders import CrawlSpider, Rule
 from w3lib.html import replace_tags, replace_escape_chars
 from ..items import Story, Chapter, User, Review
+from .. import priorities
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
@@ -56,6 +57,8 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
 
     custom_settings = {
         'JOBDIR': 'crawls/AO3-Books',
+        'FOOTPRINT_ENABLED': True,
+        'METRICS_ENABLED': True,
     }
 
     start_urls = ['https://archiveofourown.org/media/Books%20*a*%20Literature/fandoms']
@@ -72,6 +75,11 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
         self.client = MongoClient(MONGO_URI)
         self.db = self.client[MONGO_DB]
         self.adult_cookie = {'name': 'view_adult', 'value': 'true', 'domain': 'archiveofourown.org', 'path': '/'}
+        # whole-work mode requesting nothing but the full work with its comments, e.g. scrapy crawl ArchiveOfOurOwn -a full_work=1
+        # Authors are saved as preliminary users whose profiles are fetched by a later crawl without this mode.
+        self.full_work = str(getattr(self, 'full_work', '')).lower() in ('1', 'true', 'yes')
+        # fandoms known to have no works are skipped without querying the database for every link
+        self.empty_fandoms = {fandom['url'] for fandom in self.db['temp_fandoms'].find({'hasWorks': False, 'fandom': self.start_urls_genre}, {'url': 1})}
         # SCRAPY SHELL:
         # from scrapy import Request
         # fetch(Request('https://archiveofourown.org/works/35789398?view_full_work=true&show_comments=true', cookies=[{'name': 'view_adult', 'value': 'true', 'domain': 'archiveofourown.org', 'path': '/'}]))
@@ -88,7 +96,7 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
         return links
 
     def adjust_request(self, request, _referer):
-        if self.db['temp_fandoms'].find_one({'url': request.url, 'hasWorks': False, 'fandom': self.start_urls_genre}):
+        if request.url in self.empty_fandoms:
             print('SKIP', request.url)
             return False
         request.cookies.update(self.adult_cookie)
@@ -103,21 +111,44 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
         if response.css('li.work.group'):
             has_works = True
         self.db['temp_fandoms'].insert_one({'url': response.url, 'hasWorks': has_works, 'fandom': self.start_urls_genre})
+        if not has_works:
+            self.empty_fandoms.add(response.url)
 
+        works = []
         for item in response.css('li.work.group'):
             user_url_pseuds = response.urljoin(item.xpath('.//a[starts-with(@href, "/users/")]/@href').get())
-            user_url = user_url_pseuds.rsplit('/', 2)[0]
-            user_url_profile = "%s/%s" % (user_url, 'profile')
             story_url = response.urljoin(item.xpath('.//a[starts-with(@href, "/works/")]/@href').get())
+            works.append((user_url_pseuds.rsplit('/', 2)[0], story_url))
+
+        # resolve the works and authors of the page with one query per collection
+        done_users = set() if self.full_work else self.find_done_urls('users', [user_url for user_url, _ in works])
+        done_stories = self.find_done_urls('stories', [story_url for _, story_url in works])
+        for user_url, story_url in works:
+            user_url_profile = "%s/%s" % (user_url, 'profile')
             story_url_full_with_comments = "%s?%s" % (story_url, urlencode({'view_full_work': 'true', 'show_comments': 'true'}))
-            if self.db['users'].find_one({'url': user_url, 'isPreliminary': False}) is None:
-                yield Request(user_url_profile, callback=self.parse_user, cb_kwargs=dict(user_url=user_url))
-            if self.db['stories'].find_one({'url': story_url, 'isPreliminary': False}) is None:
-                yield Request(story_url_full_with_comments, cookies=[{'name': 'view_adult', 'value': 'true', 'domain': 'archiveofourown.org', 'path': '/'}], callback=self.parse_story, cb_kwargs=dict(user_url=user_url, story_url=story_url))
+            if not self.full_work and user_url not in done_users:
+                done_users.add(user_url)  # authors of several works on the page are requested once
+                self.crawler.stats.inc_value('ao3/user_requests')
+                yield Request(user_url_profile, callback=self.parse_user, cb_kwargs=dict(user_url=user_url), priority=priorities.USER)
+            if story_url not in done_stories:
+                self.crawler.stats.inc_value('ao3/work_requests')
+                yield Request(story_url_full_with_comments, cookies=[{'name': 'view_adult', 'value': 'true', 'domain': 'archiveofourown.org', 'path': '/'}], callback=self.parse_story, cb_kwargs=dict(user_url=user_url, story_url=story_url), priority=priorities.STORY)
 
         next_stories = response.css('ol.pagination > li.next a[rel="next"]::attr(href)').get()
         if next_stories:
-            yield response.follow(next_stories, callback=self.parse_fandom)
+            yield response.follow(next_stories, callback=self.parse_fandom, priority=priorities.LISTING)
+
+    def find_done_urls(self, collection: str, urls: list) -> set:
+        """Returns those urls whose documents exist and are not preliminary.
+
+        :param collection: str
+            users or stories
+        :param urls: list
+        :return: set
+        """
+        if not urls:
+            return set()
+        return {document['url'] for document in self.db[collection].find({'url': {'$in': list(set(urls))}, 'isPreliminary': False}, {'url': 1})}
 
     def parse_user(self, response, user_url):
         """Parses user item."""
@@ -142,7 +173,7 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
         yield loader.load_item()
 
     def parse_story(self, response, user_url, story_url):
-        """Parses story item."""
+        """Parses story item together with all chapters and the first page of comments of the full work."""
 
         print('\t', 'parsing story from', story_url)
 
@@ -274,5 +305,6 @@ class ArchiveOfOurOwnSpider(CrawlSpider, ABC):
 
         next_reviews = response.css('div#comments_placeholder > ol.pagination > li.next a[rel="next"]::attr(href)').get()
         if next_reviews:
-            yield response.follow(next_reviews, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url))
+            self.crawler.stats.inc_value('ao3/comment_page_requests')
+            yield response.follow(next_reviews, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url), priority=priorities.REVIEWS)
 
@@ -1,4 +1,5 @@
 import re
+from array import array
 
 from scrapy.exceptions import CloseSpider
 
@@ -7,6 +8,9 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 from abc import ABC
 from ..utilities import get_datetime, get_date, str_to_int
+from ..fingerprints import UrlSet, fingerprint
+from ..crawlmeta import CrawlMetaStore, listing_signature
+from .. import priorities
 
 from scrapy.http import Request
 from scrapy import signals
@@ -34,6 +38,24 @@ def find_story_definitions(text: str) -> list:
     return list(filter(None, [x.strip() for x in text.split(' / ')]))
 
 
+def has_missing_reviews(story: dict) -> bool:
+    """Checks if fewer reviews of the story are saved than listed.
+
+    :param story: dict
+    :return: bool
+    """
+    return 'currentReviewCount' not in story or 'totalReviewCount' not in story or str_to_int(story['totalReviewCount']) == 0 or str_to_int(story['currentReviewCount']) < str_to_int(story['totalReviewCount'])
+
+
+def has_missing_chapters(story: dict) -> bool:
+    """Checks if fewer chapters of the story are saved than listed.
+
+    :param story: dict
+    :return: bool
+    """
+    return 'currentChapterCount' not in story or 'totalChapterCount' not in story or str_to_int(story['totalChapterCount']) == 0 or str_to_int(story['currentChapterCount']) < str_to_int(story['totalChapterCount'])
+
+
 class FanfiktionSpider(CrawlSpider, ABC):
     name = 'FanFiktion'
     download_delay = 0.725
@@ -41,6 +63,8 @@ class FanfiktionSpider(CrawlSpider, ABC):
 
     custom_settings = {
         'JOBDIR': 'crawls/FanFiktion-Buecher',
+        'FOOTPRINT_ENABLED': True,
+        'METRICS_ENABLED': True,
     }
 
     # start_urls = ['https://www.fanfiktion.de/Tabletop-Rollenspiele/c/108000000']
@@ -54,7 +78,7 @@ class FanfiktionSpider(CrawlSpider, ABC):
     # start_urls = ['https://www.fanfiktion.de/Anime-Manga/c/102000000']
 
     rules = (
-        Rule(LinkExtractor(allow=r'\/c\/', restrict_css='div.storylist'), callback='parse_item', follow=True),
+        Rule(LinkExtractor(allow=r'\/c\/', restrict_css='div.storylist'), callback='parse_item', follow=True),  # listing pages keep priorities.LISTING
     )
 
     def __init__(self, *a, **kw):
@@ -62,10 +86,67 @@ class FanfiktionSpider(CrawlSpider, ABC):
         dispatcher.connect(self.spider_closed, signals.spider_closed)
         self.client = MongoClient(MONGO_URI)
         self.db = self.client[MONGO_DB]
+        self.load_urls()
+        # incremental mode refreshing changed stories, e.g. scrapy crawl FanFiktion -a incremental=1
+        self.incremental = str(getattr(self, 'incremental', '')).lower() in ('1', 'true', 'yes')
+        self.crawl_meta = None
+        if self.incremental:
+            self.crawl_meta = CrawlMetaStore(self.db)
+            self.crawl_meta.load()
+
+    def load_urls(self):
+        """Preloads fingerprints of complete users, stories and crawled review pages so that
+        listing pages are processed without querying the database for every story."""
+        self.users = UrlSet.from_urls(u['url'] for u in self.db['users'].find({'isPreliminary': False, 'url': {'$exists': True}}, {'url': 1}))
+        self.reviews = UrlSet.from_urls(r['_id'] for r in self.db['reviews'].aggregate([{'$match': {'url': {'$exists': True}}}, {'$group': {'_id': '$url'}}], allowDiskUse=True))
+        stories, missing_reviews, missing_chapters = array('Q'), array('Q'), array('Q')
+        projection = {'url': 1, 'currentReviewCount': 1, 'totalReviewCount': 1, 'currentChapterCount': 1, 'totalChapterCount': 1}
+        for story in self.db['stories'].find({'url': {'$exists': True}}, projection):
+            value = fingerprint(story['url'])
+            stories.append(value)
+            if has_missing_reviews(story):
+                missing_reviews.append(value)
+            if has_missing_chapters(story):
+                missing_chapters.append(value)
+        self.stories = UrlSet(stories)
+        self.stories_missing_reviews = UrlSet(missing_reviews)
+        self.stories_missing_chapters = UrlSet(missing_chapters)
+        self.logger.info('Loaded %d users, %d stories and %d review pages', len(self.users), len(self.stories), len(self.reviews))
 
     def spider_closed(self, spider):
+        if self.crawl_meta:
+            self.crawl_meta.flush()
         self.client.close()
 
+    def refresh_request(self, url: str, callback, cb_kwargs: dict, priority: int) -> Request:
+        """Returns request of a page crawled before, conditional if the site sent validators for it.
+        It bypasses the duplicate filter which remembers the page from earlier crawls.
+
+        :param url: str
+        :param callback: Callable
+        :param cb_kwargs: dict
+        :param priority: int
+        :return: Request
+        """
+        return Request(url, callback=callback, cb_kwargs=cb_kwargs, priority=priority, headers=self.crawl_meta.conditional_headers(url), dont_filter=True, meta={'handle_httpstatus_list': [304]})
+
+    def unchanged(self, response, content_css: str) -> bool:
+        """Checks in incremental mode if a page is not modified or has the same content as when crawled last.
+
+        :param response: Response
+        :param content_css: str
+            Selector of the relevant content of the page
+        :return: bool
+        """
+        if not self.incremental or response.status not in (200, 304):
+            return False
+        if 'unchanged' not in response.meta:
+            content = ''.join(response.css(content_css).getall()) if response.status == 200 else None
+            response.meta['unchanged'] = self.crawl_meta.unchanged(response, content)
+            if response.meta['unchanged']:
+                self.crawler.stats.inc_value('incremental/unchanged_pages')
+        return response.meta['unchanged']
+
     def parse_item(self, response):
         """Processes item by evaluating their type and passing it to the appropriate parser."""
         if response.status != 200:
@@ -76,25 +157,47 @@ class FanfiktionSpider(CrawlSpider, ABC):
             story_url = response.urljoin(item.xpath('.//a[starts-with(@href, "/s/")]/@href').get())
             reviews_url = response.urljoin(item.xpath('.//a[starts-with(@href, "/r/s/")]/@href').get())
             total_review_count = item.xpath('.//a[starts-with(@href, "/r/s/")]/text()').get()
-            if self.db['users'].find_one({'url': user_url, 'isPreliminary': False}) is None:
-                yield Request(user_url, callback=self.parse_user)
-            story = self.db['stories'].find_one({'url': story_url})
-            review = self.db['reviews'].find_one({'url': reviews_url})
-            has_missing_reviews = story and ('currentReviewCount' not in story or 'totalReviewCount' not in story or str_to_int(story['totalReviewCount']) == 0 or str_to_int(story['currentReviewCount']) < str_to_int(story['totalReviewCount']))
-            if review is None or has_missing_reviews:
-                yield Request(reviews_url, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url))
-            has_missing_chapters = story and ('currentChapterCount' not in story or 'totalChapterCount' not in story or str_to_int(story['totalChapterCount']) == 0 or str_to_int(story['currentChapterCount']) < str_to_int(story['totalChapterCount']))
-            if story is None or has_missing_chapters:
-                if has_missing_chapters:
-                    self.logger.info('Story with missing chapters: {}'.format(story))
-                yield Request(story_url, callback=self.parse_story, cb_kwargs=dict(user_url=user_url, total_review_count=total_review_count, story=story))
+            if user_url not in self.users:
+                yield Request(user_url, callback=self.parse_user, priority=priorities.USER)
+            story_exists = story_url in self.stories
+            signature = listing_signature(item.css('*::text').getall()) if self.incremental else None
+            changed = False
+            if signature is not None and story_exists:
+                if not self.crawl_meta.has_listing(story_url):  # first incremental crawl, the saved story is taken as current
+                    self.crawl_meta.record_listing(story_url, signature)
+                elif self.crawl_meta.listing_changed(story_url, signature):
+                    changed = True
+                    self.crawler.stats.inc_value('incremental/changed_stories')
+                else:
+                    self.crawler.stats.inc_value('incremental/unchanged_stories')
+            if changed:
+                yield self.refresh_request(reviews_url, self.parse_reviews, dict(story_url=story_url), priorities.REVIEWS)
+            elif reviews_url not in self.reviews or (story_exists and story_url in self.stories_missing_reviews):
+                yield Request(reviews_url, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url), priority=priorities.REVIEWS)
+            missing_chapters = story_exists and story_url in self.stories_missing_chapters
+            if not story_exists or missing_chapters or changed:
+                story = None
+                if missing_chapters or changed:  # only saved stories are passed on for requesting their missing chapters
+                    story = self.db['stories'].find_one({'url': story_url})
+                    if missing_chapters:
+                        self.logger.info('Story with missing chapters: {}'.format(story))
+                cb_kwargs = dict(user_url=user_url, total_review_count=total_review_count, story=story, signature=signature)
+                if changed:
+                    yield self.refresh_request(story_url, self.parse_story, cb_kwargs, priorities.STORY)
+                else:
+                    yield Request(story_url, callback=self.parse_story, cb_kwargs=cb_kwargs, priority=priorities.STORY)
             else:
                 self.logger.info('Story exists')
 
-    def parse_story(self, response, user_url, total_review_count, story=None):
+    def parse_story(self, response, user_url, total_review_count, story=None, signature=None):
         """Parses story item."""
-        if response.status != 200:
+        unchanged = self.unchanged(response, 'div.story-left, div.story-right')
+        if response.status != 200 and not unchanged:
             raise CloseSpider('Closing spider due to HTTP error')
+        if signature is not None:
+            self.crawl_meta.record_listing(response.url, signature)
+        if unchanged:
+            return
 
         loader = ItemLoader(item=Story(), selector=response)
 
@@ -176,16 +279,16 @@ class FanfiktionSpider(CrawlSpider, ABC):
         if not story:  # story is missing so far
             next_chapter = right_sel.xpath('.//a[contains(@title, "nächstes Kapitel")]/@href').get()
             if next_chapter:
-                yield response.follow(next_chapter, callback=self.parse_chapter, cb_kwargs=dict(story_url=story_url, story=story, total_chapter_count=total_chapter_count))
+                yield response.follow(next_chapter, callback=self.parse_chapter, cb_kwargs=dict(story_url=story_url, story=story, total_chapter_count=total_chapter_count), priority=priorities.CHAPTER)
         else:  # chapters are missing
+            saved_numbers = {c.get('number') for c in self.db['chapters'].find({'storyId': ObjectId(story['_id']), 'isPreliminary': False}, {'number': 1})}
             for chapter_number in range(1, str_to_int(total_chapter_count)):
-                chapter = self.db['chapters'].find_one({'storyId': ObjectId(story['_id']), 'number': chapter_number, 'isPreliminary': False})
-                if not chapter:
+                if chapter_number not in saved_numbers:
                     url_parts = response.url.split('/')
                     url_parts[-2] = str(chapter_number)
                     chapter_url = '/'.join(url_parts)
                     self.logger.info("New chapter: {}".format(chapter_url))
-                    yield Request(chapter_url, callback=self.parse_chapter, cb_kwargs=dict(story_url=story_url, story=story, total_chapter_count=total_chapter_count))
+                    yield Request(chapter_url, callback=self.parse_chapter, cb_kwargs=dict(story_url=story_url, story=story, total_chapter_count=total_chapter_count), priority=priorities.CHAPTER)
 
 
     def parse_user(self, response):
@@ -224,12 +327,16 @@ class FanfiktionSpider(CrawlSpider, ABC):
         # story_related.add_value('favoredStories', response.urljoin(response.css('div#ffcbox-stories-layer-favstorynickdetails a.hint--large::attr(href)').getall()))
         # story_related.add_value('favoredAuthors', response.urljoin(response.css('div#ffcbox-stories-layer-favauthornickdetails a::attr(href)').getall()))
 
+        self.users.add(response.url)
         yield loader.load_item()
 
     def parse_reviews(self, response, story_url):
         """Parses review items."""
-        if response.status != 200:
+        unchanged = self.unchanged(response, 'div.review')
+        if response.status != 200 and not unchanged:
             raise CloseSpider('Closing spider due to HTTP error')
+        if unchanged:  # following pages are not refreshed either
+            return
 
         for review in response.css('div.review'):
             loader = ItemLoader(item=Review(), selector=review)
@@ -241,8 +348,8 @@ class FanfiktionSpider(CrawlSpider, ABC):
             user_url = left_sel.xpath('.//a[starts-with(@href, "/u/")]/@href').get()
             if user_url:
                 left.add_value('userUrl', response.urljoin(user_url))
-                if self.db['users'].find_one({'url': response.urljoin(user_url), 'isPreliminary': False}) is None:
-                    yield response.follow(user_url, callback=self.parse_user)
+                if response.urljoin(user_url) not in self.users:
+                    yield response.follow(user_url, callback=self.parse_user, priority=priorities.USER)
 
             reviewed_at = left_sel.xpath('.//div[contains(text(), "Uhr")]/text()').get()
             if reviewed_at:
@@ -291,4 +398,4 @@ class FanfiktionSpider(CrawlSpider, ABC):
 
         next_reviews = response.css('link[rel="next"]::attr(href)').get()
         if next_reviews:
-            yield response.follow(next_reviews, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url))
+            yield response.follow(next_reviews, callback=self.parse_reviews, cb_kwargs=dict(story_url=story_url), priority=priorities.REVIEWS)
@@ -1,30 +1,29 @@
 import csv
-import tarfile
 import os
 import os.path
 from abc import ABC
-from datetime import datetime
 from scrapy import signals
 from scrapy.exceptions import CloseSpider
 from scrapy.http import Request
 from scrapy.linkextractors import LinkExtractor
 from scrapy.spiders import CrawlSpider, Rule
+from ..archives import PageArchiveWriter
 from ..settings import ARCHIVE_PATH_STORIES, ARCHIVE_PATH_USERS, ARCHIVE_PATH_REVIEWS
+from ..state import UrlStateStore
 
+# kinds of urls tracked in the url state store with their callback names and csv files
+URL_KINDS = {
+    'story': ('save_story', 'pages/stories.csv'),
+    'user': ('save_user', 'pages/users.csv'),
+    'reviews': ('save_reviews', 'pages/reviews.csv'),
+}
 
-def archive_files(filepath: str, outpath: str, typename: str, min_size: int = 1) -> None:
-    try:
-        filelist = [os.path.join(filepath, file) for file in os.listdir(filepath) if file.endswith('.html')]
-        if len(filelist) > min_size:
-            archive_name = typename + '_' + datetime.now().strftime("%Y%m%d%H%M%S%f") + '.tar.gz'
-            archive_path = os.path.join(outpath, archive_name)
-            with tarfile.open(archive_path, "w:gz") as tar:
-                for file in filelist:
-                    tar.add(file, arcname=file.split('/')[-1])  # add to archive
-                    os.remove(file)  # delete file
-            print('Archive: ', archive_path)
-    except FileNotFoundError:
-        print('Archive could not be created because path was not found: ', filepath)
+# page containers of each kind of url with their name prefixes and directories
+ARCHIVES = {
+    'story': ('stories', ARCHIVE_PATH_STORIES),
+    'user': ('users', ARCHIVE_PATH_USERS),
+    'reviews': ('reviews', ARCHIVE_PATH_REVIEWS),
+}
 
 
 class FanfiktionHtmlSpider(CrawlSpider, ABC):
@@ -34,6 +33,8 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
 
     custom_settings = {
         'JOBDIR': 'crawls/Buecher-Html',
+        'FOOTPRINT_ENABLED': True,
+        'METRICS_ENABLED': True,
     }
 
     start_urls = ['https://www.fanfiktion.de/Buecher/c/103000000']
@@ -46,6 +47,8 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
     def __init__(self, *a, **kw):
         super(FanfiktionHtmlSpider, self).__init__(*a, **kw)
         self.state = getattr(self, 'state', {})
+        self.urls = None
+        self.archives = {}
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -58,89 +61,118 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
     def handle_spider_opened(self, spider):
         spider.logger.info('Spider opened: %s', spider.name)
 
-        # get or initialize state attributes
-        state_attrs = ['done_story_urls', 'done_user_urls', 'done_reviews_urls', 'open_story_urls', 'open_user_urls', 'open_reviews_urls', 'failed_story_urls', 'failed_user_urls', 'failed_reviews_urls']
-        for state_attr in state_attrs:
-            self.state[state_attr] = getattr(self.state, state_attr, set())
-
+        # url sets are kept on disk next to the job state instead of inside the pickled spider state
+        self.urls = UrlStateStore(os.path.join(self.settings.get('JOBDIR') or 'pages', 'urls.sqlite'))
+        self.migrate_state()
         self.read_urls_into_state()
+        self.urls.commit()
         self.print_stats()
 
         if not os.path.isdir(ARCHIVE_PATH_STORIES) or not os.path.isdir(ARCHIVE_PATH_USERS) or not os.path.isdir(ARCHIVE_PATH_REVIEWS):
             spider.logger.info('Specified archive paths from .env-file are no valid directories')
             raise CloseSpider
 
+        # pages are appended to containers in background threads instead of being saved as files and archived periodically
+        for kind, (prefix, path) in ARCHIVES.items():
+            self.archives[kind] = PageArchiveWriter(path, prefix, self.settings.getint('PAGE_ARCHIVE_SIZE', 1000), self.settings.get('PAGE_ARCHIVE_CODEC', 'gzip'))
+
     def handle_spider_idle(self, spider):
         spider.logger.info('Spider idle: %s', spider.name)
 
-        # process open urls
-        while self.state.get('open_story_urls', set()):
-            url = self.state.get('open_story_urls').pop()
-            spider.logger.info('Crawling story: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_story), spider)
-        while self.state.get('open_user_urls', set()):
-            url = self.state.get('open_user_urls').pop()
-            spider.logger.info('Crawling user: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_user), spider)
-        while self.state.get('open_reviews_urls', set()):
-            url = self.state.get('open_reviews_urls').pop()
-            spider.logger.info('Crawling reviews: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_reviews), spider)
-
-        # process failed urls
-        while self.state.get('failed_story_urls', set()):
-            url = self.state.get('failed_story_urls').pop()
-            spider.logger.info('Crawling story: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_story), spider)
-        while self.state.get('failed_user_urls', set()):
-            url = self.state.get('failed_user_urls').pop()
-            spider.logger.info('Crawling user: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_user), spider)
-        while self.state.get('failed_reviews_urls', set()):
-            url = self.state.get('failed_reviews_urls').pop()
-            spider.logger.info('Crawling reviews: %s', url)
-            self.crawler.engine.crawl(Request(url, callback=self.save_reviews), spider)
+        # complete the current containers so that urls of pages still being written are not crawled again
+        for kind, archive in self.archives.items():
+            archive.flush()
+            self.commit_pages(kind)
+
+        # process open and failed urls
+        for status in ['open', 'failed']:
+            for kind, (callback, _) in URL_KINDS.items():
+                urls = self.urls.pop(kind, status)
+                while urls:
+                    for url in urls:
+                        spider.logger.info('Crawling %s: %s', kind, url)
+                        self.crawler.engine.crawl(Request(url, callback=getattr(self, callback)), spider)
+                    urls = self.urls.pop(kind, status)
+        self.urls.commit()
 
     def handle_spider_closed(self, spider):
         spider.logger.info('Spider closed: %s', spider.name)
 
+        # complete the current containers
+        for kind, archive in self.archives.items():
+            archive.close()
+            self.commit_pages(kind)
+
         # set stats
-        state_attrs = ['open_story_urls', 'open_user_urls', 'open_reviews_urls', 'failed_story_urls', 'failed_user_urls', 'failed_reviews_urls']
-        for state_attr in state_attrs:
-            self.crawler.stats.set_value(state_attr, len(self.state.get(state_attr, set())))
-        self.crawler.stats.set_value('crawled_stories', self.state.get('story_items'), 0)
-        self.crawler.stats.set_value('crawled_users', self.state.get('user_items'), 0)
-        self.crawler.stats.set_value('crawled_reviews', self.state.get('reviews_items'), 0)
-
-        # archive files
-        archive_files('pages/stories/', ARCHIVE_PATH_STORIES, 'stories')
-        archive_files('pages/users/', ARCHIVE_PATH_USERS, 'users')
-        archive_files('pages/reviews/', ARCHIVE_PATH_REVIEWS, 'reviews')
+        for status in ['open', 'failed']:
+            for kind in URL_KINDS:
+                self.crawler.stats.set_value('%s_%s_urls' % (status, kind), self.urls.count(kind, status))
+        self.crawler.stats.set_value('crawled_stories', self.urls.get_counter('story_items'))
+        self.crawler.stats.set_value('crawled_users', self.urls.get_counter('user_items'))
+        self.crawler.stats.set_value('crawled_reviews', self.urls.get_counter('reviews_items'))
+        self.urls.close()
+
+    def migrate_state(self):
+        """Moves url sets and item counts of a spider state pickled by earlier runs into the url state store."""
+        for status in ['done', 'open', 'failed']:
+            for kind in URL_KINDS:
+                for url in self.state.pop('%s_%s_urls' % (status, kind), set()):
+                    self.urls.add(kind, status, url)
+        for kind in URL_KINDS:
+            if '%s_items' % kind in self.state:
+                self.urls.set_counter('%s_items' % kind, self.state.pop('%s_items' % kind))
 
     def read_urls_into_state(self):
-        story_csv = 'pages/stories.csv'
-        if os.path.isfile(story_csv):
-            with open(story_csv) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in reader:
-                    self.state['done_story_urls'].add(row[1])
-        user_csv = 'pages/users.csv'
-        if os.path.isfile(user_csv):
-            with open(user_csv) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in reader:
-                    self.state['done_user_urls'].add(row[1])
-        reviews_csv = 'pages/reviews.csv'
-        if os.path.isfile(reviews_csv):
-            with open(reviews_csv) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in reader:
-                    self.state['done_reviews_urls'].add(row[1])
+        """Marks urls of saved pages as done. Only rows appended to the csv files since the last run are read."""
+        for kind, (_, csv_path) in URL_KINDS.items():
+            if os.path.isfile(csv_path):
+                offset = self.urls.get_counter(csv_path)
+                if offset > os.path.getsize(csv_path):  # file was replaced
+                    offset = 0
+                with open(csv_path, newline='') as f:
+                    f.seek(offset)
+                    reader = csv.reader(f, delimiter=',')
+                    for row in reader:
+                        self.urls.add(kind, 'done', row[1])
+                    self.urls.set_counter(csv_path, f.tell())
+
+    def save_page(self, kind: str, filename: str, body: bytes, row: list) -> int:
+        """Queues page to be archived and marks the urls of the pages of completed containers as done.
+
+        :param kind: str
+        :param filename: str
+        :param body: bytes
+        :param row: list
+            csv row of the page beginning with filename and url
+        :return: number of saved pages of the kind
+        """
+        self.archives[kind].add(filename, body, row)
+        self.commit_pages(kind)
+        item_count = self.urls.increment('%s_items' % kind)
+        self.urls.increment('item_count')
+        if item_count % 1000 == 0:  # every 1000 items
+            self.print_stats()
+        return item_count
+
+    def commit_pages(self, kind: str) -> None:
+        """Appends the rows of pages whose containers are complete to the csv file and marks their urls as done.
+        Urls of pages lost by a crash before their container was completed therefore remain open.
+
+        :param kind: str
+        """
+        rows = self.archives[kind].committed()
+        if not rows:
+            return
+        with open(URL_KINDS[kind][1], 'a', encoding='UTF8') as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+        for row in rows:
+            self.urls.add(kind, 'done', row[1])
 
     def print_stats(self):
-        self.logger.info('Stories: %d [Done: %d, Open: %d]', self.state.get('story_items', 0), len(self.state.get('done_story_urls', set())), len(self.state.get('open_story_urls', set())))
-        self.logger.info('Users: %d [Done: %d, Open: %d]', self.state.get('user_items', 0), len(self.state.get('done_user_urls', set())), len(self.state.get('open_user_urls', set())))
-        self.logger.info('Reviews: %d [Done: %d, Open: %d]', self.state.get('reviews_items', 0), len(self.state.get('done_reviews_urls', set())), len(self.state.get('open_reviews_urls', set())))
+        self.logger.info('Stories: %d [Done: %d, Open: %d]', self.urls.get_counter('story_items'), self.urls.count('story', 'done'), self.urls.count('story', 'open'))
+        self.logger.info('Users: %d [Done: %d, Open: %d]', self.urls.get_counter('user_items'), self.urls.count('user', 'done'), self.urls.count('user', 'open'))
+        self.logger.info('Reviews: %d [Done: %d, Open: %d]', self.urls.get_counter('reviews_items'), self.urls.count('reviews', 'done'), self.urls.count('reviews', 'open'))
 
     def parse_storylist(self, response):
         for item in response.css('div.storylist-item'):
@@ -148,21 +180,21 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
             story_url = item.xpath('.//a[starts-with(@href, "/s/")]/@href').get()
             reviews_url = item.xpath('.//a[starts-with(@href, "/r/s/")]/@href').get()
 
-            if story_url and response.urljoin(story_url) not in self.state['done_story_urls']:
-                self.state['open_story_urls'].add(response.urljoin(story_url))
+            if story_url and not self.urls.contains('story', 'done', response.urljoin(story_url)):
+                self.urls.add('story', 'open', response.urljoin(story_url))
                 yield response.follow(response.urljoin(story_url), callback=self.save_story)
-            if user_url and response.urljoin(user_url) not in self.state['done_user_urls']:
-                self.state['open_user_urls'].add(response.urljoin(user_url))
+            if user_url and not self.urls.contains('user', 'done', response.urljoin(user_url)):
+                self.urls.add('user', 'open', response.urljoin(user_url))
                 yield response.follow(response.urljoin(user_url), callback=self.save_user)
-            if reviews_url and response.urljoin(reviews_url) not in self.state['done_reviews_urls']:
-                self.state['open_reviews_urls'].add(response.urljoin(reviews_url))
+            if reviews_url and not self.urls.contains('reviews', 'done', response.urljoin(reviews_url)):
+                self.urls.add('reviews', 'open', response.urljoin(reviews_url))
                 yield response.follow(response.urljoin(reviews_url), callback=self.save_reviews)
 
     def save_story(self, response: any):
         # check for failed request
         if response.status == 403 or response.status == 404:
             self.crawler.stats.inc_value('failed_url_count')
-            self.state['failed_story_urls'].add(response.url)
+            self.urls.add('story', 'failed', response.url)
             raise CloseSpider
 
         # get last part of path while omitting preceeding 'https://www.fanfiktion.de/s/'
@@ -172,36 +204,20 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
         title = parts[6]
         filename = '%s_%s_%s.html' % (uid, chapter, title)
 
-        # save url data into csv file
-        with open('pages/stories.csv', 'a', encoding='UTF8') as f:
-            writer = csv.writer(f)
-            writer.writerow([filename, response.url, uid, title, chapter])
-
-        # save html file
-        with open('pages/stories/' + filename, 'wb') as f:
-            f.write(response.body)
-
-        # increment item count and archive if due
-        self.state['story_items'] = self.state.get('story_items', 0) + 1
-        self.state['item_count'] = self.state.get('item_count', 0) + 1
-        if self.state['story_items'] % 1000 == 0:  # every 1000 items
-            self.print_stats()
-            archive_files('pages/stories/', ARCHIVE_PATH_STORIES, 'stories')
-
-        # remove story url from open urls
-        self.state['open_story_urls'].discard(response.url)
+        # archive html file, its url is marked as done once its container is complete
+        self.save_page('story', filename, response.body, [filename, response.url, uid, title, chapter])
 
         # check for next chapter and follow
         next_chapter = response.css('div.story-right').xpath('.//a[contains(@title, "nächstes Kapitel")]/@href').get()
-        if next_chapter and response.urljoin(next_chapter) not in self.state['done_story_urls']:
-            self.state['open_story_urls'].add(response.urljoin(next_chapter))
+        if next_chapter and not self.urls.contains('story', 'done', response.urljoin(next_chapter)):
+            self.urls.add('story', 'open', response.urljoin(next_chapter))
             yield response.follow(next_chapter, callback=self.save_story)
 
     def save_user(self, response: any):
         # check for failed requests
         if response.status == 403 or response.status == 404:
             self.crawler.stats.inc_value('failed_url_count')
-            self.state['failed_user_urls'].add(response.url)
+            self.urls.add('user', 'failed', response.url)
             raise CloseSpider
 
         # get last part of path while omitting preceeding 'https://www.fanfiktion.de/u/'
@@ -209,30 +225,14 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
         uid = parts[4]
         filename = '%s.html' % uid
 
-        # save url data into csv file
-        with open('pages/users.csv', 'a', encoding='UTF8') as f:
-            writer = csv.writer(f)
-            writer.writerow([filename, response.url, uid])
-
-        # save html file
-        with open('pages/users/' + filename, 'wb') as f:
-            f.write(response.body)
-
-        # increment item count and archive if due
-        self.state['user_items'] = self.state.get('user_items', 0) + 1
-        self.state['item_count'] = self.state.get('item_count', 0) + 1
-        if self.state['user_items'] % 1000 == 0:  # every 1000 items
-            self.print_stats()
-            archive_files('pages/users/', ARCHIVE_PATH_USERS, 'users')
-
-        # remove user url from open urls
-        self.state['open_user_urls'].discard(response.url)
+        # archive html file, its url is marked as done once its container is complete
+        self.save_page('user', filename, response.body, [filename, response.url, uid])
 
     def save_reviews(self, response: any):
         # check for failed requests
         if response.status == 403 or response.status == 404:
             self.crawler.stats.inc_value('failed_url_count')
-            self.state['failed_reviews_urls'].add(response.url)
+            self.urls.add('reviews', 'failed', response.url)
             raise CloseSpider
 
         # get last part of path while omitting preceeding 'https://www.fanfiktion.de/r/s/'
@@ -243,27 +243,11 @@ class FanfiktionHtmlSpider(CrawlSpider, ABC):
         page = parts[8]
         filename = '%s_%s_%s_%s.html' % (uid, sorted_by, chapter, page)
 
-        # save url data into csv file
-        with open('pages/reviews.csv', 'a', encoding='UTF8') as f:
-            writer = csv.writer(f)
-            writer.writerow([filename, response.url, uid, page])
-
-        # save html file
-        with open('pages/reviews/' + filename, 'wb') as f:
-            f.write(response.body)
-
-        # increment item count and archive if due
-        self.state['reviews_items'] = self.state.get('reviews_items', 0) + 1
-        self.state['item_count'] = self.state.get('item_count', 0) + 1
-        if self.state['reviews_items'] % 1000 == 0:  # every 1000 items
-            self.print_stats()
-            archive_files('pages/reviews/', ARCHIVE_PATH_REVIEWS, 'reviews')
-
-        # remove reviews url from open urls
-        self.state['open_reviews_urls'].discard(response.url)
+        # archive html file, its url is marked as done once its container is complete
+        self.save_page('reviews', filename, response.body, [filename, response.url, uid, page])
 
         # check for next reviews and follow
         next_reviews = response.css('link[rel="next"]::attr(href)').get()
-        if next_reviews and response.urljoin(next_reviews) not in self.state['done_reviews_urls']:
-            self.state['open_reviews_urls'].add(response.urljoin(next_reviews))
+        if next_reviews and not self.urls.contains('reviews', 'done', response.urljoin(next_reviews)):
+            self.urls.add('reviews', 'open', response.urljoin(next_reviews))
             yield response.follow(next_reviews, callback=self.save_reviews)
@@ -1,10 +1,17 @@
 import re
 import os
 import csv
+import time
+import socket
+import threading
+import uuid
 from ..settings import MONGO_URI, MONGO_DB, EXTRACTED_STORIES_PATH, EXTRACTED_USERS_PATH, EXTRACTED_REVIEWS_PATH, CSV_STORIES_PATH, CSV_USERS_PATH, CSV_REVIEWS_PATH
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
 from abc import ABC
 from ..utilities import get_datetime, get_date, str_to_int
+from ..archives import archive_url
+from ..extractors import find_story_definitions, parse_html, extract_story, extract_chapter, extract_user, extract_reviews
 from tqdm import tqdm
 
 from scrapy.http import Request
@@ -13,25 +20,9 @@ from scrapy.loader import ItemLoader
 from scrapy.exceptions import CloseSpider
 from scrapy.spiders import CrawlSpider
 
-from w3lib.html import replace_tags, replace_escape_chars
-
 from ..items import Story, Chapter, User, Review
 
 
-def find_story_definitions(text: str) -> list:
-    """Find story definitions inside HTML snippet.
-    e.g. '<div class="small-font center block">\nGeschichte<span class="fas fa-angle-right" style="margin:0 .4em;"></span>Schmerz/Trost, Suspense / P16 / Gen\n</div>'
-
-    :param text: str
-        with HTML elements containing tags and excape chars
-    :return: list
-        with elements split by ' / ' character
-    """
-    text = replace_escape_chars(text)
-    text = replace_tags(text, ' / ')
-    return list(filter(None, [x.strip() for x in text.split(' / ')]))
-
-
 class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
     name = 'FanFiktionHtmlExtract'
 
@@ -40,8 +31,13 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
         'ROBOTSTXT_OBEY': 'False',
         'AUTOTHROTTLE_ENABLED': 'False',
         'ITEM_PIPELINES': {
-            'fanfiction.pipelines.FanfictionHtmlPipeline': 400
-        }
+            'fanfiction.pipelines.AsyncFanfictionHtmlPipeline': 400
+        },
+        'PIPELINE_BULK_WRITE': True,
+        'PIPELINE_CONCURRENCY': 1,
+        'DOWNLOAD_HANDLERS': {
+            'archive': 'fanfiction.archives.ArchiveDownloadHandler',
+        },
     }
 
     def start_requests(self):
@@ -62,29 +58,187 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
         #         csv_story = self.db['csv_stories'].find_one({'chapter': '1', 'uid': csv_chapter['uid']})
         #         yield Request(url='file://' + filepath, callback=self.parse_chapter, cb_kwargs=dict(csv_story=csv_story, csv_chapter=csv_chapter))
         # iterative [#4] -> reviews
-        for csv_reviews in self.db['csv_reviews'].find({'done': False}):
-            if 'extracted_folder' in csv_reviews:
-                filepath = os.path.join(EXTRACTED_REVIEWS_PATH, csv_reviews['extracted_folder'], csv_reviews['filename'])
+        for batch in self.claim_rows('csv_reviews'):
+            csv_stories = self.find_first_chapters(csv_reviews['uid'] for csv_reviews in batch)
+            released = []
+            for csv_reviews in batch:
+                url = self.page_url(csv_reviews, EXTRACTED_REVIEWS_PATH)
+                csv_story = csv_stories.get(csv_reviews['uid'])
+                if url and csv_story:
+                    yield Request(url=url, callback=self.parse_reviews, cb_kwargs=dict(csv_story=csv_story, csv_reviews=csv_reviews), meta=dict(row=('csv_reviews', csv_reviews['_id'])))
+                else:
+                    released.append(csv_reviews['_id'])
+            self.release_rows('csv_reviews', released)
+
+    def claim_rows(self, collection: str):
+        """Claims rows which are neither done nor leased by another process in batches of EXTRACT_BATCH_SIZE.
+        A row is claimed by atomically setting a lease owned by this process, so any number of processes
+        may run at once, each one working on disjoint rows. Leases of crashed processes expire after
+        EXTRACT_LEASE_SECONDS.
+
+        :param collection: str
+        :return: Iterator of lists of rows
+        """
+        last_id = None
+        while True:
+            now = time.time()
+            available = {'done': False, '$or': [{'lease_until': {'$exists': False}}, {'lease_until': {'$lt': now}}]}
+            query = dict(available, _id={'$gt': last_id}) if last_id else available  # released rows are not claimed again
+            ids = [row['_id'] for row in self.db[collection].find(query, {'_id': 1}).sort('_id', 1).limit(self.batch_size)]
+            if not ids:
+                return
+            last_id = ids[-1]
+            self.db[collection].update_many(dict(available, _id={'$in': ids}), {'$set': {'lease_owner': self.lease_owner, 'lease_until': now + self.lease_seconds}})
+            batch = list(self.db[collection].find({'_id': {'$in': ids}, 'lease_owner': self.lease_owner}))
+            if batch:
+                yield batch
+
+    def release_rows(self, collection: str, ids: list) -> None:
+        """Releases the lease of claimed rows which were not requested, e.g. since their page is missing,
+        so that a later run may process them.
+
+        :param collection: str
+        :param ids: list
+        """
+        if ids:
+            self.db[collection].update_many({'_id': {'$in': ids}, 'lease_owner': self.lease_owner}, {'$unset': {'lease_owner': '', 'lease_until': ''}})
+
+    def track(self, response, items):
+        """Yields the items parsed from the page of the row given in the request meta, counting those not yet processed
+        by the item pipelines. Once the page is parsed and all its items are processed, the row is saved for mark_done.
+
+        :param response: Response
+        :param items: Iterable
+        """
+        row = response.meta['row']
+        self.pending_rows[row] = self.pending_rows.get(row, 0) + 1  # held until the page is parsed
+        for item in items:
+            self.pending_rows[row] += 1
+            yield item
+        self.resolve(row)
+
+    def resolve(self, row: tuple, failed: bool = False) -> None:
+        """Counts an item of the row as processed. Rows with items which failed in the pipelines are not marked as done,
+        their leases expire so that a later run processes them again.
+
+        :param row: tuple
+            of collection and id
+        :param failed: bool
+        """
+        if row not in self.pending_rows:
+            return
+        if failed:
+            self.failed_rows.add(row)
+        self.pending_rows[row] -= 1
+        if self.pending_rows[row] == 0:
+            del self.pending_rows[row]
+            if row in self.failed_rows:
+                self.failed_rows.discard(row)
             else:
-                filepath = os.path.join(EXTRACTED_REVIEWS_PATH, csv_reviews['filename'])
-            if os.path.isfile(filepath):
-                csv_story = self.db['csv_story'].find_one({'chapter': '1', 'uid': csv_reviews['uid']})
-                yield Request(url='file://' + filepath, callback=self.parse_reviews, cb_kwargs=dict(csv_story=csv_story, csv_reviews=csv_reviews))
+                with self.done_lock:
+                    self.done_rows.append(row)
+
+    def handle_item_scraped(self, item, response, spider):
+        self.resolve(response.meta.get('row'))
+
+    def handle_item_dropped(self, item, response, exception, spider):
+        self.resolve(response.meta.get('row'))
+
+    def handle_item_error(self, item, response, spider, failure):
+        self.resolve(response.meta.get('row'), failed=True)
+
+    def items_flushed(self, written: bool) -> None:
+        """Called by the pipeline after writing its buffered items. Rows whose items were all processed before are
+        included in the written items, so they are marked as done now. If any write failed, these rows are left
+        to their leases expiring so that a later run processes them again.
+
+        :param written: bool
+        """
+        if written:
+            self.mark_done()
+        else:
+            with self.done_lock:
+                self.done_rows = []
+
+    def mark_done(self) -> None:
+        """Marks the rows whose items are written as done."""
+        with self.done_lock:
+            rows, self.done_rows = self.done_rows, []
+        operations = {}
+        for collection, row_id in rows:
+            operations.setdefault(collection, []).append(UpdateOne({'_id': row_id}, {'$set': {'done': True}, '$unset': {'lease_owner': '', 'lease_until': ''}}))
+        for collection, collection_operations in operations.items():
+            self.write_chunk(collection, collection_operations)
+
+    def find_first_chapters(self, uids) -> dict:
+        """Fetches the rows of the first chapters of the stories in a single query.
+
+        :param uids: Iterable
+            of story uids
+        :return: dict
+            mapping uid to csv_stories row
+        """
+        return {row['uid']: row for row in self.db['csv_stories'].find({'chapter': '1', 'uid': {'$in': list(set(uids))}})}
+
+    @staticmethod
+    def page_url(csv_row: dict, extracted_path: str):
+        """Returns url of the page inside its container if converted by extract_archives.py or of its extracted file.
+
+        :param csv_row: dict
+        :param extracted_path: str
+            Directory of extracted files
+        :return: url or None if neither container nor file exist
+        """
+        if 'archive' in csv_row:
+            if os.path.isfile(csv_row['archive']):
+                return archive_url(csv_row['archive'], csv_row['filename'])
+            return None
+        if 'extracted_folder' in csv_row:
+            filepath = os.path.join(extracted_path, csv_row['extracted_folder'], csv_row['filename'])
+        else:
+            filepath = os.path.join(extracted_path, csv_row['filename'])
+        if os.path.isfile(filepath):
+            return 'file://' + filepath
+        return None
 
     def __init__(self, *a, **kw):
         super(FanfiktionHtmlExtractSpider, self).__init__(*a, **kw)
         self.client = MongoClient(MONGO_URI)
         self.db = self.client[MONGO_DB]
+        self.lease_owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.batch_size = None
+        self.lease_seconds = None
+        # rows with items not yet processed by the pipelines mapped to their number, rows with failed items
+        self.pending_rows = {}
+        self.failed_rows = set()
+        # rows with processed items waiting for the pipeline to write them, appended to by the reactor thread
+        # and taken by the thread writing the items
+        self.done_rows = []
+        self.done_lock = threading.Lock()
+        # engine extracting the items: loader (ItemLoader), fast (lxml) or check (both, comparing their items).
+        # The ItemLoader engine stays the default, the equivalence of both is covered by tests/test_extractors.py
+        self.parser = getattr(self, 'parser', 'loader')
+        if self.parser not in ('loader', 'fast', 'check'):
+            raise ValueError('Unknown parser: %s' % self.parser)
+        self.page = None
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(FanfiktionHtmlExtractSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.batch_size = crawler.settings.getint('EXTRACT_BATCH_SIZE')
+        spider.lease_seconds = crawler.settings.getint('EXTRACT_LEASE_SECONDS')
         crawler.signals.connect(spider.handle_spider_opened, signals.spider_opened)
         crawler.signals.connect(spider.handle_spider_closed, signals.spider_closed)
+        crawler.signals.connect(spider.handle_item_scraped, signals.item_scraped)
+        crawler.signals.connect(spider.handle_item_dropped, signals.item_dropped)
+        crawler.signals.connect(spider.handle_item_error, signals.item_error)
         return spider
 
     def handle_spider_opened(self, spider):
         spider.logger.info('Spider opened: %s', spider.name)
+        for collection in ['csv_users', 'csv_stories', 'csv_reviews']:
+            self.db[collection].create_index([('done', ASCENDING), ('_id', ASCENDING)])
+        self.db['csv_stories'].create_index([('uid', ASCENDING), ('chapter', ASCENDING)])
         # if not os.path.isdir(EXTRACTED_STORIES_PATH) or not os.path.isdir(EXTRACTED_USERS_PATH) or not os.path.isdir(EXTRACTED_REVIEWS_PATH):
         #     spider.logger.info('Specified extracted paths from .env-file are no valid directories')
         #     raise CloseSpider
@@ -95,36 +249,130 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
 
     def handle_spider_closed(self, spider):
         spider.logger.info('Spider closed: %s', spider.name)
+        self.mark_done()  # the pipelines are closed before, having written all items
         self.client.close()
 
     def store_csvs(self):
-        if os.path.isfile(CSV_STORIES_PATH):
-            print('Storing stories from CSV file into database...')
-            with open(CSV_STORIES_PATH) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in tqdm(reader):
-                    csv_story = self.db['csv_stories'].find_one({'url': row[1]})
-                    if not csv_story:
-                        self.db['csv_stories'].insert_one({'filename': row[0], 'url': row[1], 'uid': row[2], 'title': row[3], 'chapter': row[4], 'done': False})
-        if os.path.isfile(CSV_USERS_PATH):
-            print('Storing users from CSV file into database...')
-            with open(CSV_USERS_PATH) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in tqdm(reader):
-                    csv_user = self.db['csv_users'].find_one({'url': row[1]})
-                    if not csv_user:
-                        self.db['csv_users'].insert_one({'filename': row[0], 'url': row[1], 'uid': row[2], 'done': False})
-        if os.path.isfile(CSV_REVIEWS_PATH):
-            print('Storing reviews from CSV file into database...')
-            with open(CSV_REVIEWS_PATH) as f:
-                reader = csv.reader(f, delimiter=',')
-                for row in tqdm(reader):
-                    csv_reviews = self.db['csv_reviews'].find_one({'url': row[1]})
-                    if not csv_reviews:
-                        self.db['csv_reviews'].insert_one({'filename': row[0], 'url': row[1], 'uid': row[2], 'page': row[3], 'done': False})
+        print('Storing stories from CSV file into database...')
+        self.store_csv(CSV_STORIES_PATH, 'csv_stories', lambda row: {'filename': row[0], 'url': row[1], 'uid': row[2], 'title': row[3], 'chapter': row[4], 'done': False})
+        print('Storing users from CSV file into database...')
+        self.store_csv(CSV_USERS_PATH, 'csv_users', lambda row: {'filename': row[0], 'url': row[1], 'uid': row[2], 'done': False})
+        print('Storing reviews from CSV file into database...')
+        self.store_csv(CSV_REVIEWS_PATH, 'csv_reviews', lambda row: {'filename': row[0], 'url': row[1], 'uid': row[2], 'page': row[3], 'done': False})
+
+    def store_csv(self, path: str, collection: str, build_document, chunk_size: int = 10000) -> int:
+        """Loads rows of a CSV file in chunks of unordered upserts keyed on the url.
+        Existing documents are left untouched so that their done flags persist.
+
+        :param path: str
+        :param collection: str
+        :param build_document: Callable
+            creating the document from a CSV row
+        :param chunk_size: int
+            Number of rows written per batch
+        :return: int
+            number of rows read
+        """
+        if not path or not os.path.isfile(path):
+            return 0
+        try:
+            self.db[collection].create_index('url', unique=True)
+        except OperationFailure as e:
+            self.logger.warning('Unique index on %s.url not created: %s', collection, e)
+            self.db[collection].create_index('url')
+        row_count = 0
+        inserted_count = 0
+        started_at = time.monotonic()
+        with open(path) as f:
+            reader = csv.reader(f, delimiter=',')
+            with tqdm(reader, unit=' rows') as rows:
+                operations = []
+                for row in rows:
+                    document = build_document(row)
+                    operations.append(UpdateOne({'url': document['url']}, {'$setOnInsert': document}, upsert=True))
+                    if len(operations) >= chunk_size:
+                        inserted_count += self.write_chunk(collection, operations)
+                        row_count += len(operations)
+                        operations = []
+                if operations:
+                    inserted_count += self.write_chunk(collection, operations)
+                    row_count += len(operations)
+        elapsed = max(time.monotonic() - started_at, 1e-6)
+        print('Stored %d rows (%d new) into %s at %.0f rows/s' % (row_count, inserted_count, collection, row_count / elapsed))
+        return row_count
+
+    def write_chunk(self, collection: str, operations: list) -> int:
+        """Writes a chunk of upserts.
+
+        :param collection: str
+        :param operations: list
+        :return: int
+            number of inserted documents
+        """
+        try:
+            return self.db[collection].bulk_write(operations, ordered=False).upserted_count
+        except BulkWriteError as e:
+            self.logger.error('Bulk write to %s failed for %d rows: %s', collection, len(e.details.get('writeErrors', [])), e.details.get('writeErrors', [])[:1])
+            return e.details.get('nUpserted', 0)
+
+    def page_root(self, response):
+        """Returns the lxml tree of the response, parsing it only once for all items of a page.
+
+        :param response: Response
+        :return: root element
+        """
+        if self.page is None or self.page[0] is not response:
+            self.page = (response, parse_html(response.text))
+        return self.page[1]
+
+    def extract(self, response, load_items, extract_items) -> list:
+        """Extracts the items of a page with the engine selected by the parser argument,
+        e.g. scrapy crawl FanFiktionHtmlExtract -a parser=fast. The check engine yields the ItemLoader
+        items and counts pages on which the fast engine produces different items.
+
+        :param response: Response
+        :param load_items: Callable
+            returning the items of the ItemLoader engine
+        :param extract_items: Callable
+            returning the items of the fast engine given the root element of the page
+        :return: list
+            of items
+        """
+        if self.parser == 'fast':
+            return list(extract_items(self.page_root(response)))
+        items = list(load_items())
+        if self.parser == 'check':
+            fast_items = list(extract_items(self.page_root(response)))
+            if [dict(item) for item in items] == [dict(item) for item in fast_items]:
+                self.crawler.stats.inc_value('extractors/match')
+            else:
+                self.crawler.stats.inc_value('extractors/mismatch')
+                self.logger.warning('Fast parser differs on %s: %s != %s', response.url, [dict(item) for item in items], [dict(item) for item in fast_items])
+        return items
 
     def parse_story(self, response, csv_story):
-        """Parses story item."""
+        """Parses story item and its first chapter."""
+        yield from self.extract(response, lambda: self.load_story(response, csv_story), lambda root: [extract_story(root, csv_story['url'])])
+        yield from self.parse_chapter(response, csv_story, csv_story)
+
+    def parse_chapter(self, response, csv_story, csv_chapter):
+        """Parses chapters and following."""
+        if not csv_story:
+            return False
+        yield from self.extract(response, lambda: self.load_chapter(response, csv_story, csv_chapter), lambda root: [extract_chapter(root, csv_story['url'], csv_chapter['url'])])
+
+    def parse_user(self, response, csv_user):
+        """Parses user item."""
+        yield from self.extract(response, lambda: self.load_user(response, csv_user), lambda root: [extract_user(root, csv_user['url'])])
+
+    def parse_reviews(self, response, csv_story, csv_reviews):
+        """Parses review items."""
+        if not csv_story:
+            return False
+        yield from self.track(response, self.extract(response, lambda: self.load_reviews(response, csv_story, csv_reviews), lambda root: extract_reviews(root, csv_story['url'], csv_reviews['url'])))
+
+    def load_story(self, response, csv_story):
+        """Loads story item."""
         loader = ItemLoader(item=Story(), selector=response)
 
         # mark stories with age verification
@@ -184,13 +432,9 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
             left.add_value('totalChapterCount', total_chapter_count)
 
         yield loader.load_item()
-        yield from self.parse_chapter(response, csv_story, csv_story)
-
-    def parse_chapter(self, response, csv_story, csv_chapter):
-        """Parses chapters and following."""
-        if not csv_story:
-            return False
 
+    def load_chapter(self, response, csv_story, csv_chapter):
+        """Loads chapter item."""
         right_sel = response.css('div.story-right')
         loader = ItemLoader(item=Chapter(), selector=right_sel)
         loader.add_value('storyUrl', csv_story['url'])
@@ -207,8 +451,8 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
             loader.add_value('title', chapter_title)
         yield loader.load_item()
 
-    def parse_user(self, response, csv_user):
-        """Parses user item."""
+    def load_user(self, response, csv_user):
+        """Loads user item."""
 
         loader = ItemLoader(item=User(), selector=response)
 
@@ -216,7 +460,6 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
         loader.add_value('source', 'FanFiktion')
         loader.add_css('username', 'div.userprofile-bio-table-outer h2')
 
-        self.db['csv_users'].find_one({})
         loader.add_value('url', csv_user['url'])
 
         bio_table = loader.nested_css('div.userprofile-bio-table')
@@ -242,11 +485,8 @@ class FanfiktionHtmlExtractSpider(CrawlSpider, ABC):
 
         yield loader.load_item()
 
-    def parse_reviews(self, response, csv_story, csv_reviews):
-        """Parses review items."""
-        if not csv_story:
-            return False
-
+    def load_reviews(self, response, csv_story, csv_reviews):
+        """Loads review items."""
         for review in response.css('div.review'):
             loader = ItemLoader(item=Review(), selector=review)
             loader.add_value('url', csv_reviews['url'])
@@ -1,3 +1,5 @@
+import csv
+import os
 import re
 from datetime import datetime
 
@@ -48,28 +50,55 @@ class FanfiktionSpider(CrawlSpider, ABC):
     }
 
     def start_requests(self):
-        users = self.db.users.find({'username': None, 'url': {'$regex': '^https:\/\/www\.fanfiktion\.de\/s'}})
-        user_count = self.db.users.count_documents({'username': None, 'url': {'$regex': '^https:\/\/www\.fanfiktion\.de\/s'}})
+        # users created from story urls, urlHost and urlKind are backfilled by scripts/backfill_url_fields.py
+        query = {'username': None, 'urlHost': 'fanfiktion.de', 'urlKind': 's'}
+        user_count = self.db.users.count_documents(query)
+        users = self.db.users.find(query)
+        # users stay unrepaired until scripts/repair_authors.py applies the journal, so they are not journaled again
+        journaled_ids = self.read_journaled_ids()
 
         with tqdm(total=user_count) as pbar:
             for user in users:
                 pbar.update(1)
-                if 'url' in user:
+                if 'url' in user and str(user['_id']) not in journaled_ids:
                     yield Request(url=user['url'], callback=self.parse_user_from_story, cookies=self.auth_cookies, cb_kwargs=dict(user=user))
 
     def parse_user_from_story(self, response, user):
+        """Journals the url of the author of the story the user was created from.
+        The references are repaired in bulk afterwards by scripts/repair_authors.py."""
         left = response.css('div.story-left')
         user_sub_url = left.xpath('.//a[starts-with(@href, "/u/")]/@href').get()
         if user_sub_url:
             user_url = response.urljoin(user_sub_url)
-            correct_user = self.db.users.find_one({'url': user_url})
-            if correct_user:
-                self.db.stories.update_many({'authorId': user['_id']}, {'$set': {'authorId': correct_user['_id']}})
-                self.db.users.delete_one({'_id': user['_id']})
-            else:
-                self.db.users.update_one({'_id': user['_id']}, {'$set': {'url': user_url}})
+            self.journal_author(user['_id'], user_url)
             yield Request(user_url, callback=self.parse_user)
 
+    def read_journaled_ids(self) -> set:
+        """Reads the ids of the users in the repair journal, including those already applied.
+
+        :return: set
+            of user ids as str
+        """
+        path = self.settings.get('REPAIR_JOURNAL_PATH')
+        if not os.path.isfile(path):
+            return set()
+        with open(path, encoding='UTF8', newline='') as f:
+            return {row[0] for row in csv.reader(f) if row}
+
+    def journal_author(self, user_id: ObjectId, user_url: str) -> None:
+        """Appends id of a user created from a story url and the url of the actual author of the story to the repair journal.
+
+        :param user_id: ObjectId
+        :param user_url: str
+        """
+        if self.repair_journal is None:
+            path = self.settings.get('REPAIR_JOURNAL_PATH')
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.repair_journal = open(path, 'a', encoding='UTF8', newline='')
+        csv.writer(self.repair_journal).writerow([str(user_id), user_url])
+        self.repair_journal.flush()
+        self.crawler.stats.inc_value('repair/journaled_authors')
+
     # def start_requests(self):
     #     items = self.db.chapters.find({'hasMissingContent': True})
     #     items_count = self.db.chapters.count_documents({'hasMissingContent': True})
@@ -95,6 +124,7 @@ class FanfiktionSpider(CrawlSpider, ABC):
         dispatcher.connect(self.spider_closed, signals.spider_closed)
         self.client = MongoClient(MONGO_URI)
         self.db = self.client[MONGO_DB]
+        self.repair_journal = None
         self.auth_cookies = []  # https://www.fanfiktion.de/?a=l
         self.auth_cookies = [
             {'name': 'i', 'value': '1f80c0f2352e815c831a199fd8e30d442ff5af6bba7d208765e6d6bb6305802bb912bb813dca1fcb3308605762cc9284e642dfaafb2bb3c65a989f1ccb78535e', 'domain': '.fanfiktion.de', 'path': '/'},
@@ -104,6 +134,8 @@ class FanfiktionSpider(CrawlSpider, ABC):
         ]
 
     def spider_closed(self, spider):
+        if self.repair_journal is not None:
+            self.repair_journal.close()
         self.client.close()
 
     def handle_failed_request(self, failure):
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import time
+
+
+class UrlStateStore:
+
+    def __init__(self, path: str, commit_interval: int = 1000, commit_seconds: float = 30.0):
+        """Initializes disk-backed store of url sets which replaces keeping them in the pickled spider state.
+        Each url has one status per kind, e.g. a story url is either 'open', 'done' or 'failed'.
+        Changes are committed incrementally so that a crash only loses the changes since the last checkpoint.
+
+        :param path: str
+            Path of the SQLite database file
+        :param commit_interval: int
+            Number of changes after which they are committed
+        :param commit_seconds: float
+            Seconds after which changes are committed with the next change
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_seconds = commit_seconds
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS urls (kind TEXT NOT NULL, url TEXT NOT NULL, status TEXT NOT NULL, PRIMARY KEY (kind, url)) WITHOUT ROWID')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS urls_status ON urls (kind, status)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID')
+        self.connection.commit()
+        self.counts = {(kind, status): count for kind, status, count in self.connection.execute('SELECT kind, status, COUNT(*) FROM urls GROUP BY kind, status')}
+        self.changes = 0
+        self.committed_at = time.monotonic()
+
+    def status(self, kind: str, url: str) -> str:
+        """Returns status of the url or None if it is unknown.
+
+        :param kind: str
+        :param url: str
+        :return: str or None
+        """
+        row = self.connection.execute('SELECT status FROM urls WHERE kind = ? AND url = ?', (kind, url)).fetchone()
+        return row[0] if row else None
+
+    def contains(self, kind: str, status: str, url: str) -> bool:
+        """Checks if the url has the status.
+
+        :param kind: str
+        :param status: str
+        :param url: str
+        :return: bool
+        """
+        return self.status(kind, url) == status
+
+    def add(self, kind: str, status: str, url: str) -> None:
+        """Sets status of the url.
+
+        :param kind: str
+        :param status: str
+        :param url: str
+        """
+        previous = self.status(kind, url)
+        if previous == status:
+            return
+        self.connection.execute('INSERT OR REPLACE INTO urls (kind, url, status) VALUES (?, ?, ?)', (kind, url, status))
+        if previous is not None:
+            self.counts[(kind, previous)] -= 1
+        self.counts[(kind, status)] = self.counts.get((kind, status), 0) + 1
+        self.changed()
+
+    def discard(self, kind: str, status: str, url: str) -> None:
+        """Removes the url if it has the status.
+
+        :param kind: str
+        :param status: str
+        :param url: str
+        """
+        if self.connection.execute('DELETE FROM urls WHERE kind = ? AND url = ? AND status = ?', (kind, url, status)).rowcount:
+            self.counts[(kind, status)] -= 1
+            self.changed()
+
+    def pop(self, kind: str, status: str, limit: int = 1000) -> list:
+        """Removes and returns up to limit urls having the status.
+
+        :param kind: str
+        :param status: str
+        :param limit: int
+        :return: list
+        """
+        urls = [row[0] for row in self.connection.execute('SELECT url FROM urls WHERE kind = ? AND status = ? LIMIT ?', (kind, status, limit))]
+        self.connection.executemany('DELETE FROM urls WHERE kind = ? AND url = ?', ((kind, url) for url in urls))
+        if urls:
+            self.counts[(kind, status)] -= len(urls)
+            self.changes += len(urls) - 1
+            self.changed()
+        return urls
+
+    def count(self, kind: str, status: str) -> int:
+        """Returns number of urls having the status.
+
+        :param kind: str
+        :param status: str
+        :return: int
+        """
+        return self.counts.get((kind, status), 0)
+
+    def get_counter(self, name: str) -> int:
+        """Returns value of the named counter.
+
+        :param name: str
+        :return: int
+        """
+        row = self.connection.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_counter(self, name: str, value: int) -> None:
+        """Sets value of the named counter.
+
+        :param name: str
+        :param value: int
+        """
+        self.connection.execute('INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)', (name, value))
+        self.changed()
+
+    def increment(self, name: str) -> int:
+        """Increments the named counter.
+
+        :param name: str
+        :return: int
+            new value of the counter
+        """
+        value = self.get_counter(name) + 1
+        self.set_counter(name, value)
+        return value
+
+    def changed(self) -> None:
+        """Counts a change and commits once one of the checkpoint thresholds is reached."""
+        self.changes += 1
+        if self.changes >= self.commit_interval or time.monotonic() - self.committed_at >= self.commit_seconds:
+            self.commit()
+
+    def commit(self) -> None:
+        """Commits all changes since the last checkpoint."""
+        self.connection.commit()
+        self.changes = 0
+        self.committed_at = time.monotonic()
+
+    def close(self) -> None:
+        """Commits pending changes and closes the database."""
+        self.commit()
+        self.connection.close()
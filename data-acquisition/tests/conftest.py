@@ -0,0 +1,14 @@
+import os
+import sys
+import types
+
+PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules such as the pipelines import their siblings absolutely
+sys.path.insert(0, PROJECT_PATH)
+
+# the spiders import their siblings relatively from the package the project is deployed as, see SPIDER_MODULES
+if 'fanfiction' not in sys.modules:
+    package = types.ModuleType('fanfiction')
+    package.__path__ = [PROJECT_PATH]
+    sys.modules['fanfiction'] = package
@@ -0,0 +1,66 @@
+# Tests of the buffered documents of the BulkWriter and the merged updates of the pipelines in bulk mode.
+
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from pipelines import BulkWriter, MongoPipeline
+
+
+def test_pending_document_reflects_buffered_updates():
+    writer = BulkWriter(None, batch_size=100, flush_interval=3600)
+    story_id = writer.insert('stories', {'url': 'https://www.fanfiktion.de/s/1', 'title': None})
+    writer.update('stories', {'_id': story_id}, {'$set': {'title': 'Titel'}})
+    assert writer.pending('stories', {'url': 'https://www.fanfiktion.de/s/1'})['title'] == 'Titel'
+
+
+def test_changes_keep_fields_updated_since_the_read():
+    found = {'_id': 1, 'title': 'Titel', 'likes': 3, 'currentReviewCount': 0}
+    merged = {**found, 'likes': 4}
+    assert MongoPipeline.changes(found, merged) == {'likes': 4}
+
+
+class ScriptedDatabase:
+    """Database in which another process has inserted the user https://www.fanfiktion.de/u/Dachs first."""
+
+    def __init__(self, winner_id: ObjectId, failing: set = frozenset()):
+        self.winner_id = winner_id
+        self.failing = failing
+        self.writes = []
+
+    def __getitem__(self, collection: str):
+        def bulk_write(operations, ordered=True):
+            self.writes.append((collection, operations))
+            if collection in self.failing:
+                raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'failed'}], 'upserted': []})
+            return SimpleNamespace(upserted_ids={})  # the upsert matched the document inserted first
+
+        def find(query, projection=None):
+            return [{'_id': self.winner_id, 'url': url} for url in query['url']['$in']]
+        return SimpleNamespace(bulk_write=bulk_write, find=find)
+
+
+def test_documents_inserted_first_by_another_process_replace_buffered_ones():
+    winner_id = ObjectId()
+    db = ScriptedDatabase(winner_id)
+    flushes = []
+    writer = BulkWriter(db, batch_size=100, flush_interval=3600, on_flush=flushes.append)
+    user_id = writer.insert('users', {'url': 'https://www.fanfiktion.de/u/Dachs', 'username': 'Dachs', 'isPreliminary': False})
+    review = {'userId': user_id, 'content': 'Schön'}
+    writer.insert('reviews', review)
+    writer.flush()
+    assert db.writes[0] == ('users', [UpdateOne({'url': 'https://www.fanfiktion.de/u/Dachs'}, {'$setOnInsert': {'username': 'Dachs', 'isPreliminary': False, '_id': user_id}}, upsert=True)])
+    assert db.writes[1] == ('users', [UpdateOne({'_id': winner_id}, {'$set': {'username': 'Dachs', 'isPreliminary': False}}, upsert=False)])
+    assert db.writes[2] == ('reviews', [InsertOne({'userId': winner_id, 'content': 'Schön', '_id': review['_id']})])
+    assert flushes == [True]
+
+
+def test_failed_flushes_are_reported():
+    db = ScriptedDatabase(ObjectId(), failing={'reviews'})
+    flushes = []
+    writer = BulkWriter(db, batch_size=100, flush_interval=3600, on_flush=flushes.append)
+    writer.insert('reviews', {'content': 'Schön'})
+    writer.flush()
+    assert flushes == [False]
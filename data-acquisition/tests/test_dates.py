@@ -0,0 +1,17 @@
+# Tests of parsing the German dates of FanFiktion.de, which are read day first.
+
+from datetime import datetime
+
+from utilities import get_date, get_datetime
+
+
+def test_ambiguous_dates_are_read_day_first():
+    assert get_date('01.02.2020') == datetime(2020, 2, 1)
+
+
+def test_datetimes_are_read_day_first():
+    assert get_datetime('01.02.2020 um 13:45 Uhr') == datetime(2020, 2, 1, 13, 45)
+
+
+def test_other_formats_are_parsed_by_dateutil():
+    assert get_date('2020-02-01') == datetime(2020, 2, 1)
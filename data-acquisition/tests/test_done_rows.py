@@ -0,0 +1,89 @@
+# Tests of marking csv rows done in the FanFiktionHtmlExtract spider.
+#
+# A row may only be marked as done once the bulk write containing the items of its page has been executed,
+# otherwise a crash in between loses those items for good.
+
+import threading
+from types import SimpleNamespace
+
+from scrapy.http import HtmlResponse, Request
+
+from fanfiction.spiders.FanFiktionHtmlExtract import FanfiktionHtmlExtractSpider
+from pipelines import BulkWriter
+
+
+class RecordingDatabase:
+    """Database recording the collections of its bulk writes in order."""
+
+    def __init__(self):
+        self.writes = []
+
+    def __getitem__(self, collection: str):
+        def bulk_write(operations, ordered=True):
+            self.writes.append((collection, len(operations)))
+            return SimpleNamespace(upserted_count=0, upserted_ids={})
+        return SimpleNamespace(bulk_write=bulk_write)
+
+
+def create_spider(db: RecordingDatabase) -> FanfiktionHtmlExtractSpider:
+    spider = FanfiktionHtmlExtractSpider.__new__(FanfiktionHtmlExtractSpider)  # no database connection
+    spider.db = db
+    spider.pending_rows = {}
+    spider.failed_rows = set()
+    spider.done_rows = []
+    spider.done_lock = threading.Lock()
+    return spider
+
+
+def page_response(row_id: int) -> HtmlResponse:
+    request = Request('file:///reviews/%d.html' % row_id, meta=dict(row=('csv_reviews', row_id)))
+    return HtmlResponse(url=request.url, body=b'', request=request)
+
+
+def test_rows_are_marked_done_after_their_items_are_written():
+    db = RecordingDatabase()
+    spider = create_spider(db)
+    writer = BulkWriter(db, batch_size=100, flush_interval=3600, on_flush=spider.items_flushed)
+    response = page_response(1)
+    for item in spider.track(response, [{'content': 'a'}, {'content': 'b'}]):
+        writer.insert('reviews', dict(item))  # as the pipeline does in its thread
+        spider.handle_item_scraped(item, response, spider)
+    assert db.writes == []
+    writer.flush()
+    assert db.writes == [('reviews', 2), ('csv_reviews', 1)]
+
+
+def test_rows_wait_for_items_still_in_the_pipeline():
+    db = RecordingDatabase()
+    spider = create_spider(db)
+    writer = BulkWriter(db, batch_size=100, flush_interval=3600, on_flush=spider.items_flushed)
+    response = page_response(1)
+    items = list(spider.track(response, [{'content': 'a'}, {'content': 'b'}]))
+    writer.insert('reviews', dict(items[0]))
+    spider.handle_item_scraped(items[0], response, spider)
+    writer.flush()  # the second item has not been processed yet
+    assert db.writes == [('reviews', 1)]
+    writer.insert('reviews', dict(items[1]))
+    spider.handle_item_scraped(items[1], response, spider)
+    writer.flush()
+    assert db.writes == [('reviews', 1), ('reviews', 1), ('csv_reviews', 1)]
+
+
+def test_rows_with_failed_items_are_not_marked_done():
+    db = RecordingDatabase()
+    spider = create_spider(db)
+    response = page_response(1)
+    items = list(spider.track(response, [{'content': 'a'}, {'content': 'b'}]))
+    spider.handle_item_scraped(items[0], response, spider)
+    spider.handle_item_error(items[1], response, spider, None)
+    spider.items_flushed(True)
+    assert db.writes == []
+    assert spider.pending_rows == {} and spider.failed_rows == set()
+
+
+def test_rows_without_items_are_marked_done():
+    db = RecordingDatabase()
+    spider = create_spider(db)
+    assert list(spider.track(page_response(1), [])) == []
+    spider.items_flushed(True)
+    assert db.writes == [('csv_reviews', 1)]
@@ -0,0 +1,88 @@
+# Golden-file tests of the extraction engines of the FanFiktionHtmlExtract spider.
+#
+# Every page in fixtures/ is accompanied by a json file holding the metadata of its csv rows and the items
+# expected from it. Both the ItemLoader callbacks (load_*) and the lxml functions of extractors.py (extract_*)
+# must produce exactly these items, so the fast engine can replace the ItemLoader engine.
+
+import json
+import os
+from datetime import datetime
+
+import pytest
+from scrapy.http import HtmlResponse
+
+from fanfiction.extractors import parse_html, extract_story, extract_chapter, extract_user, extract_reviews
+from fanfiction.spiders.FanFiktionHtmlExtract import FanfiktionHtmlExtractSpider
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+FIXTURES = sorted(filename[:-len('.json')] for filename in os.listdir(FIXTURES_PATH) if filename.endswith('.json'))
+
+
+def read_fixture(name: str) -> tuple:
+    """Returns response of the saved page and its expectations.
+
+    :param name: str
+    :return: tuple
+    """
+    with open(os.path.join(FIXTURES_PATH, name + '.json'), encoding='utf-8') as f:
+        case = json.load(f)
+    with open(os.path.join(FIXTURES_PATH, name + '.html'), 'rb') as f:
+        response = HtmlResponse(url=case['url'], body=f.read(), encoding='utf-8')
+    return response, case
+
+
+def as_json(items: list) -> list:
+    """Returns the items as dicts with datetimes in ISO format as stored in the json files.
+
+    :param items: list
+    :return: list
+    """
+    return [{field: value.isoformat() if isinstance(value, datetime) else value for field, value in dict(item).items()} for item in items]
+
+
+def load_items(response, case: dict) -> list:
+    """Returns the items of the ItemLoader engine, by the same calls as the parse callbacks of the spider.
+
+    :param response: HtmlResponse
+    :param case: dict
+    :return: list
+    """
+    spider = FanfiktionHtmlExtractSpider.__new__(FanfiktionHtmlExtractSpider)  # the loaders use no spider state, e.g. no database
+    csv_story = {'url': case.get('storyUrl')}
+    csv_page = {'url': case['url']}
+    if case['page'] == 'story':
+        return list(spider.load_story(response, csv_story)) + list(spider.load_chapter(response, csv_story, csv_story))
+    if case['page'] == 'chapter':
+        return list(spider.load_chapter(response, csv_story, csv_page))
+    if case['page'] == 'user':
+        return list(spider.load_user(response, csv_page))
+    return list(spider.load_reviews(response, csv_story, csv_page))
+
+
+def extract_items(response, case: dict) -> list:
+    """Returns the items of the fast engine.
+
+    :param response: HtmlResponse
+    :param case: dict
+    :return: list
+    """
+    root = parse_html(response.text)
+    if case['page'] == 'story':
+        return [extract_story(root, case['storyUrl']), extract_chapter(root, case['storyUrl'], case['storyUrl'])]
+    if case['page'] == 'chapter':
+        return [extract_chapter(root, case['storyUrl'], case['url'])]
+    if case['page'] == 'user':
+        return [extract_user(root, case['url'])]
+    return list(extract_reviews(root, case['storyUrl'], case['url']))
+
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_item_loader_engine(name):
+    response, case = read_fixture(name)
+    assert as_json(load_items(response, case)) == case['items']
+
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_fast_engine(name):
+    response, case = read_fixture(name)
+    assert as_json(extract_items(response, case)) == case['items']
@@ -0,0 +1,25 @@
+# Normalized host and kind of the url of a document.
+#
+# Documents of both archives and of every kind of page share their collections, e.g. users which early crawls
+# created from story urls of FanFiktion.de. Selecting them by a regular expression on the url scans the whole
+# collection, so the host without www. and the first segment of the path are stored as urlHost and urlKind,
+# e.g. fanfiktion.de and s, u or r, or archiveofourown.org and works or users, and queried by equality.
+
+from urllib.parse import urlparse
+
+# collections whose documents have an url
+COLLECTIONS = ['users', 'stories', 'chapters', 'reviews']
+
+
+def url_fields(url: str) -> dict:
+    """Returns urlHost and urlKind of the url.
+
+    :param url: str
+    :return: dict
+    """
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    return {'urlHost': host or None, 'urlKind': segments[0] if segments else None}
@@ -1,8 +1,8 @@
 from datetime import datetime
-from dateutil import parser
-from parser import ParserError
+from dateutil.parser import ParserError
 from typing import Union
-import re
+
+from normalization import NON_DATETIME_PATTERN, NON_DATE_PATTERN, parse_datetime
 
 
 # merge two dictionaries and replace None and empty values if available
@@ -26,9 +26,8 @@ def str_to_int(string_value: str) -> Union[int, str]:
 # format datetime from string
 def get_datetime(datetime_string: str) -> Union[datetime, str]:
     try:
-        datetime_string = re.sub(r'[^\d.:]', ' ', datetime_string)  # replace everything except numbers, ':' and '.' characters with spaces
-        datetime_string = re.sub(r'\s{2,}', ' ', datetime_string)  # replace multiple spaces with single space
-        return parser.parse(datetime_string)
+        datetime_string = NON_DATETIME_PATTERN.sub(' ', datetime_string)  # replace everything except numbers, ':' and '.' characters with single spaces
+        return parse_datetime(datetime_string)
     except AttributeError:
         print('Passed item is not a String')
         return datetime_string
@@ -40,9 +39,8 @@ def get_datetime(datetime_string: str) -> Union[datetime, str]:
 # format date from string
 def get_date(date_string: str) -> Union[datetime, str]:
     try:
-        date_string = re.sub(r'[^\d.]', ' ', date_string)  # replace everything except numbers, ':' and '.' characters with spaces
-        date_string = re.sub(r'\s{2,}', ' ', date_string)  # replace multiple spaces with single space
-        return parser.parse(date_string)
+        date_string = NON_DATE_PATTERN.sub(' ', date_string)  # replace everything except numbers and '.' characters with single spaces
+        return parse_datetime(date_string)
     except (AttributeError, TypeError):
         print('Passed item is not a String')
         print(date_string)